@@ -1,33 +1,98 @@
 from flask import Flask, render_template, request, redirect, url_for
 from flask_socketio import SocketIO, emit
-from model import db, Page, BodyInvertedIndex, TitleInvertedIndex, DocumentStats
+from model import db, Page, DocumentStats, DuplicatePage, PageText, PageLink, SegmentCommit, ENGINE_OPTIONS, upgrade_schema
 from spider import crawl
+from fetchcache import FetchCache
 from threading import Thread
 import time
-from sqlalchemy.pool import NullPool
+from sqlalchemy.orm import selectinload
 from phase1 import output_records_to_txt
-from search import search
+from search import search, slow_queries
+from querycache import query_cache
+from indexer import recover_segments
+from generation import bump_generation
+from docstats import reset_doc_stats
+from segments import get_store
+from snapshot import write_snapshot, load_snapshot
+from shards import write_shards, SHARD_DIR
+from frontier import Frontier
+from chat import answer
+from similar import similar_pages, refresh_similar
+from linkgraph import reset_link_graph
+from writer import get_writer
 import os
-import requests
-from flask import jsonify
+import click
+from flask import jsonify, Response, stream_with_context
+from metrics import render as render_metrics
 
 URL = "https://www.cse.ust.hk/~kwtleung/COMP4321/testpage.htm"
+SPIDER_PAGE_SIZE = 50  # Pages listed per /spider page
 is_crawling = False
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///database.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
-    'poolclass': NullPool,
-    'connect_args': {'timeout': 30}  # Increase timeout
-}
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = ENGINE_OPTIONS  # WAL mode, pooled connections
+# Optional directory for compressed raw page bodies, reused when re-crawling
+app.config['FETCH_CACHE_DIR'] = os.environ.get('FETCH_CACHE_DIR')
+# Crawl frontier checkpoint, so an interrupted crawl resumes on the next start
+app.config['FRONTIER_PATH'] = os.environ.get('FRONTIER_PATH') or os.path.join(app.instance_path, 'frontier.db')
 db.init_app(app)
 socketio = SocketIO(app, cors_allowed_origins="*")
 
+with app.app_context():
+    # Add the tables and columns a database from an older version lacks, keeping its pages
+    try:
+        added = upgrade_schema(db.engine)
+        if added:
+            print(f"Upgraded database schema, added {', '.join(added)}")
+        if 'page.norm_title' in added:
+            # Its df counts are of the old inverted index tables; the next crawl reindexes every page
+            db.session.query(DocumentStats).delete()
+            db.session.commit()
+    except Exception as e:
+        print(f"Error upgrading database schema: {e}")
+
+    # Publish index segments whose pages committed just before the last shutdown
+    try:
+        recover_segments(db.session)
+    except Exception as e:
+        print(f"Error recovering index segments: {e}")
+
 @app.cli.command('init-db')
 def initialize_database():
     db.drop_all()
     db.create_all()
+    get_store().clear()
+    reset_link_graph()
+    with Frontier(app.config['FRONTIER_PATH']) as frontier:
+        frontier.clear()
+
+@app.cli.command('index-snapshot')
+@click.argument('path', default='index.snapshot')
+def index_snapshot(path):
+    """Write the index, df table and page stats to one snapshot file."""
+    start = time.time()
+    pages = write_snapshot(path, db.session, get_store())
+    click.echo(f"Wrote {pages} pages to {path} ({os.path.getsize(path)} bytes) in {time.time() - start:.2f}s")
+
+@app.cli.command('index-load')
+@click.argument('path', default='index.snapshot')
+def index_load(path):
+    """Replace the pages and index with those of a snapshot file."""
+    start = time.time()
+    pages = load_snapshot(path, db.session, get_store())
+    reset_doc_stats()
+    bump_generation()
+    click.echo(f"Loaded {pages} pages from {path} in {time.time() - start:.2f}s")
+
+@app.cli.command('index-shard')
+@click.argument('num_shards', type=int)
+def index_shard(num_shards):
+    """Split the index into document-partitioned shards for SEARCH_SHARDS=local."""
+    start = time.time()
+    counts = write_shards(db.session, get_store(), num_shards)
+    click.echo(f"Wrote {num_shards} shards of {', '.join(map(str, counts))} pages to {SHARD_DIR} in {time.time() - start:.2f}s")
 
 @app.route('/')
 def index():
@@ -43,11 +108,42 @@ def search_page():
     results = search(query)
     return render_template('search.html', results=results, query=query)
 
+@app.route('/search_cache')
+def search_cache_stats():
+    return jsonify(query_cache.stats())
+
+@app.route('/metrics')
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/slow_queries')
+def slow_query_traces():
+    return jsonify(list(slow_queries))
+
 @app.route('/spider')
 def spider():
-    pages = Page.query.all()
+    # Keyset pagination on id: ?after=<id> lists the next pages, ?before=<id> the previous ones,
+    # each an index range scan however deep into the crawl
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+    query = Page.query.options(selectinload(Page.parent).load_only(Page.url),
+                               selectinload(Page.children).load_only(Page.url, Page.parent_id))
+    if before is not None:
+        pages = query.filter(Page.id < before).order_by(Page.id.desc()).limit(SPIDER_PAGE_SIZE + 1).all()
+        has_previous = len(pages) > SPIDER_PAGE_SIZE
+        pages = pages[:SPIDER_PAGE_SIZE][::-1]
+        has_next = bool(pages)
+    else:
+        if after is not None:
+            query = query.filter(Page.id > after)
+        pages = query.order_by(Page.id).limit(SPIDER_PAGE_SIZE + 1).all()
+        has_next = len(pages) > SPIDER_PAGE_SIZE
+        pages = pages[:SPIDER_PAGE_SIZE]
+        has_previous = after is not None and db.session.query(Page.id).filter(Page.id <= after).first() is not None
     length = db.session.query(Page).count()
-    return render_template('spider.html', pages=pages, crawling_url = URL, is_crawling = is_crawling, length = length)
+    return render_template('spider.html', pages=pages, crawling_url = URL, is_crawling = is_crawling, length = length,
+                           next_after=pages[-1].id if has_next else None,
+                           previous_before=pages[0].id if has_previous and pages else None)
 
 @app.route('/start', methods=['POST'])
 def start_crawl():
@@ -56,7 +152,10 @@ def start_crawl():
         with app.app_context():
             is_crawling = True
             try:
-                crawl(URL, socketio)
+                cache_dir = app.config['FETCH_CACHE_DIR']
+                crawl(URL, socketio, fetch_cache=FetchCache(cache_dir) if cache_dir else None,
+                      frontier_path=app.config['FRONTIER_PATH'])
+                refresh_similar(db.session)
             except Exception as e:
                 print(f"error: {e}")
             finally:
@@ -69,30 +168,53 @@ def start_crawl():
 
 @app.route('/clear_database', methods=['POST'])
 def clear_database():
-    db.session.query(Page).delete()
-    db.session.query(BodyInvertedIndex).delete()
-    db.session.query(TitleInvertedIndex).delete()
-    db.session.query(DocumentStats).delete()
-    db.session.commit()
+    get_writer().run(clear_tables)
+    get_store().clear()
+    reset_link_graph()
+    with Frontier(app.config['FRONTIER_PATH']) as frontier:
+        frontier.clear()
+    reset_doc_stats()
+    bump_generation()
     socketio.emit('update', {'data': 'Database cleared'})
     return redirect(url_for('spider'))
 
+def clear_tables(session):
+    session.query(SegmentCommit).delete()
+    session.query(DuplicatePage).delete()
+    session.query(PageText).delete()
+    session.query(PageLink).delete()
+    session.query(Page).delete()
+    session.query(DocumentStats).delete()
+
 @app.route('/phase1', methods=['POST'])
 def phase1():
-    output_records_to_txt()
+    output_records_to_txt(full_export=request.form.get('full_export') == 'on')
     return redirect(url_for('spider'))
     
 
 @app.route('/get_similar', methods=['POST'])
 def get_similar():
-    from indexer import STOP_WORDS
-    page_id = request.form.get('page_id')
+    page_id = request.form.get('page_id', type=int)
     original_query = request.form.get('original_query', '')
-    if not page_id:
+    if page_id is None:
         return redirect(url_for('search_page', query=original_query))
-    page = Page.query.get(page_id)
-    if not page or not page.keywords:
+    page = db.session.get(Page, page_id)
+    if not page:
         return redirect(url_for('search_page', query=original_query))
+    neighbours = similar_pages(db.session, page_id)
+    if neighbours is None:
+        # Crawled after the similar pages index was built: search for its top keywords instead
+        return redirect(url_for('search_page', query=keyword_query(page) or original_query))
+    pages = {other.id: other for other in Page.query.filter(Page.id.in_([other_id for other_id, _ in neighbours]))}
+    results = [(pages[other_id], score) for other_id, score in neighbours if other_id in pages]
+    return render_template('search.html', results=results, query=original_query, similar_to=page)
+
+
+def keyword_query(page):
+    """The page's top 5 keywords as a query string."""
+    from indexer import STOP_WORDS
+    if not page.keywords:
+        return ''
     # Flatten and filter stopwords
     keywords = []
     for kw in page.keywords:
@@ -106,12 +228,7 @@ def get_similar():
             keywords.append((stem, freq))
     # Sort by frequency, take top 5
     keywords = sorted(keywords, key=lambda x: -x[1])
-    top_keywords = [k[0] for k in keywords[:5]]
-    if not top_keywords:
-        return redirect(url_for('search_page', query=original_query))
-    # Join keywords as new query
-    revised_query = ' '.join(top_keywords)
-    return redirect(url_for('search_page', query=revised_query))
+    return ' '.join(k[0] for k in keywords[:5])
 
 
 @app.route('/chat', methods=['GET', 'POST'])
@@ -121,109 +238,14 @@ def chat():
 
     data = request.get_json()
     user_message = data.get('message', '')
-
-    # Step 1: Use AI to extract search keywords from the question
-    DEEPSEEK_API_KEY = os.environ.get('DEEPSEEK_API_KEY', 'sk-9a1925a117ba4039b90328dd065a06bc')
-    api_url = 'https://api.deepseek.com/v1/chat/completions'
-    headers = {
-        'Authorization': f'Bearer {DEEPSEEK_API_KEY}',
-        'Content-Type': 'application/json'
-    }
-
-    keyword_system_prompt = """You are a keyword extraction assistant. 
-    Extract 3-5 most important search keywords from the user's question. 
-    Return ONLY the keywords separated by spaces, no other text or explanation."""
-
-    payload = {
-        'model': 'deepseek-chat',
-        'messages': [
-            {'role': 'system', 'content': keyword_system_prompt},
-            {'role': 'user', 'content': user_message}
-        ]
-    }
-
-    try:
-        resp = requests.post(api_url, headers=headers, json=payload, timeout=10)
-        resp.raise_for_status()
-        keywords = resp.json()['choices'][0]['message']['content'].strip()
-        print(f"Extracted keywords: {keywords}")
-    except Exception as e:
-        print(f"Error extracting keywords: {e}")
-        # Fallback to using the entire query
-        keywords = user_message
-
-    # Step 2: Search the database with the AI-extracted keywords
-    results = search(keywords)
-    print(f"Search results for '{keywords}': {len(results)} results found")
-
-    # Step 3: Build context from search results
-    if results:
-        context = "The following information is from our database:\n\n"
-
-        # Get full content from top 3 results
-        for i, (page, score) in enumerate(results[:3], 1):
-            context += f"Document {i}: {page.title}\n"
-            context += f"URL: {page.url}\n"
-
-            # Try to fetch the actual page content
-            try:
-                if page.url.startswith(('http://', 'https://')):
-                    response = requests.get(page.url, timeout=5)
-                    if response.status_code == 200:
-                        from bs4 import BeautifulSoup
-                        soup = BeautifulSoup(response.text, 'html.parser')
-
-                        # Remove script and style elements
-                        for script in soup(["script", "style"]):
-                            script.extract()
-
-                        # Get text
-                        page_text = soup.get_text(separator='\n', strip=True)
-                        context += f"Page Content:\n{page_text}\n"
-                    else:
-                        context += f"Content could not be retrieved (HTTP {response.status_code})\n"
-                else:
-                    context += "URL not accessible (invalid URL format)\n"
-            except Exception as e:
-                # Fall back to keywords if we can't get the content
-                if page.keywords:
-                    if isinstance(page.keywords[0], list):
-                        keywords_list = [f"{k[0]} ({k[1]})" for k in sorted(page.keywords, key=lambda x: -x[1])[:15]]
-                    else:
-                        keywords_list = [f"{k.get('stem', '')} ({k.get('frequency', 0)})" for k in
-                                        sorted(page.keywords, key=lambda x: -x.get('frequency', 0))[:15]]
-                    context += f"Keywords: {', '.join(keywords_list)}\n"
-                context += f"Note: Full page content unavailable. Error: {str(e)[:100]}\n"
-
-            # Add separator between documents
-            context += "\n" + "-" * 40 + "\n\n"
-    else:
-        context = "No relevant information found in our database."
-
-    # Step 4: Use AI to analyze the pages and respond to the question
-    analysis_system_prompt = """You are a helpful assistant that provides information based on the database context provided.
-    Only use the information in the given context to answer the user's question.
-    If the context doesn't contain relevant information to answer the question, state that you don't have that information.
-    Do not make up information or use knowledge outside of the provided context.
-    Be concise and relevant in your responses.
-    Present the answer in a clear, coherent, and informative manner."""
-
-    payload = {
-        'model': 'deepseek-chat',
-        'messages': [
-            {'role': 'system', 'content': analysis_system_prompt},
-            {'role': 'user', 'content': f"Context:\n{context}\n\nQuestion: {user_message}"}
-        ]
-    }
-
-    try:
-        resp = requests.post(api_url, headers=headers, json=payload, timeout=30)
-        resp.raise_for_status()
-        reply = resp.json()['choices'][0]['message']['content']
-    except Exception as e:
-        reply = f'Error: {str(e)}'
-
-    return jsonify({'reply': reply})
+    chunks = answer(db.session, user_message)
+    db.session.remove()  # Don't hold the session while the reply streams
+
+    if data.get('stream'):
+        # Send the reply as the model writes it, over a chunked response
+        return Response(stream_with_context(chunks), mimetype='text/plain; charset=utf-8',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    return jsonify({'reply': ''.join(chunks)})
 
 if __name__ == '__main__':
     socketio.run(app, debug=True, allow_unsafe_werkzeug=True)
@@ -0,0 +1,324 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+from flask import Flask
+from model import db, Page, ENGINE_OPTIONS
+from segments import open_store, get_store
+from spider import crawl, parse_for_index, INDEX_BATCH_SIZE
+from indexer import IndexBatch
+from generation import bump_generation
+from docstats import record_page, reset_doc_stats
+from querycache import query_cache
+from search import search
+
+SIZES = (1000, 10000, 100000)
+STAGES = ('crawl', 'index', 'query')
+SEED = 4321
+FANOUT = 8  # Children per page in the site tree
+VOCABULARY_SIZE = 20000
+QUERIES_PER_KIND = 50
+QUERY_REPEATS = 5
+LAST_MODIFIED = 'Mon, 01 Jan 2024 00:00:00 GMT'
+SYLLABLES = ('com', 'put', 'er', 'sci', 'ence', 'hong', 'kong', 'uni', 'ver', 'sity', 'stu', 'dent',
+             'pro', 'gram', 'mov', 'ie', 'book', 'news', 'data', 'base', 'net', 'work', 'lab', 'ter')
+COMMON_WORDS = ('the', 'of', 'and', 'to', 'in', 'is', 'for', 'on', 'with', 'as', 'by', 'at', 'from',
+                'computer', 'science', 'engineering', 'hkust', 'department', 'student', 'research',
+                'course', 'faculty', 'admission', 'news', 'movie', 'book', 'review', 'search', 'engine')
+
+
+class SyntheticSite:
+    """Deterministic site shaped like the COMP4321 test pages.
+
+    Pages form a tree under page 0: each page links to its children, back
+    to its parent, to a couple of random pages and to an off-site URL the
+    crawler must skip. Words follow a Zipfian distribution over generated
+    words mixed with common English ones, and every page is rendered on
+    request so large sites need no disk or memory.
+    """
+
+    def __init__(self, num_pages, seed=SEED):
+        self.num_pages = num_pages
+        self.seed = seed
+        rnd = random.Random(seed)
+        words = dict.fromkeys(COMMON_WORDS)
+        while len(words) < VOCABULARY_SIZE:
+            words[''.join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(1, 4)))] = None
+        self.vocabulary = list(words)
+        cumulative = np.cumsum([1 / (rank + 1) for rank in range(len(self.vocabulary))])
+        self.cum_weights = cumulative.tolist()
+
+    def words(self, rnd, count):
+        return rnd.choices(self.vocabulary, cum_weights=self.cum_weights, k=count)
+
+    def body_words(self, page):
+        rnd = random.Random(self.seed * 1000003 + page)
+        title = self.words(rnd, rnd.randint(2, 6))
+        paragraphs = [self.words(rnd, rnd.randint(20, 120)) for _ in range(rnd.randint(1, 5))]
+        return rnd, title, paragraphs
+
+    def render(self, page):
+        rnd, title, paragraphs = self.body_words(page)
+        links = [FANOUT * page + k for k in range(1, FANOUT + 1) if FANOUT * page + k < self.num_pages]
+        if page:
+            links.append((page - 1) // FANOUT)
+        links += [rnd.randrange(self.num_pages) for _ in range(2)]
+        parts = [f'<html><head><title>{" ".join(title)}</title></head><body>']
+        for words in paragraphs:
+            # Inline markup splits the text into several nodes
+            middle = len(words) // 2
+            parts.append(f'<p>{" ".join(words[:middle])} <b>{words[middle]}</b> {" ".join(words[middle + 1:])}</p>')
+        parts.extend(f'<a href="page{link}.htm">{self.vocabulary[link % 50]}</a>' for link in links)
+        parts.append(f'<a href="http://www.example.com/{page}.htm">elsewhere</a></body></html>')
+        return ''.join(parts)
+
+    def page_for(self, path):
+        name = path.rsplit('/', 1)[-1]
+        if not (name.startswith('page') and name.endswith('.htm')):
+            return None
+        try:
+            page = int(name[4:-4])
+        except ValueError:
+            return None
+        return page if 0 <= page < self.num_pages else None
+
+    def queries(self, count, seed=SEED):
+        """Return {'term': [...], 'phrase': [...], 'ngram': [...]} queries drawn from page text."""
+        rnd = random.Random(seed)
+        queries = {'term': [], 'phrase': [], 'ngram': []}
+        while min(len(q) for q in queries.values()) < count:
+            _, _, paragraphs = self.body_words(rnd.randrange(self.num_pages))
+            words = max(paragraphs, key=len)
+            start = rnd.randrange(len(words) - 3)
+            queries['term'].append(' '.join(words[start:start + rnd.randint(1, 2)]))
+            queries['phrase'].append('"' + ' '.join(words[start:start + 2]) + '"')
+            # Unquoted runs make parse_query add their 2- and 3-grams as phrases
+            queries['ngram'].append(' '.join(words[start:start + 3]))
+        return {kind: q[:count] for kind, q in queries.items()}
+
+
+def serve(site):
+    """Serve site on an ephemeral localhost port from a background thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            page = site.page_for(self.path)
+            if page is None:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if self.headers.get('If-Modified-Since') == LAST_MODIFIED:
+                self.send_response(304)
+                self.end_headers()
+                return
+            body = site.render(page).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Last-Modified', LAST_MODIFIED)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class NullEvents:
+    """Stands in for the SocketIO server crawl() reports progress to."""
+
+    def emit(self, *args, **kwargs):
+        pass
+
+
+def make_app(directory):
+    """Flask app with a fresh SQLite database and segment store under directory."""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'benchmark.db')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = ENGINE_OPTIONS
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+    open_store(os.path.join(directory, 'index'))
+    reset_doc_stats()
+    bump_generation()
+    query_cache.clear()
+    return app
+
+
+def bench_crawl(server):
+    start_url = f'http://127.0.0.1:{server.server_port}/page0.htm'
+    start = time.perf_counter()
+    crawl(start_url, NullEvents())
+    seconds = time.perf_counter() - start
+    pages = db.session.query(Page).count()
+    db.session.remove()
+    return {'pages': pages, 'seconds': round(seconds, 3), 'pages_per_sec': round(pages / seconds, 1)}
+
+
+def bench_index(site):
+    """Time IndexBatch writes of pre-parsed pages, batched as the crawler does."""
+    session = db.session
+    batch = IndexBatch()
+    postings = positions = 0
+    seconds = 0.0
+    for first in range(0, site.num_pages, INDEX_BATCH_SIZE):
+        parsed = []
+        for page in range(first, min(first + INDEX_BATCH_SIZE, site.num_pages)):
+            url = f'http://bench.local/page{page}.htm'
+            parsed.append((url, parse_for_index(url, site.render(page), 'bench.local')))
+
+        start = time.perf_counter()
+        pending = []
+        for url, (title, title_positions, body_positions, _, keywords, stats, *_) in parsed:
+            page = Page(url=url, title=title, size=stats[2], keywords=keywords,
+                        max_tf_title=stats[0], max_tf_body=stats[1])
+            session.add(page)
+            session.flush()
+            batch.add(page.id, title_positions, body_positions)
+            pending.append((page.id, stats))
+        norms = batch.flush(session)
+        session.commit()
+        batch.publish()
+        seconds += time.perf_counter() - start
+
+        for page_id, stats in pending:
+            record_page(page_id, *stats, *norms[page_id])
+        for _, (_, title_positions, body_positions, *_) in parsed:
+            for stem_map in (title_positions, body_positions):
+                postings += len(stem_map)
+                positions += sum(len(p) for p in stem_map.values())
+    # Background segment merges are part of the indexing cost
+    start = time.perf_counter()
+    get_store().wait_for_merges()
+    seconds += time.perf_counter() - start
+    session.remove()
+    return {'pages': site.num_pages, 'postings': postings, 'positions': positions, 'seconds': round(seconds, 3),
+            'postings_per_sec': round(postings / seconds, 1)}
+
+
+def bench_queries(site, mode, count=QUERIES_PER_KIND, repeats=QUERY_REPEATS):
+    """p50/p99 latency of uncached search() calls per query kind."""
+    bump_generation()
+    results = {}
+    for kind, queries in site.queries(count).items():
+        for query in queries:
+            search(query, mode=mode, use_cache=False)  # Warm the engine and the query's posting lists
+        latencies = []
+        for _ in range(repeats):
+            for query in queries:
+                start = time.perf_counter()
+                search(query, mode=mode, use_cache=False)
+                latencies.append((time.perf_counter() - start) * 1000)
+        p50, p99 = np.percentile(latencies, [50, 99])
+        results[kind] = {'queries': len(latencies), 'p50_ms': round(float(p50), 3), 'p99_ms': round(float(p99), 3),
+                         'mean_ms': round(float(np.mean(latencies)), 3)}
+    db.session.remove()
+    return results
+
+
+def run_size(num_pages, stages, mode):
+    site = SyntheticSite(num_pages)
+    result = {'docs': num_pages}
+    if 'crawl' in stages or 'query' in stages:
+        with tempfile.TemporaryDirectory() as directory:
+            app = make_app(directory)
+            server = serve(site)
+            try:
+                with app.app_context():
+                    result['crawl'] = bench_crawl(server)
+                    if 'query' in stages:
+                        result['query'] = bench_queries(site, mode)
+            finally:
+                server.shutdown()
+        if 'crawl' not in stages:
+            del result['crawl']
+    if 'index' in stages:
+        with tempfile.TemporaryDirectory() as directory:
+            app = make_app(directory)
+            with app.app_context():
+                result['index'] = bench_index(site)
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """Print each metric next to the baseline run's value for the same size."""
+    previous = {run['docs']: run for run in baseline['results']}
+    metrics = [('crawl', 'pages_per_sec'), ('index', 'postings_per_sec')]
+    metrics += [('query', kind, stat) for kind in ('term', 'phrase', 'ngram') for stat in ('p50_ms', 'p99_ms')]
+    for run in results:
+        old = previous.get(run['docs'])
+        if not old:
+            continue
+        for path in metrics:
+            new_value, old_value = run, old
+            for key in path:
+                new_value = new_value.get(key, {}) if isinstance(new_value, dict) else {}
+                old_value = old_value.get(key, {}) if isinstance(old_value, dict) else {}
+            if isinstance(new_value, (int, float)) and isinstance(old_value, (int, float)) and old_value:
+                print(f"{run['docs']:>7} {'.'.join(path):<22} {old_value:>12} -> {new_value:<12} "
+                      f"({new_value / old_value:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark crawling, indexing and search on a synthetic site.')
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)), help='comma separated document counts')
+    parser.add_argument('--stages', default=','.join(STAGES), help='comma separated subset of ' + ', '.join(STAGES))
+    parser.add_argument('--mode', default='vectorized', help='search() scoring mode')
+    parser.add_argument('--output', default='benchmark.json', help='JSON results file')
+    parser.add_argument('--baseline', help='earlier results file to compare against')
+    args = parser.parse_args()
+    stages = set(args.stages.split(','))
+
+    results = []
+    for num_pages in (int(size) for size in args.sizes.split(',')):
+        result = run_size(num_pages, stages, args.mode)
+        print(json.dumps(result))
+        results.append(result)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'revision': git_revision(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'mode': args.mode,
+            'seed': SEED,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from model import PageText
+from pagetext import html_text, compress_text, decompress_text
+from search import search
+from writer import get_writer
+
+CHAT_API_URL = os.environ.get('CHAT_API_URL', 'https://api.deepseek.com/v1/chat/completions')
+CHAT_MODEL = os.environ.get('CHAT_MODEL', 'deepseek-chat')
+DEEPSEEK_API_KEY = os.environ.get('DEEPSEEK_API_KEY', 'sk-9a1925a117ba4039b90328dd065a06bc')
+CONTEXT_DOCUMENTS = 3  # Top search results whose text is given to the model
+KEYWORD_TIMEOUT = 10  # Seconds for the keyword extraction call
+REPLY_TIMEOUT = 30  # Seconds to connect and between streamed chunks of the reply
+PAGE_FETCH_TIMEOUT = 5  # Seconds to fetch a page whose text wasn't stored at crawl time
+
+KEYWORD_SYSTEM_PROMPT = """You are a keyword extraction assistant.
+    Extract 3-5 most important search keywords from the user's question.
+    Return ONLY the keywords separated by spaces, no other text or explanation."""
+
+ANALYSIS_SYSTEM_PROMPT = """You are a helpful assistant that provides information based on the database context provided.
+    Only use the information in the given context to answer the user's question.
+    If the context doesn't contain relevant information to answer the question, state that you don't have that information.
+    Do not make up information or use knowledge outside of the provided context.
+    Be concise and relevant in your responses.
+    Present the answer in a clear, coherent, and informative manner."""
+
+# requests.Session isn't thread-safe: each thread keeps its own, so a chat
+# request's two model calls still share a keep-alive connection
+_local = threading.local()
+
+
+def _http():
+    http = getattr(_local, 'http', None)
+    if http is None:
+        http = _local.http = requests.Session()
+    return http
+
+
+def _api_headers():
+    return {
+        'Authorization': f'Bearer {DEEPSEEK_API_KEY}',
+        'Content-Type': 'application/json'
+    }
+
+
+def extract_keywords(message):
+    """Ask the model for search keywords, falling back to the whole message."""
+    payload = {
+        'model': CHAT_MODEL,
+        'messages': [
+            {'role': 'system', 'content': KEYWORD_SYSTEM_PROMPT},
+            {'role': 'user', 'content': message}
+        ]
+    }
+    try:
+        resp = _http().post(CHAT_API_URL, headers=_api_headers(), json=payload, timeout=KEYWORD_TIMEOUT)
+        resp.raise_for_status()
+        keywords = resp.json()['choices'][0]['message']['content'].strip()
+        print(f"Extracted keywords: {keywords}")
+        return keywords
+    except Exception as e:
+        print(f"Error extracting keywords: {e}")
+        return message
+
+
+def _fetch_text(url):
+    if not url.startswith(('http://', 'https://')):
+        raise ValueError("URL not accessible (invalid URL format)")
+    response = _http().get(url, timeout=PAGE_FETCH_TIMEOUT)
+    if response.status_code != 200:
+        raise ValueError(f"Content could not be retrieved (HTTP {response.status_code})")
+    return html_text(response.text)
+
+
+def load_page_texts(session, pages):
+    """Return {page_id: text or the exception raised getting it} for pages.
+
+    Text stored at crawl time is used as is. Pages crawled before text was
+    stored are fetched concurrently, and their text is saved for next time.
+    """
+    ids = [page.id for page in pages]
+    texts = {page_id: decompress_text(data) for page_id, data in
+             session.query(PageText.page_id, PageText.text).filter(PageText.page_id.in_(ids))}
+    missing = [page for page in pages if page.id not in texts]
+    if not missing:
+        return texts
+
+    with ThreadPoolExecutor(len(missing)) as pool:
+        futures = [(page.id, pool.submit(_fetch_text, page.url)) for page in missing]
+        fetched = {}
+        for page_id, future in futures:
+            try:
+                fetched[page_id] = future.result()
+            except Exception as e:
+                texts[page_id] = e
+    if fetched:
+        # Saved in the background by the writer thread; the reply doesn't wait for it
+        rows = {page_id: compress_text(text) for page_id, text in fetched.items()}
+        get_writer().submit(lambda write_session: _save_page_texts(write_session, rows)).add_done_callback(
+            _report_save_error)
+    texts.update(fetched)
+    return texts
+
+
+def _save_page_texts(session, rows):
+    for page_id, data in rows.items():
+        session.merge(PageText(page_id=page_id, text=data))
+
+
+def _report_save_error(future):
+    if future.exception() is not None:
+        print(f"Database error saving page text: {future.exception()}")
+
+
+def _keyword_summary(page):
+    if isinstance(page.keywords[0], list):
+        keywords_list = [f"{k[0]} ({k[1]})" for k in sorted(page.keywords, key=lambda x: -x[1])[:15]]
+    else:
+        keywords_list = [f"{k.get('stem', '')} ({k.get('frequency', 0)})" for k in
+                         sorted(page.keywords, key=lambda x: -x.get('frequency', 0))[:15]]
+    return f"Keywords: {', '.join(keywords_list)}\n"
+
+
+def build_context(session, results):
+    """Describe the top search results, with their text, for the answering model."""
+    if not results:
+        return "No relevant information found in our database."
+
+    pages = [page for page, _ in results[:CONTEXT_DOCUMENTS]]
+    texts = load_page_texts(session, pages)
+    context = "The following information is from our database:\n\n"
+    for i, page in enumerate(pages, 1):
+        context += f"Document {i}: {page.title}\n"
+        context += f"URL: {page.url}\n"
+        text = texts[page.id]
+        if isinstance(text, Exception):
+            # Fall back to keywords if we can't get the content
+            if page.keywords:
+                context += _keyword_summary(page)
+            context += f"Note: Full page content unavailable. Error: {str(text)[:100]}\n"
+        else:
+            context += f"Page Content:\n{text}\n"
+
+        # Add separator between documents
+        context += "\n" + "-" * 40 + "\n\n"
+    return context
+
+
+def stream_reply(message, context):
+    """Yield the model's answer to message as it is generated."""
+    payload = {
+        'model': CHAT_MODEL,
+        'messages': [
+            {'role': 'system', 'content': ANALYSIS_SYSTEM_PROMPT},
+            {'role': 'user', 'content': f"Context:\n{context}\n\nQuestion: {message}"}
+        ],
+        'stream': True
+    }
+    streamed = False
+    try:
+        with _http().post(CHAT_API_URL, headers=_api_headers(), json=payload, stream=True,
+                        timeout=REPLY_TIMEOUT) as resp:
+            resp.raise_for_status()
+            # Server-sent events: one "data: {json}" line per chunk, then "data: [DONE]"
+            for line in resp.iter_lines():
+                if not line.startswith(b'data:'):
+                    continue
+                data = line[5:].strip()
+                if data == b'[DONE]':
+                    break
+                delta = json.loads(data)['choices'][0].get('delta', {}).get('content')
+                if delta:
+                    streamed = True
+                    yield delta
+    except Exception as e:
+        yield ('\n\n' if streamed else '') + f'Error: {str(e)}'
+
+
+def answer(session, message):
+    """Search for the message's keywords and return a generator of the reply's chunks.
+
+    The search and context assembly happen before this returns, so the
+    caller can release its database session before streaming.
+    """
+    keywords = extract_keywords(message)
+    results = search(keywords)
+    print(f"Search results for '{keywords}': {len(results)} results found")
+    context = build_context(session, results)
+    return stream_reply(message, context)
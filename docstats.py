@@ -0,0 +1,100 @@
+import threading
+import numpy as np
+from model import Page
+
+COLUMNS = (
+    ('max_tf_title', np.int32),
+    ('max_tf_body', np.int32),
+    ('size', np.int32),
+    ('norm_title', np.float64),  # Length of the page's title tf-idf vector
+    ('norm_body', np.float64),  # Length of the page's body tf-idf vector
+)
+
+
+class DocStats:
+    """Columnar per-document statistics indexed directly by page id."""
+
+    def __init__(self, capacity=1024):
+        for name, dtype in COLUMNS:
+            setattr(self, name, np.zeros(capacity, dtype=dtype))
+
+    @property
+    def capacity(self):
+        return len(self.max_tf_title)
+
+    def _ensure_capacity(self, page_id):
+        if page_id < self.capacity:
+            return
+        capacity = max(page_id + 1, self.capacity * 2)
+        for name, dtype in COLUMNS:
+            column = getattr(self, name)
+            grown = np.zeros(capacity, dtype=dtype)
+            grown[:len(column)] = column
+            setattr(self, name, grown)
+
+    def update(self, page_id, max_tf_title, max_tf_body, size, norm_title=None, norm_body=None):
+        self._ensure_capacity(page_id)
+        self.max_tf_title[page_id] = max_tf_title or 0
+        self.max_tf_body[page_id] = max_tf_body or 0
+        self.size[page_id] = size or 0
+        if norm_title is not None:
+            self.norm_title[page_id] = norm_title
+        if norm_body is not None:
+            self.norm_body[page_id] = norm_body
+
+    def max_tf(self, index_type, page_id):
+        column = self.max_tf_title if index_type == 'title' else self.max_tf_body
+        return int(column[page_id]) if page_id < len(column) else 0
+
+    def norm(self, index_type, page_id):
+        column = self.norm_title if index_type == 'title' else self.norm_body
+        return float(column[page_id]) if page_id < len(column) else 0.0
+
+    def copy(self):
+        snapshot = DocStats(0)
+        for name, _ in COLUMNS:
+            setattr(snapshot, name, getattr(self, name).copy())
+        return snapshot
+
+    @classmethod
+    def load(cls, session):
+        rows = session.query(Page.id, Page.max_tf_title, Page.max_tf_body, Page.size,
+                             Page.norm_title, Page.norm_body).all()
+        stats = cls(max((row[0] for row in rows), default=0) + 1)
+        for row in rows:
+            stats.update(*row)
+        return stats
+
+
+_doc_stats = None
+_doc_stats_lock = threading.Lock()
+
+
+def get_doc_stats(session):
+    """Return the shared DocStats table, loading it on first use."""
+    global _doc_stats
+    if _doc_stats is None:
+        with _doc_stats_lock:
+            if _doc_stats is None:
+                _doc_stats = DocStats.load(session)
+    return _doc_stats
+
+
+def snapshot_doc_stats(session):
+    """Return a private copy of the shared table that later updates won't touch."""
+    stats = get_doc_stats(session)
+    with _doc_stats_lock:
+        return stats.copy()
+
+
+def record_page(page_id, max_tf_title, max_tf_body, size, norm_title=None, norm_body=None):
+    """Apply a committed page's stats to the loaded table, if any."""
+    with _doc_stats_lock:
+        if _doc_stats is not None:
+            _doc_stats.update(page_id, max_tf_title, max_tf_body, size, norm_title, norm_body)
+
+
+def reset_doc_stats():
+    global _doc_stats
+    with _doc_stats_lock:
+        _doc_stats = None
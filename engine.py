@@ -0,0 +1,98 @@
+import threading
+from model import Page
+from generation import index_generation
+from docstats import snapshot_doc_stats
+from segments import get_store, read_postings, live_df, term_key
+from linkgraph import get_link_graph
+from metrics import Collected
+
+
+class FieldIndex:
+    """Read-only {stem: PostingList} view of one field over a set of segments.
+
+    Lists and document counts are looked up in the segments' term
+    dictionaries on first use and kept. A list's max_impact is the impact
+    bound stored with the segments.
+    """
+
+    def __init__(self, field, segments):
+        self.field = field
+        self.segments = segments
+        self._lists = {}
+        self._dfs = {}
+
+    def get(self, stem, default=None):
+        if stem is None:
+            return default
+        if stem not in self._lists:
+            self._lists[stem] = read_postings(self.segments, term_key(self.field, stem))
+        plist = self._lists[stem]
+        return default if plist is None else plist
+
+    def df(self, stem):
+        """Live document count of stem, read without decoding its postings."""
+        if stem is None:
+            return 0
+        if stem in self._lists:
+            return len(self._lists[stem] or ())
+        if stem not in self._dfs:
+            self._dfs[stem] = live_df(self.segments, term_key(self.field, stem))
+        return self._dfs[stem]
+
+
+class IndexEngine:
+    """Read-only snapshot of the title and body inverted indices over the published segments.
+
+    doc_stats is a private copy of the per-document stats taken at load
+    time, so scores use the norms the segments' impact bounds were
+    computed against.
+    static_scores holds each page's 0 to 1 link authority by page id, or
+    is None before the link graph has been ranked.
+    """
+
+    def __init__(self, title, body, num_docs, doc_stats, generation=0, static_scores=None):
+        self.title = title
+        self.body = body
+        self.num_docs = num_docs
+        self.doc_stats = doc_stats
+        self.generation = generation
+        self.static_scores = static_scores
+
+    @classmethod
+    def load(cls, session, generation=0):
+        doc_stats = snapshot_doc_stats(session)
+        segments = get_store().snapshot()
+        title = FieldIndex(0, segments)
+        body = FieldIndex(1, segments)
+        num_docs = session.query(Page).count()
+        graph = get_link_graph()
+        return cls(title, body, num_docs, doc_stats, generation, graph.static_scores() if graph else None)
+
+    def df(self, stem):
+        """Return (df_title, df_body) for stem, or None if it is not indexed."""
+        df_title = self.title.df(stem)
+        df_body = self.body.df(stem)
+        if not df_title and not df_body:
+            return None
+        return df_title, df_body
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine(session):
+    """Return the shared IndexEngine, reloading it if the index has changed."""
+    global _engine
+    generation = index_generation()
+    engine = _engine
+    if engine is None or engine.generation != generation:
+        with _engine_lock:
+            if _engine is None or _engine.generation != generation:
+                _engine = IndexEngine.load(session, generation)
+            engine = _engine
+    return engine
+
+
+Collected('index_generation', 'Generation of the committed index data', index_generation)
+Collected('index_segments', 'Published index segments', lambda: len(get_store().snapshot()))
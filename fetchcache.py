@@ -0,0 +1,40 @@
+import os
+import json
+import zlib
+import hashlib
+
+
+class FetchCache:
+    """On-disk cache of raw page bodies and their validators, zlib compressed."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, url):
+        digest = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest + '.z')
+
+    def get(self, url):
+        """Return {'url', 'etag', 'last_modified', 'text'} for url, or None."""
+        try:
+            with open(self._path(url), 'rb') as f:
+                entry = json.loads(zlib.decompress(f.read()))
+        except (OSError, ValueError, zlib.error):
+            return None
+        return entry if entry.get('url') == url else None
+
+    def put(self, url, etag, last_modified, text):
+        path = self._path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = zlib.compress(json.dumps({
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'text': text,
+        }).encode('utf-8'))
+        # Write then rename so readers never see a partial entry
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
@@ -0,0 +1,128 @@
+import hashlib
+from functools import lru_cache
+from itertools import chain
+from collections import defaultdict
+import numpy as np
+from model import Page
+
+SIMHASH_BITS = 64
+SIMHASH_DISTANCE = 3  # Bodies whose fingerprints differ in at most this many bits are near-duplicates
+SHINGLE_SIZE = 3  # Consecutive indexed stems per fingerprint feature
+SHINGLE_MULTIPLIER = 0x9e3779b97f4a7c15  # Odd 64-bit constant combining a shingle's stem hashes
+SIMHASH_MIN_SHINGLES = 10  # Bodies with fewer distinct shingles are too small to fingerprint reliably
+_MASK = (1 << SIMHASH_BITS) - 1
+
+
+@lru_cache(maxsize=100000)
+def _stem_hash(stem):
+    # Stable across parser processes, unlike the randomized built-in hash()
+    return int.from_bytes(hashlib.blake2b(stem.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def _mix(values):
+    """splitmix64 finalizer, spreading combined stem hashes over all 64 bits."""
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xbf58476d1ce4e5b9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94d049bb133111eb)
+    return values ^ (values >> np.uint64(31))
+
+
+def shingle_hashes(positions):
+    """Hashes and counts of the distinct SHINGLE_SIZE-stem runs of a {stem: positions} body.
+
+    Stop words have no positions in the map, so runs skip over them.
+    """
+    lengths = [len(stem_positions) for stem_positions in positions.values()]
+    order = np.fromiter(chain.from_iterable(positions.values()), dtype=np.int64, count=sum(lengths)).argsort()
+    tokens = np.repeat(np.array([_stem_hash(stem) for stem in positions], dtype=np.uint64), lengths)[order]
+    runs = len(tokens) - SHINGLE_SIZE + 1
+    if runs <= 0:
+        return tokens[:0], np.zeros(0, dtype=np.int64)
+    # Order-sensitive combination of each run's stem hashes, wrapping at 64 bits
+    combined = tokens[:runs].copy()
+    for offset in range(1, SHINGLE_SIZE):
+        combined = combined * np.uint64(SHINGLE_MULTIPLIER) + tokens[offset:runs + offset]
+    return np.unique(_mix(combined), return_counts=True)
+
+
+def simhash(positions):
+    """64-bit SimHash of a {stem: positions} body's shingles, or None if it has too few.
+
+    Each bit is the sign of the count-weighted vote of the shingles' hashes
+    on that bit, so bodies sharing most of their text differ in only a few
+    bits while bodies that merely share vocabulary do not.
+    """
+    hashes, counts = shingle_hashes(positions)
+    if len(hashes) < SIMHASH_MIN_SHINGLES:
+        return None
+    # Row i holds hash i's bits, least significant first
+    bits = np.unpackbits(hashes.astype('<u8').view(np.uint8).reshape(-1, 8), axis=1, bitorder='little')
+    votes = counts @ (2 * bits.astype(np.int64) - 1)
+    return sum(1 << int(bit) for bit in np.flatnonzero(votes > 0))
+
+
+def to_signed(fingerprint):
+    """Fingerprint as the signed 64-bit value SQLite stores."""
+    return fingerprint - (1 << SIMHASH_BITS) if fingerprint >> (SIMHASH_BITS - 1) else fingerprint
+
+
+class FingerprintIndex:
+    """SimHash lookup for fingerprints within SIMHASH_DISTANCE bits of a query.
+
+    Fingerprints are split into SIMHASH_DISTANCE + 1 blocks, each with a
+    table keyed by the block's value: two fingerprints that differ in at
+    most that many bits agree exactly on at least one block, so only pages
+    sharing a block are compared.
+    """
+
+    def __init__(self, distance=SIMHASH_DISTANCE):
+        self.distance = distance
+        blocks = distance + 1
+        width, extra = divmod(SIMHASH_BITS, blocks)
+        self._blocks = []  # (shift, mask) of each block
+        shift = 0
+        for i in range(blocks):
+            bits = width + (1 if i < extra else 0)
+            self._blocks.append((shift, (1 << bits) - 1))
+            shift += bits
+        self._tables = [defaultdict(set) for _ in self._blocks]
+        self._fingerprints = {}
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+    def add(self, page_id, fingerprint):
+        self.remove(page_id)
+        self._fingerprints[page_id] = fingerprint
+        for table, (shift, mask) in zip(self._tables, self._blocks):
+            table[(fingerprint >> shift) & mask].add(page_id)
+
+    def remove(self, page_id):
+        fingerprint = self._fingerprints.pop(page_id, None)
+        if fingerprint is None:
+            return
+        for table, (shift, mask) in zip(self._tables, self._blocks):
+            key = (fingerprint >> shift) & mask
+            table[key].discard(page_id)
+            if not table[key]:
+                del table[key]
+
+    def find(self, fingerprint, exclude=None):
+        """Return the id of the closest page within the distance, lowest id on ties, or None."""
+        best = None
+        for table, (shift, mask) in zip(self._tables, self._blocks):
+            for page_id in table.get((fingerprint >> shift) & mask, ()):
+                if page_id == exclude:
+                    continue
+                distance = (fingerprint ^ self._fingerprints[page_id]).bit_count()
+                if distance <= self.distance and (best is None or (distance, page_id) < best):
+                    best = (distance, page_id)
+        return best[1] if best else None
+
+    @classmethod
+    def load(cls, session):
+        index = cls()
+        for page_id, fingerprint in session.query(Page.id, Page.simhash).filter(Page.simhash.isnot(None)):
+            index.add(page_id, fingerprint & _MASK)
+        return index
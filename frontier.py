@@ -0,0 +1,231 @@
+import re
+import math
+import time
+import struct
+import sqlite3
+import hashlib
+import threading
+from urllib.parse import urlsplit, urlunsplit
+from metrics import Counter
+
+BLOOM_CAPACITY = 1000000  # URLs the seen-set filter is sized for; more only raises its false positive rate
+BLOOM_ERROR_RATE = 0.01  # False positive rate at capacity, each costing one exact lookup on disk
+CHECKPOINT_SECONDS = 5.0  # Longest time frontier changes stay uncommitted
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+QUEUED, IN_FLIGHT, DONE = 0, 1, 2
+
+FRONTIER_URLS = Counter('crawler_frontier_urls_total', 'URLs offered to the crawl frontier, by outcome', ('outcome',))
+
+_ESCAPE_PATTERN = re.compile(r'%[0-9a-fA-F]{2}')
+_SLASHES_PATTERN = re.compile(r'/{2,}')
+
+
+def canonicalize_url(url):
+    """Normalize a URL so equivalent spellings dedupe to one frontier entry.
+
+    Lowercases the scheme and host, drops default ports, userinfo and the
+    fragment, collapses repeated slashes, uppercases percent escapes and
+    sorts the query parameters. Trailing slashes are kept: "/a" and "/a/"
+    resolve relative links differently, and a redirect between them is
+    caught when the page is fetched.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = parts.hostname or ''
+    if ':' in host:
+        host = f'[{host}]'
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    netloc = host if port is None or DEFAULT_PORTS.get(scheme) == port else f'{host}:{port}'
+    path = _ESCAPE_PATTERN.sub(lambda m: m.group().upper(), _SLASHES_PATTERN.sub('/', parts.path)) or '/'
+    query = '&'.join(sorted(param for param in parts.query.split('&') if param))
+    return urlunsplit((scheme, netloc, path, query, ''))
+
+
+class BloomFilter:
+    """Fixed-size probabilistic set: no false negatives, about error_rate false positives at capacity."""
+
+    def __init__(self, capacity=BLOOM_CAPACITY, error_rate=BLOOM_ERROR_RATE):
+        self.num_bits = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, key):
+        # Double hashing: k positions from two 64-bit halves of one digest
+        h1, h2 = struct.unpack('<QQ', hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest())
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class Frontier:
+    """Persistent, deduplicating crawl frontier ordered by link depth.
+
+    Every URL ever queued stays in an SQLite table with its depth, parent
+    page and state (queued, in flight or done), which doubles as the exact
+    seen-set behind an in-memory Bloom filter. get() hands out the
+    shallowest queued URL, oldest first; task_done() retires it. Changes are
+    committed by checkpoint(), at least every CHECKPOINT_SECONDS, so a
+    crawl that dies can pick up from its last checkpoint with start().
+    """
+
+    def __init__(self, path=':memory:', capacity=BLOOM_CAPACITY):
+        self.path = path
+        self.capacity = capacity
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        if path != ':memory:':
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS frontier ('
+                           'url TEXT PRIMARY KEY, depth INTEGER NOT NULL, parent_id INTEGER, state INTEGER NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS frontier_order ON frontier (state, depth)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS frontier_meta (key TEXT PRIMARY KEY, value TEXT)')
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._all_done = threading.Condition(self._lock)
+        self._seen = BloomFilter(capacity)
+        self._queued = 0
+        self._in_flight = 0
+        self._closed = False
+        self._last_checkpoint = time.monotonic()
+
+    def start(self, seed):
+        """Resume an unfinished crawl from seed, or reset the frontier to just seed.
+
+        Returns the number of URLs left from the interrupted crawl, 0 for a
+        fresh start. URLs that were in flight when it stopped are queued again.
+        """
+        seed = canonicalize_url(seed)
+        with self._lock:
+            self._in_flight = 0
+            row = self._conn.execute("SELECT value FROM frontier_meta WHERE key = 'seed'").fetchone()
+            if row and row[0] == seed:
+                self._conn.execute('UPDATE frontier SET state = ? WHERE state = ?', (QUEUED, IN_FLIGHT))
+                self._queued = self._conn.execute('SELECT COUNT(*) FROM frontier WHERE state = ?',
+                                                  (QUEUED,)).fetchone()[0]
+                if self._queued:
+                    self._seen = BloomFilter(self.capacity)
+                    for url, in self._conn.execute('SELECT url FROM frontier'):
+                        self._seen.add(url)
+                    self._conn.commit()
+                    return self._queued
+            self._reset()
+            self._conn.execute("INSERT INTO frontier_meta (key, value) VALUES ('seed', ?)", (seed,))
+            self._conn.commit()
+        self.add(seed, 0, None)
+        return 0
+
+    def _reset(self):
+        self._conn.execute('DELETE FROM frontier')
+        self._conn.execute('DELETE FROM frontier_meta')
+        self._seen = BloomFilter(self.capacity)
+        self._queued = 0
+
+    def clear(self):
+        """Forget every URL, finished or not."""
+        with self._lock:
+            self._reset()
+            self._conn.commit()
+
+    def add(self, url, depth, parent_id):
+        """Queue url unless it was seen before in this crawl. Returns whether it was queued."""
+        url = canonicalize_url(url)
+        with self._lock:
+            # Only a Bloom filter hit needs the exact check on disk
+            if url in self._seen and self._conn.execute('SELECT 1 FROM frontier WHERE url = ?', (url,)).fetchone():
+                FRONTIER_URLS.inc('duplicate')
+                return False
+            self._conn.execute('INSERT INTO frontier (url, depth, parent_id, state) VALUES (?, ?, ?, ?)',
+                               (url, depth, parent_id, QUEUED))
+            self._seen.add(url)
+            self._queued += 1
+            FRONTIER_URLS.inc('queued')
+            self._not_empty.notify()
+            return True
+
+    def mark_seen(self, url, depth, parent_id):
+        """Record url as done without queueing it, e.g. the target of a redirect being followed.
+
+        Returns False if url was already seen.
+        """
+        url = canonicalize_url(url)
+        with self._lock:
+            if url in self._seen and self._conn.execute('SELECT 1 FROM frontier WHERE url = ?', (url,)).fetchone():
+                return False
+            self._conn.execute('INSERT INTO frontier (url, depth, parent_id, state) VALUES (?, ?, ?, ?)',
+                               (url, depth, parent_id, DONE))
+            self._seen.add(url)
+            return True
+
+    def get(self):
+        """Block until a URL is queued and return (url, depth, parent_id), or None once closed."""
+        with self._lock:
+            while True:
+                if self._closed:
+                    return None
+                if self._queued:
+                    url, depth, parent_id = self._conn.execute(
+                        'SELECT url, depth, parent_id FROM frontier WHERE state = ? ORDER BY depth, rowid LIMIT 1',
+                        (QUEUED,)).fetchone()
+                    self._conn.execute('UPDATE frontier SET state = ? WHERE url = ?', (IN_FLIGHT, url))
+                    self._queued -= 1
+                    self._in_flight += 1
+                    self._maybe_checkpoint()
+                    return url, depth, parent_id
+                self._not_empty.wait()
+
+    def task_done(self, url):
+        """Retire a URL returned by get(), once its outcome and links are recorded."""
+        with self._lock:
+            self._conn.execute('UPDATE frontier SET state = ? WHERE url = ?', (DONE, url))
+            self._in_flight -= 1
+            self._maybe_checkpoint()
+            if not self._queued and not self._in_flight:
+                self._all_done.notify_all()
+
+    def join(self):
+        """Block until every queued URL has been handed out and retired."""
+        with self._lock:
+            while self._queued or self._in_flight:
+                self._all_done.wait()
+
+    def _maybe_checkpoint(self):
+        if time.monotonic() - self._last_checkpoint >= CHECKPOINT_SECONDS:
+            self._conn.commit()
+            self._last_checkpoint = time.monotonic()
+
+    def checkpoint(self):
+        """Commit the frontier so a restarted crawl resumes from here."""
+        with self._lock:
+            if self._closed:
+                return
+            self._conn.commit()
+            self._last_checkpoint = time.monotonic()
+
+    def close(self):
+        """Checkpoint, wake blocked get() calls with None and close the database."""
+        with self._lock:
+            if self._closed:
+                return
+            self._conn.commit()
+            self._conn.close()
+            self._closed = True
+            self._not_empty.notify_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._queued
@@ -0,0 +1,16 @@
+import threading
+
+# Bumped whenever committed index data changes so readers can drop stale snapshots
+_generation = 0
+_generation_lock = threading.Lock()
+
+
+def bump_generation():
+    global _generation
+    with _generation_lock:
+        _generation += 1
+        return _generation
+
+
+def index_generation():
+    return _generation
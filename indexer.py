@@ -1,65 +1,249 @@
 import re
 import math
-from nltk.stem import PorterStemmer
-from model import db, BodyInvertedIndex, TitleInvertedIndex, DocumentStats, Page
+from model import DocumentStats, Page, SegmentCommit
 from collections import defaultdict
 from nltk.util import ngrams
-import shlex
-
-
-STOP_WORDS = set()
-with open('stopwords.txt', 'r') as f:
-    STOP_WORDS = {line.strip().lower() for line in f if line.strip()}
-stemmer = PorterStemmer()
+import numpy as np
+from sqlalchemy import bindparam, func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from tokenizer import STOP_WORDS, stem_term
+from generation import bump_generation
+from segments import get_store
 
 
 def process_terms(terms):
-    stems = []
+    """Map each stem to its token positions, consuming terms as a stream.
+
+    Stop words keep their positions but are not indexed. Returns
+    (positions, number of terms).
+    """
     positions = {}
+    count = 0
     for pos, term in enumerate(terms):
-        if term.lower() in STOP_WORDS:
+        count += 1
+        stem = stem_term(term)
+        if stem is None:
             continue
-        stem = stemmer.stem(term)
-        stems.append(stem)
         if stem not in positions:
             positions[stem] = []
         positions[stem].append(pos)
-    return stems, positions
-
-
-def update_stats(stem_map, index_type, session):
-    for stem in stem_map.keys():
-        stats = session.query(DocumentStats).filter_by(stem=stem).first()
-        if not stats:
-            stats = DocumentStats(stem=stem, df_title=0, df_body=0)
-            session.add(stats)
-
-        if index_type == 'title':
-            stats.df_title += 1
-        else:
-            stats.df_body += 1
-
-
-def update_inverted_index(stem_map, page_id, index_class, session):
-    max_freq = 0
-    for stem, positions in stem_map.items():
-        index_entry = session.query(index_class).filter_by(stem=stem, page_id=page_id).first()
-        freq = len(positions)
-        max_freq = max(max_freq, freq)
-
-        if not index_entry:
-            index_entry = index_class(stem=stem, page_id=page_id, positions=positions, frequency=freq)
-            session.add(index_entry)
-        else:
-            index_entry.positions.extend(positions)
-            index_entry.frequency += freq
-
-    page = session.query(Page).get(page_id)
-    if index_class == TitleInvertedIndex:
-        page.max_tf_title = max(page.max_tf_title, max_freq)
-    else:
-        page.max_tf_body = max(page.max_tf_body, max_freq)
-    session.add(page)
+    return positions, count
+
+
+def _upsert_df(increments, session):
+    """Add {stem: [df_title, df_body]} increments to DocumentStats with one executemany."""
+    if not increments:
+        return
+    table = DocumentStats.__table__
+    stmt = sqlite_insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['stem'],
+        set_={'df_title': table.c.df_title + stmt.excluded.df_title,
+              'df_body': table.c.df_body + stmt.excluded.df_body}
+    )
+    session.execute(stmt, [{'stem': stem, 'df_title': df[0], 'df_body': df[1]}
+                           for stem, df in increments.items()])
+
+
+def _prune_df(stems, session):
+    """Drop DocumentStats rows whose df fell to zero in both fields."""
+    if not stems:
+        return
+    table = DocumentStats.__table__
+    stmt = table.delete().where(table.c.stem == bindparam('b_stem'), table.c.df_title <= 0, table.c.df_body <= 0)
+    session.execute(stmt, [{'b_stem': stem} for stem in stems])
+
+
+def load_page_terms(page_id):
+    """Return the indexed title and body stem -> frequency maps of a page, or None."""
+    return get_store().page_terms(page_id)
+
+
+def diff_terms(old_terms, new_map):
+    """Return (added, removed): the stems whose df a page's new stem map changes."""
+    added = [stem for stem in new_map if stem not in old_terms]
+    removed = [stem for stem in old_terms if stem not in new_map]
+    return added, removed
+
+
+class IndexBatch:
+    """Accumulates pages and df increments for one segment and one bulk df write."""
+
+    def __init__(self):
+        self.segment = None
+        self.clear()
+
+    def clear(self):
+        self.df_increments = defaultdict(lambda: [0, 0])
+        self.docs = []  # (page_id, title_positions, body_positions)
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, page_id, title_positions, body_positions):
+        for stem in title_positions:
+            self.df_increments[stem][0] += 1
+        for stem in body_positions:
+            self.df_increments[stem][1] += 1
+        self.docs.append((page_id, title_positions, body_positions))
+
+    def update(self, page_id, old_terms, title_positions, body_positions):
+        """Re-index a page, adjusting df only for stems it gained or lost."""
+        for field, (old_map, new_map) in enumerate(((old_terms[0], title_positions),
+                                                    (old_terms[1], body_positions))):
+            added, removed = diff_terms(old_map, new_map)
+            for stem in added:
+                self.df_increments[stem][field] += 1
+            for stem in removed:
+                self.df_increments[stem][field] -= 1
+        self.docs.append((page_id, title_positions, body_positions))
+
+    def flush(self, session):
+        """Write the pages as an unpublished segment and the df changes in the session's transaction.
+
+        Returns {page_id: (norm_title, norm_body)} for the batch's pages,
+        computed against the document frequencies after this write. Call
+        publish() once the session has committed, or discard() otherwise.
+        The segment is listed as pending and recorded in SegmentCommit, so
+        recover_segments() publishes it if the process stops in between.
+        """
+        increments = {stem: df for stem, df in self.df_increments.items() if df != [0, 0]}
+        _upsert_df(increments, session)
+        _prune_df([stem for stem, df in increments.items() if df[0] < 0 or df[1] < 0], session)
+
+        total_docs = session.query(func.count(Page.id)).scalar() or 0
+        df_map = load_df({stem for _, title, body in self.docs for stem in (*title, *body)}, session)
+        norms = {}
+        for page_id, title_positions, body_positions in self.docs:
+            norms[page_id] = (vector_norm(title_positions, df_map, 0, total_docs),
+                              vector_norm(body_positions, df_map, 1, total_docs))
+        _write_norms(norms, session)
+
+        # Written once the norms are known, so the segment carries its terms' impact bounds
+        store = get_store()
+        self.segment = store.write(self.docs, norms)
+        store.prepare(self.segment)
+        # Rows of segments no longer pending have done their job
+        table = SegmentCommit.__table__
+        session.execute(table.delete().where(table.c.name.notin_(store.prepared())))
+        session.execute(table.insert(), {'name': self.segment})
+        self.clear()
+        return norms
+
+    def publish(self):
+        """Make the flushed segment visible to searches."""
+        if self.segment:
+            get_store().publish(self.segment)
+            self.segment = None
+
+    def discard(self):
+        """Drop the batch and any flushed but unpublished segment."""
+        if self.segment:
+            get_store().discard(self.segment)
+            self.segment = None
+        self.clear()
+
+
+def recover_segments(session):
+    """Publish the segments whose batch committed just before the process last stopped.
+
+    Segments left pending by batches that never committed are deleted.
+    Returns the names of the published ones.
+    """
+    store = get_store()
+    if not store.needs_recovery:
+        return []
+    recovered = store.recover(set(session.scalars(select(SegmentCommit.name))))
+    session.rollback()
+    if recovered:
+        bump_generation()
+    return recovered
+
+
+def term_weight(frequency, max_tf, df, total_docs):
+    """Normalised tf times idf: the weight search() gives a stem in one page field."""
+    return (0.5 + 0.5 * (frequency / max_tf)) * math.log(1 + (total_docs / (df or 1)))
+
+
+def vector_norm(stem_map, df_map, field, total_docs):
+    """Length of a page field's tf-idf vector; field indexes the (df_title, df_body) pairs of df_map."""
+    max_tf = max((len(positions) for positions in stem_map.values()), default=0)
+    if not max_tf:
+        return 0.0
+    return math.sqrt(sum(
+        term_weight(len(positions), max_tf, df_map.get(stem, (1, 1))[field], total_docs) ** 2
+        for stem, positions in stem_map.items()
+    ))
+
+
+def load_df(stems, session, chunk_size=500):
+    """Return {stem: (df_title, df_body)} for the given stems."""
+    stems = list(stems)
+    df_map = {}
+    for start in range(0, len(stems), chunk_size):
+        rows = session.query(DocumentStats.stem, DocumentStats.df_title, DocumentStats.df_body).filter(
+            DocumentStats.stem.in_(stems[start:start + chunk_size]))
+        df_map.update((stem, (df_title, df_body)) for stem, df_title, df_body in rows)
+    return df_map
+
+
+def _write_norms(norms, session):
+    if not norms:
+        return
+    table = Page.__table__
+    stmt = table.update().where(table.c.id == bindparam('b_id')).values(
+        norm_title=bindparam('b_norm_title'), norm_body=bindparam('b_norm_body'))
+    session.execute(stmt, [{'b_id': page_id, 'b_norm_title': norm_title, 'b_norm_body': norm_body}
+                           for page_id, (norm_title, norm_body) in norms.items()])
+
+
+def recompute_norms(session):
+    """Recompute every page's title and body vector norms against the current df counts.
+
+    The segments' impact bounds, which depend on the norms, are refreshed too.
+    """
+    total_docs = session.query(func.count(Page.id)).scalar() or 0
+    pages = session.query(Page.id, Page.max_tf_title, Page.max_tf_body).all()
+    if not pages:
+        return {}
+    size = max(page[0] for page in pages) + 1
+    max_tf = {'title': np.zeros(size), 'body': np.zeros(size)}
+    for page_id, max_tf_title, max_tf_body in pages:
+        max_tf['title'][page_id] = max_tf_title or 0
+        max_tf['body'][page_id] = max_tf_body or 0
+
+    df_map = {stem: (df_title, df_body) for stem, df_title, df_body in
+              session.query(DocumentStats.stem, DocumentStats.df_title, DocumentStats.df_body)}
+    columns = {'title': ([], [], []), 'body': ([], [], [])}
+    for page_id, maps in get_store().iter_vectors():
+        if page_id >= size:
+            continue
+        for field, (index_type, stem_freqs) in enumerate(zip(('title', 'body'), maps)):
+            page_ids, freqs, dfs = columns[index_type]
+            for stem, frequency in stem_freqs.items():
+                page_ids.append(page_id)
+                freqs.append(frequency)
+                dfs.append(df_map.get(stem, (1, 1))[field])
+
+    field_norms = {}
+    for index_type, (page_ids, freqs, dfs) in columns.items():
+        squares = np.zeros(size)
+        if page_ids:
+            page_ids = np.array(page_ids, dtype=np.int64)
+            freqs = np.array(freqs, dtype=np.float64)
+            dfs = np.array(dfs, dtype=np.float64)
+            page_max_tf = max_tf[index_type][page_ids]
+            keep = page_max_tf > 0
+            weights = (0.5 + 0.5 * (freqs[keep] / page_max_tf[keep])) * np.log(1 + total_docs / np.maximum(dfs[keep], 1))
+            squares = np.bincount(page_ids[keep], weights=weights ** 2, minlength=size)
+        field_norms[index_type] = np.sqrt(squares)
+
+    norms = {page_id: (float(field_norms['title'][page_id]), float(field_norms['body'][page_id]))
+             for page_id, _, _ in pages}
+    _write_norms(norms, session)
+    get_store().refresh_impacts((max_tf['title'].tolist(), max_tf['body'].tolist()),
+                                (field_norms['title'].tolist(), field_norms['body'].tolist()))
+    return norms
 
 
 def parse_query(query):
@@ -0,0 +1,188 @@
+import os
+import threading
+import numpy as np
+from sqlalchemy import select, union_all
+from model import Page, PageLink, DuplicatePage
+from segments import LINK_GRAPH, get_store
+from metrics import Collected
+
+DAMPING = 0.85  # Chance the random surfer follows a link rather than jumping to a random page
+PAGERANK_TOLERANCE = 1e-9  # Stop once an iteration moves the ranks less than this in total
+PAGERANK_MAX_ITERATIONS = 100
+
+
+class LinkGraph:
+    """Link graph of the indexed pages in compressed sparse row form, with their PageRank.
+
+    page_ids lists the pages in id order. The out-links of the page at
+    position i are indices[indptr[i]:indptr[i + 1]], as positions in
+    page_ids, and ranks[i] is its PageRank. A link to a near-duplicate URL
+    counts as a link to the page it duplicates; repeated links count once
+    and self links not at all.
+    """
+
+    def __init__(self, page_ids, indptr, indices, ranks=None):
+        self.page_ids = page_ids
+        self.indptr = indptr
+        self.indices = indices
+        self.ranks = np.full(len(page_ids), 1 / max(1, len(page_ids))) if ranks is None else ranks
+        self.iterations = 0
+        self._static_scores = None
+
+    def __len__(self):
+        return len(self.page_ids)
+
+    @property
+    def num_links(self):
+        return len(self.indices)
+
+    @classmethod
+    def build(cls, session):
+        """Resolve the stored links to indexed pages and pack them by source page."""
+        page_ids = np.array(session.scalars(select(Page.id).order_by(Page.id)).all(), dtype=np.int64)
+        resolved = union_all(
+            select(PageLink.source_id, Page.id).join(Page, Page.url == PageLink.target_url),
+            select(PageLink.source_id, DuplicatePage.duplicate_of)
+            .join(DuplicatePage, DuplicatePage.url == PageLink.target_url))
+        edges = np.array(session.execute(resolved).all(), dtype=np.int64).reshape(-1, 2)
+        session.rollback()  # Don't hold a read transaction while ranking
+        num_pages = len(page_ids)
+        if not num_pages:
+            return cls(page_ids, np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int32))
+
+        sources = np.minimum(np.searchsorted(page_ids, edges[:, 0]), num_pages - 1)
+        targets = np.minimum(np.searchsorted(page_ids, edges[:, 1]), num_pages - 1)
+        valid = (page_ids[sources] == edges[:, 0]) & (page_ids[targets] == edges[:, 1]) & (sources != targets)
+        # Sorted unique (source, target) keys give each row's targets in order
+        sources, targets = np.divmod(np.unique(sources[valid] * num_pages + targets[valid]), num_pages)
+        indptr = np.zeros(num_pages + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=num_pages), out=indptr[1:])
+        return cls(page_ids, indptr, targets.astype(np.int32))
+
+    def compute_pagerank(self, previous=None):
+        """Power-iterate PageRank until it converges, starting from previous's ranks where it has them.
+
+        Rank held by pages without out-links is spread over every page. After
+        a crawl only adds or changes some pages, starting from the old ranks
+        converges in far fewer iterations than starting from uniform ones.
+        """
+        num_pages = len(self)
+        if not num_pages:
+            return
+        out_degree = np.diff(self.indptr)
+        sources = np.repeat(np.arange(num_pages), out_degree)
+        dangling = out_degree == 0
+
+        ranks = np.full(num_pages, 1 / num_pages)
+        if previous is not None and len(previous):
+            known = np.isin(self.page_ids, previous.page_ids)
+            ranks[known] = previous.ranks[np.searchsorted(previous.page_ids, self.page_ids[known])]
+            ranks /= ranks.sum()
+
+        shares = np.zeros(num_pages)
+        for iteration in range(1, PAGERANK_MAX_ITERATIONS + 1):
+            np.divide(ranks, out_degree, out=shares, where=~dangling)
+            updated = np.bincount(self.indices, weights=shares[sources], minlength=num_pages)
+            updated = DAMPING * (updated + ranks[dangling].sum() / num_pages) + (1 - DAMPING) / num_pages
+            change = np.abs(updated - ranks).sum()
+            ranks = updated
+            if change < PAGERANK_TOLERANCE:
+                break
+        self.ranks = ranks
+        self.iterations = iteration
+        self._static_scores = None
+
+    def static_scores(self):
+        """Each page's PageRank on a 0 to 1 log scale, in an array indexed by page id.
+
+        num_pages * rank is 1 for a page of average authority; the log keeps
+        a few hub pages from flattening everyone else to zero.
+        """
+        if self._static_scores is None:
+            scores = np.zeros(int(self.page_ids[-1]) + 1 if len(self) else 0)
+            if len(self):
+                scaled = np.log1p(len(self) * self.ranks)
+                scores[self.page_ids] = scaled / scaled.max()
+            self._static_scores = scores
+        return self._static_scores
+
+    def write(self, f):
+        np.savez(f, page_ids=self.page_ids, indptr=self.indptr, indices=self.indices, ranks=self.ranks)
+
+    def save(self, path):
+        # Write then rename so a crash leaves either the old or the new graph
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            self.write(f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, file):
+        """Read a graph written by save() or write() from a path or file object."""
+        with np.load(file) as data:
+            return cls(data['page_ids'], data['indptr'], data['indices'], data['ranks'])
+
+
+_graph = None  # (path, LinkGraph or None) of the shared store's directory
+_graph_lock = threading.Lock()
+
+
+def _graph_path():
+    return os.path.join(get_store().directory, LINK_GRAPH)
+
+
+def get_link_graph():
+    """Return the saved link graph of the shared index, or None before the first update_link_graph()."""
+    global _graph
+    path = _graph_path()
+    with _graph_lock:
+        if _graph is None or _graph[0] != path:
+            try:
+                _graph = (path, LinkGraph.load(path))
+            except FileNotFoundError:
+                _graph = (path, None)
+        return _graph[1]
+
+
+def update_link_graph(session):
+    """Rebuild the link graph from the stored links, rerank it from the previous ranks and save it.
+
+    Callers bump the index generation afterwards so searches pick up the new ranks.
+    """
+    previous = get_link_graph()
+    graph = LinkGraph.build(session)
+    graph.compute_pagerank(previous)
+    install_link_graph(graph)
+    return graph
+
+
+def install_link_graph(graph):
+    """Save graph as the shared index's link graph, e.g. one restored from a snapshot."""
+    global _graph
+    path = _graph_path()
+    graph.save(path)
+    with _graph_lock:
+        _graph = (path, graph)
+
+
+def reset_link_graph():
+    """Delete the saved link graph, e.g. once the pages it ranks are gone."""
+    global _graph
+    path = _graph_path()
+    with _graph_lock:
+        _graph = (path, None)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _loaded_graph():
+    return _graph[1] if _graph else None
+
+
+Collected('link_graph_pages', 'Pages in the loaded link graph', lambda: len(_loaded_graph() or ()))
+Collected('link_graph_links', 'Distinct links between pages in the loaded link graph',
+          lambda: _loaded_graph().num_links if _loaded_graph() else 0)
+Collected('pagerank_iterations', 'Power iterations run by the last PageRank update',
+          lambda: _loaded_graph().iterations if _loaded_graph() else 0)
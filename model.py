@@ -1,33 +1,102 @@
+import sqlite3
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import Engine
 
 db = SQLAlchemy()
 
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),  # Readers see the last commit instead of waiting for the writer
+    ('synchronous', 'NORMAL'),  # Fsync at checkpoints only; WAL keeps the database consistent
+    ('busy_timeout', 30000),  # Milliseconds to wait for the write lock, e.g. behind a CLI command
+    ('cache_size', -65536),  # Page cache per connection, in KiB
+    ('temp_store', 'MEMORY'),
+    ('mmap_size', 268435456),  # Bytes of the database file read through a memory map
+)
+# Engine options for the app and benchmark: a pool of reused connections, sized for
+# concurrent web requests plus the crawler's fetcher threads
+ENGINE_OPTIONS = {
+    'pool_size': 16,
+    'max_overflow': 16,
+    'connect_args': {'timeout': 30},
+}
+
+
+@event.listens_for(Engine, 'connect')
+def _configure_sqlite_connection(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        # pysqlite only opens a transaction before DML, so a leading SAVEPOINT would start
+        # (and its RELEASE commit) the outer transaction. Let SQLAlchemy emit BEGIN itself.
+        dbapi_connection.isolation_level = None
+        for name, value in SQLITE_PRAGMAS:
+            dbapi_connection.execute(f'PRAGMA {name}={value}')
+
+
+@event.listens_for(Engine, 'begin')
+def _begin_sqlite_transaction(conn):
+    if conn.dialect.name == 'sqlite':
+        conn.exec_driver_sql('BEGIN')
+
 class Page(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     url = db.Column(db.String(1024), unique=True, nullable=False)
     title = db.Column(db.String(256))
     last_modified = db.Column(db.String(128))
+    last_modified_at = db.Column(db.DateTime)  # Parsed Last-Modified for revalidation
+    etag = db.Column(db.String(256))
     size = db.Column(db.Integer)
     keywords = db.Column(db.JSON)
     parent_id = db.Column(db.Integer, db.ForeignKey('page.id'), nullable=True)
     children = db.relationship('Page', backref=db.backref('parent', remote_side=[id]), lazy=True)
     max_tf_title = db.Column(db.Integer, default=0)
     max_tf_body = db.Column(db.Integer, default=0)
+    norm_title = db.Column(db.Float, default=0)  # tf-idf vector lengths used for cosine normalisation
+    norm_body = db.Column(db.Float, default=0)
+    simhash = db.Column(db.BigInteger)  # Body fingerprint for near-duplicate detection, stored signed
 
-class BaseIndex(db.Model):
-    __abstract__ = True
-    stem = db.Column(db.String(100), primary_key=True)
+class DuplicatePage(db.Model):
+    """A fetched URL left out of the index because its body nearly duplicates an indexed page."""
+    url = db.Column(db.String(1024), primary_key=True)
+    duplicate_of = db.Column(db.Integer, db.ForeignKey('page.id'), nullable=False)
+
+class PageText(db.Model):
+    """Clean body text of an indexed page, zlib compressed, so chat context needs no refetch."""
     page_id = db.Column(db.Integer, db.ForeignKey('page.id'), primary_key=True)
-    positions = db.Column(db.JSON)
-    frequency = db.Column(db.Integer)
+    text = db.Column(db.LargeBinary, nullable=False)
 
-class BodyInvertedIndex(BaseIndex):
-    __tablename__ = 'body_inverted_index'
+class PageLink(db.Model):
+    """A same-domain link found on an indexed page, kept so the link graph can be rebuilt."""
+    source_id = db.Column(db.Integer, db.ForeignKey('page.id'), primary_key=True)
+    target_url = db.Column(db.String(1024), primary_key=True)
 
-class TitleInvertedIndex(BaseIndex):
-    __tablename__ = 'title_inverted_index'
+class SegmentCommit(db.Model):
+    """An index segment whose batch committed, so a restart can publish it if the process stopped first."""
+    name = db.Column(db.String(64), primary_key=True)
 
 class DocumentStats(db.Model):
     stem = db.Column(db.String(100), primary_key=True)
     df_title = db.Column(db.Integer, default=0)  # Document frequency in titles
     df_body = db.Column(db.Integer, default=0)   # Document frequency in bodies
+
+
+def upgrade_schema(engine):
+    """Bring a database written by an older version up to the current schema, in place.
+
+    Missing tables are created and missing columns added, with their scalar
+    defaults, so existing pages are kept. Safe to run on every start.
+    Returns the "table.column" names that were added.
+    """
+    db.metadata.create_all(engine)
+    added = []
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in inspect(conn).get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}'
+                if column.default is not None and column.default.is_scalar:
+                    ddl += f' DEFAULT {column.default.arg!r}'
+                conn.exec_driver_sql(ddl)
+                added.append(f'{table.name}.{column.name}')
+    return added
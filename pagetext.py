@@ -0,0 +1,33 @@
+import zlib
+from bs4 import BeautifulSoup
+
+# Clean page text as the crawler stores it in PageText and chat gives it to the model
+
+
+def body_strings(soup):
+    """List of the text nodes of a parsed page's body, without scripts, styles or comments.
+
+    A list rather than a generator because the crawler reads the nodes twice,
+    once for tokens and once for the stored text; tokenizing them does not
+    join them into one string.
+    """
+    body = soup.find('body')
+    return list(body.strings) if body else []
+
+
+def clean_text(strings):
+    """Join text nodes into visible text, one non-blank node per line."""
+    return '\n'.join(filter(None, (string.strip() for string in strings)))
+
+
+def html_text(html):
+    """Clean body text of an HTML page."""
+    return clean_text(body_strings(BeautifulSoup(html, 'html.parser')))
+
+
+def compress_text(text):
+    return zlib.compress(text.encode('utf-8'))
+
+
+def decompress_text(data):
+    return zlib.decompress(data).decode('utf-8')
@@ -1,19 +1,46 @@
-import os
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
 from model import db, Page
 
-def output_records_to_txt(file_path='spider_result.txt'):
-    pages = Page.query.limit(30).all()
+EXPORT_BATCH_SIZE = 500  # Pages loaded per round trip while exporting
+PHASE1_RECORDS = 30  # Pages written by the Phase 1 output unless a full export is asked for
+SEPARATOR = "------------------------------------------------------------------------------------\n"
+
+
+def _keyword_pairs(keywords):
+    # Crawls store [stem, frequency] pairs; older databases stored {'stem', 'frequency'} dicts
+    for keyword in keywords or ():
+        if isinstance(keyword, dict):
+            yield keyword.get('stem', ''), keyword.get('frequency', 0)
+        else:
+            yield keyword[0], keyword[1]
+
+
+def format_record(page):
+    record = f"Page title: {page.title}\n"
+    record += f"URL: {page.url}\n"
+    record += f"Last modified date: {page.last_modified}, size of page: {page.size} words\n"
+    record += "Keywords: " + "; ".join(f"{stem} ({frequency})" for stem, frequency in _keyword_pairs(page.keywords)) + "\n"
+    if page.parent:
+        record += f"Parent {page.parent.url}\n"
+    if page.children:
+        record += "\n".join(f"Child {child.url}" for child in page.children) + "\n"
+    return record + SEPARATOR
+
+
+def output_records_to_txt(file_path='spider_result.txt', limit=PHASE1_RECORDS, full_export=False):
+    """Write the first limit pages by id, or every page for a full export, with their parent and child links.
+
+    Pages are streamed EXPORT_BATCH_SIZE at a time, each batch loading its
+    parents' and children's URLs in one query apiece, so memory stays flat
+    however large the crawl.
+    """
+    query = (select(Page)
+             .options(selectinload(Page.parent).load_only(Page.url),
+                      selectinload(Page.children).load_only(Page.url, Page.parent_id))
+             .order_by(Page.id)
+             .limit(None if full_export else limit)
+             .execution_options(yield_per=EXPORT_BATCH_SIZE))
     with open(file_path, 'w', encoding='utf-8') as f:
-        for page in pages:
-            f.write(f"Page title: {page.title}\n")
-            f.write(f"URL: {page.url}\n")
-            f.write(f"Last modified date: {page.last_modified}, size of page: {page.size} words\n")
-            f.write("Keywords: ")
-            keywords = [f"{keyword['stem']} ({keyword['frequency']})" for keyword in page.keywords]
-            f.write("; ".join(keywords) + "\n")
-            if page.parent:
-                f.write(f"Parent {page.parent.url}\n")
-            if page.children:
-                children_urls = [child.url for child in page.children]
-                f.write("\n".join(f"Child {url}" for url in children_urls) + "\n")
-            f.write("------------------------------------------------------------------------------------\n")
\ No newline at end of file
+        for page in db.session.scalars(query):
+            f.write(format_record(page))
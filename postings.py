@@ -0,0 +1,344 @@
+from array import array
+from bisect import bisect_left, bisect_right
+
+SKIP_INTERVAL = 64  # Postings per skip block
+
+
+def encode_varint(value, out):
+    """Append value to the bytearray out as a LEB128 varint."""
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varint(buf, offset):
+    """Decode one varint from buf at offset, returning (value, next_offset)."""
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def skip_varints(buf, offset, count):
+    """Return the offset just past the next count varints in buf."""
+    while count:
+        if buf[offset] < 0x80:
+            count -= 1
+        offset += 1
+    return offset
+
+
+class PostingList:
+    """Delta/varint compressed postings for one stem in one field.
+
+    Doc ids and term frequencies are interleaved in doc_bytes as
+    (doc gap, freq) pairs, positions are delta encoded per document in
+    pos_bytes. Every SKIP_INTERVAL postings a skip entry records the first
+    doc id of the block and where the block starts in both streams.
+    """
+    __slots__ = ('df', 'doc_bytes', 'pos_bytes', 'skip_docs', 'skip_bases',
+                 'skip_doc_offsets', 'skip_pos_offsets', 'max_impact')
+
+    def __init__(self, postings, max_impact=0.0):
+        # postings: iterable of (page_id, positions) sorted by page_id
+        doc_bytes = bytearray()
+        pos_bytes = bytearray()
+        self.skip_docs = array('I')
+        self.skip_bases = array('I')
+        self.skip_doc_offsets = array('I')
+        self.skip_pos_offsets = array('I')
+        df = 0
+        last_doc = 0
+        for page_id, positions in postings:
+            if df % SKIP_INTERVAL == 0:
+                self.skip_docs.append(page_id)
+                self.skip_bases.append(last_doc)
+                self.skip_doc_offsets.append(len(doc_bytes))
+                self.skip_pos_offsets.append(len(pos_bytes))
+            encode_varint(page_id - last_doc, doc_bytes)
+            encode_varint(len(positions), doc_bytes)
+            last_pos = 0
+            for pos in positions:
+                encode_varint(pos - last_pos, pos_bytes)
+                last_pos = pos
+            last_doc = page_id
+            df += 1
+        self.df = df
+        # Largest normalised tf / document norm over the list, an idf-free score bound
+        self.max_impact = max_impact
+        self.doc_bytes = bytes(doc_bytes)
+        self.pos_bytes = bytes(pos_bytes)
+
+    @classmethod
+    def from_buffers(cls, df, doc_bytes, pos_bytes, skips, max_impact=0.0):
+        """Wrap already encoded streams, e.g. memoryviews of a mapped segment, without copying."""
+        plist = cls.__new__(cls)
+        plist.df = df
+        plist.doc_bytes = doc_bytes
+        plist.pos_bytes = pos_bytes
+        plist.skip_docs, plist.skip_bases, plist.skip_doc_offsets, plist.skip_pos_offsets = skips
+        plist.max_impact = max_impact
+        return plist
+
+    def __len__(self):
+        return self.df
+
+    def docs(self):
+        """Decode all (doc ids, frequencies) as two parallel arrays."""
+        doc_ids = array('I')
+        freqs = array('I')
+        buf = self.doc_bytes
+        offset = 0
+        doc = 0
+        for _ in range(self.df):
+            gap, offset = decode_varint(buf, offset)
+            freq, offset = decode_varint(buf, offset)
+            doc += gap
+            doc_ids.append(doc)
+            freqs.append(freq)
+        return doc_ids, freqs
+
+    def cursor(self):
+        return PostingCursor(self)
+
+    def freqs_for(self, doc_ids):
+        """Return the frequency of each of the sorted doc_ids, 0 where absent.
+
+        Only the skip blocks that may hold them are decoded, and positions
+        not at all.
+        """
+        freqs = [0] * len(doc_ids)
+        buf = self.doc_bytes
+        index = -1
+        doc = -1
+        freq = offset = 0
+        for i, target in enumerate(doc_ids):
+            if doc < target:
+                block = bisect_right(self.skip_docs, target) - 1
+                if block < 0:
+                    continue
+                if block * SKIP_INTERVAL > index:
+                    index = block * SKIP_INTERVAL - 1
+                    doc = self.skip_bases[block]
+                    offset = self.skip_doc_offsets[block]
+                while (doc < target or index < 0) and index + 1 < self.df:
+                    gap, offset = decode_varint(buf, offset)
+                    freq, offset = decode_varint(buf, offset)
+                    doc += gap
+                    index += 1
+                if doc < target:
+                    break
+            if doc == target:
+                freqs[i] = freq
+        return freqs
+
+
+class PostingCursor:
+    """Forward iterator over a PostingList supporting skip-based advance()."""
+    __slots__ = ('plist', 'index', 'doc', 'freq', '_doc_offset', '_pos_offset')
+
+    def __init__(self, plist):
+        self.plist = plist
+        self.index = -1
+        self.doc = 0
+        self.freq = 0
+        self._doc_offset = 0
+        self._pos_offset = 0
+
+    def next(self):
+        """Move to the next posting; returns False once exhausted."""
+        plist = self.plist
+        if self.index + 1 >= plist.df:
+            self.index = plist.df
+            return False
+        if self.index >= 0:
+            self._pos_offset = skip_varints(plist.pos_bytes, self._pos_offset, self.freq)
+        gap, self._doc_offset = decode_varint(plist.doc_bytes, self._doc_offset)
+        self.freq, self._doc_offset = decode_varint(plist.doc_bytes, self._doc_offset)
+        self.doc += gap
+        self.index += 1
+        return True
+
+    def advance(self, target):
+        """Move to the first posting with doc >= target; False if none."""
+        plist = self.plist
+        if self.index >= plist.df:
+            return False
+        if self.index >= 0 and self.doc >= target:
+            return True
+        block = bisect_right(plist.skip_docs, target) - 1
+        if block >= 0 and block * SKIP_INTERVAL > self.index:
+            # Jump straight to the start of the block that may hold target
+            self.index = block * SKIP_INTERVAL - 1
+            self.doc = plist.skip_bases[block]
+            self.freq = 0
+            self._doc_offset = plist.skip_doc_offsets[block]
+            self._pos_offset = plist.skip_pos_offsets[block]
+        while self.next():
+            if self.doc >= target:
+                return True
+        return False
+
+    def positions(self):
+        positions = []
+        buf = self.plist.pos_bytes
+        offset = self._pos_offset
+        pos = 0
+        for _ in range(self.freq):
+            gap, offset = decode_varint(buf, offset)
+            pos += gap
+            positions.append(pos)
+        return positions
+
+
+class ArrayPostings:
+    """Uncompressed (doc_ids, freqs) postings with the PostingList read API."""
+    __slots__ = ('doc_ids', 'freqs', 'max_impact')
+
+    def __init__(self, doc_ids, freqs, max_impact=0.0):
+        self.doc_ids = doc_ids
+        self.freqs = freqs
+        self.max_impact = max_impact
+
+    @property
+    def df(self):
+        return len(self.doc_ids)
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def docs(self):
+        return self.doc_ids, self.freqs
+
+    def cursor(self):
+        return ArrayCursor(self)
+
+    def freqs_for(self, doc_ids):
+        freqs = [0] * len(doc_ids)
+        start = 0
+        for i, target in enumerate(doc_ids):
+            start = bisect_left(self.doc_ids, target, start)
+            if start == len(self.doc_ids):
+                break
+            if self.doc_ids[start] == target:
+                freqs[i] = self.freqs[start]
+        return freqs
+
+
+class ArrayCursor:
+    """PostingCursor counterpart for ArrayPostings."""
+    __slots__ = ('plist', 'index', 'doc', 'freq')
+
+    def __init__(self, plist):
+        self.plist = plist
+        self.index = -1
+        self.doc = 0
+        self.freq = 0
+
+    def _seek(self, index):
+        self.index = index
+        if index >= self.plist.df:
+            self.index = self.plist.df
+            return False
+        self.doc = self.plist.doc_ids[index]
+        self.freq = self.plist.freqs[index]
+        return True
+
+    def next(self):
+        return self._seek(self.index + 1)
+
+    def advance(self, target):
+        if self.index >= self.plist.df:
+            return False
+        if self.index >= 0 and self.doc >= target:
+            return True
+        return self._seek(bisect_left(self.plist.doc_ids, target, max(self.index, 0)))
+
+
+def _merge_intersect(a, b):
+    """Intersect two sorted lists in a single merge pass."""
+    result = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i] < b[j]:
+            i += 1
+        elif a[i] > b[j]:
+            j += 1
+        else:
+            result.append(a[i])
+            i += 1
+            j += 1
+    return result
+
+
+def count_phrase_positions(position_lists):
+    """Count start positions p with p + i in position_lists[i] for every i."""
+    # Shift each term's positions back by its offset so phrase occurrences line up
+    shifted = sorted(([pos - i for pos in positions] for i, positions in enumerate(position_lists)), key=len)
+    matches = shifted[0]
+    for positions in shifted[1:]:
+        if not matches:
+            break
+        matches = _merge_intersect(matches, positions)
+    return len(matches)
+
+
+def phrase_counts(plists):
+    """Return (doc_ids, counts) of documents containing the phrase.
+
+    plists holds one PostingList per phrase term in phrase order. Documents
+    are found by leapfrogging the cursors, smallest df first, and positions
+    are only decoded for documents that contain every term.
+    """
+    doc_ids = array('I')
+    counts = array('I')
+    if not plists or any(plist is None for plist in plists):
+        return doc_ids, counts
+
+    cursors = [plist.cursor() for plist in plists]
+    order = sorted(range(len(cursors)), key=lambda i: plists[i].df)
+    lead = cursors[order[0]]
+    if not lead.next():
+        return doc_ids, counts
+    target = lead.doc
+    while True:
+        for i in order:
+            cursor = cursors[i]
+            if not cursor.advance(target):
+                return doc_ids, counts
+            if cursor.doc > target:
+                target = cursor.doc
+                break
+        else:
+            count = count_phrase_positions([cursor.positions() for cursor in cursors])
+            if count:
+                doc_ids.append(target)
+                counts.append(count)
+            if not lead.next():
+                return doc_ids, counts
+            target = lead.doc
+
+
+def impact(freq, max_tf, norm):
+    """Normalised tf / document norm of one posting: its score bound before idf and query weights."""
+    return (0.5 + 0.5 * (freq / max_tf)) / norm
+
+
+def max_impact(postings, max_tf, norms):
+    """Largest impact() over (page_id, freq) postings.
+
+    max_tf and norms are per-page sequences; pages without a max_tf or norm
+    are skipped, as search() gives them no weight or score.
+    """
+    bound = 0.0
+    for page_id, freq in postings:
+        if page_id >= len(norms) or not max_tf[page_id] or not norms[page_id]:
+            continue
+        bound = max(bound, impact(freq, max_tf[page_id], norms[page_id]))
+    return bound
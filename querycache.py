@@ -0,0 +1,69 @@
+import time
+import threading
+from collections import OrderedDict
+from metrics import Collected
+
+MAX_ENTRIES = 1024
+TTL_SECONDS = 300
+
+
+class QueryCache:
+    """Bounded LRU of ranked (page_id, score) lists with a TTL.
+
+    Entries remember the index generation they were computed for and are
+    treated as misses once the index has moved on.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, ttl=TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, generation):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_generation, expires, value = entry
+                if entry_generation == generation and expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, generation, value):
+        with self._lock:
+            self._entries[key] = (generation, time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+query_cache = QueryCache()
+
+Collected('query_cache_hits_total', 'Result cache lookups that hit', lambda: query_cache.stats()['hits'], 'counter')
+Collected('query_cache_misses_total', 'Result cache lookups that missed', lambda: query_cache.stats()['misses'], 'counter')
+Collected('query_cache_evictions_total', 'Result cache entries evicted for space', lambda: query_cache.stats()['evictions'],
+          'counter')
+Collected('query_cache_entries', 'Result cache entries held', lambda: query_cache.stats()['size'])
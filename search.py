@@ -1,98 +1,99 @@
+import os
 import re
 import math
-from nltk.stem import PorterStemmer
-from model import db, BodyInvertedIndex, TitleInvertedIndex, Page, DocumentStats
-from collections import defaultdict
+import numpy as np
+from model import db, Page
+from collections import defaultdict, deque
 from indexer import parse_query
+from postings import phrase_counts, max_impact, ArrayPostings
+from engine import get_engine
+from querycache import query_cache
+from tokenizer import stem_term
+from metrics import Counter, Histogram, Trace
 
-stemmer = PorterStemmer()
+PRUNING_SLACK = 1e-9  # Keeps MaxScore bounds safe from floating point rounding
+MAXSCORE_PROBE_RATIO = 4  # MaxScore probes a list for its candidates when the list is this many times longer
+SLOW_QUERY_SECONDS = float(os.environ.get('SLOW_QUERY_SECONDS', 0))  # Trace searches slower than this; 0 disables
+SLOW_QUERY_LOG_SIZE = 100  # Most recent slow query traces kept
+PAGERANK_WEIGHT = float(os.environ.get('PAGERANK_WEIGHT', 0.3))  # Boost for the most linked-to page; 0 disables
+SEARCH_SHARDS = os.environ.get('SEARCH_SHARDS', '')  # "local", or host:port,... of shard workers; empty searches in process
 
+SEARCH_SECONDS = Histogram('search_seconds', 'search() latency', ('mode',))
+SEARCH_STAGE_SECONDS = Histogram('search_stage_seconds', 'search() time per stage', ('stage',))
+SEARCH_REQUESTS = Counter('search_requests_total', 'search() calls by result cache outcome', ('cache',))
 
-def get_phrase_count(phrase_terms, page_id, index_class, session):
-    """Count occurrences of a phrase in a document."""
-    # Get positions of all terms in one batch query
-    stems = [stemmer.stem(term) for term in phrase_terms]
-    entries = session.query(index_class).filter(
-        index_class.stem.in_(stems),
-        index_class.page_id == page_id
-    ).all()
+slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
 
-    # Exit early if we're missing any term
-    if len(entries) != len(stems):
-        return 0
 
-    # Map stems to their positions
-    positions = {entry.stem: entry.positions for entry in entries}
+def get_phrase_counts(phrase_terms, postings):
+    """Count occurrences of a phrase in every document of one index."""
+    stems = [stem_term(term) for term in phrase_terms]
+    return phrase_counts([postings.get(stem) for stem in stems])
 
-    # Check for consecutive positions
-    first_stem = stems[0]
-    count = 0
-    for pos in positions.get(first_stem, []):
-        if all(pos+i in positions.get(stems[i], []) for i in range(1, len(stems))):
-            count += 1
-    return count
 
+def _phrase_postings(hits, doc_stats, index_type):
+    """Wrap phrase (doc_ids, counts) as postings with their impact bound."""
+    if index_type == 'title':
+        columns = doc_stats.max_tf_title, doc_stats.norm_title
+    else:
+        columns = doc_stats.max_tf_body, doc_stats.norm_body
+    return ArrayPostings(hits[0], hits[1], max_impact(zip(*hits), *columns))
 
-def search(query_string):
-    """Search documents using vector space model with title preference."""
-    session = db.session
-    query_parts = parse_query(query_string)
 
-    # Extract terms and phrases
-    terms = [content for part_type, content in query_parts if part_type == 'term']
-    phrases = [content for part_type, content in query_parts if part_type == 'phrase']
+def _field_postings(plist, idf):
+    """Return (postings, idf) for a posting list, or None if absent."""
+    if not plist:
+        return None
+    return plist, idf
 
-    # Initialize score tracking
-    title_scores = defaultdict(float)
-    body_scores = defaultdict(float)
-    title_lengths = defaultdict(float)
-    body_lengths = defaultdict(float)
-    query_vector_length = 0
-    total_docs = session.query(Page).count() or 1  # Avoid division by zero
 
-    # Process individual terms
-    if terms:
-        stems = [stemmer.stem(term) for term in terms]
-
-        # Get document frequencies in batch
-        df_records = session.query(DocumentStats).filter(
-            DocumentStats.stem.in_(stems)
-        ).all()
-        df_map = {record.stem: (record.df_title or 1, record.df_body or 1) for record in df_records}
-
-        # Process each term
-        for term in terms:
-            stem = stemmer.stem(term)
-            if stem not in df_map:
-                continue
-
-            df_title, df_body = df_map[stem]
-
-            # Calculate query weight
-            query_weight = math.log(1 + (total_docs / df_body))
-            query_vector_length += query_weight ** 2
-
-            # Process title matches
-            title_entries = session.query(TitleInvertedIndex).filter_by(stem=stem).all()
-            for entry in title_entries:
-                page = session.query(Page).get(entry.page_id)
-                if not page or not page.max_tf_title:
-                    continue
-
-                weight = (0.5 + 0.5 * (entry.frequency / page.max_tf_title)) * math.log(1 + (total_docs / df_title))
-                title_scores[entry.page_id] += weight * query_weight
-                title_lengths[entry.page_id] += weight ** 2
+def query_df_stems(terms, phrases):
+    """Stems whose document frequencies weight a query: each term's, and each phrase's first."""
+    stems = [stem_term(term) for term in terms]
+    for phrase in phrases:
+        phrase_terms = re.findall(r'\w+', phrase)
+        if phrase_terms:
+            stems.append(stem_term(phrase_terms[0]))
+    return [stem for stem in stems if stem is not None]
+
+
+def _gather_units(engine, terms, phrases, trace, collection=None):
+    """Resolve query terms and phrases into scoring units.
+
+    Each unit is (query_weight, title, body) where title and body are
+    (postings, idf) pairs or None. Units keep the order in which the
+    scores are accumulated: terms first, then phrases. Time spent is
+    added to trace's df_lookup, postings and phrase stages.
+
+    collection, a (total_docs, {stem: (df_title, df_body)}) pair, replaces
+    the engine's own counts when it holds only part of the collection, as
+    a shard does.
+    """
+    units = []
+    if collection is None:
+        total_docs = engine.num_docs or 1  # Avoid division by zero
+        document_frequency = engine.df
+    else:
+        total_docs = collection[0] or 1
+        document_frequency = collection[1].get
 
-            # Process body matches
-            body_entries = session.query(BodyInvertedIndex).filter_by(stem=stem).all()
-            for entry in body_entries:
-                page = session.query(Page).get(entry.page_id)
-                if not page or not page.max_tf_body:
-                    continue
+    # Process individual terms
+    for term in terms:
+        stem = stem_term(term)
+        with trace.stage('df_lookup'):
+            df = document_frequency(stem)
+        if not df:
+            continue
+        df_title, df_body = df[0] or 1, df[1] or 1
 
-                weight = (0.5 + 0.5 * (entry.frequency / page.max_tf_body)) * math.log(1 + (total_docs / df_body))
-                body_scores[entry.page_id] += weight * query_weight
-                body_lengths[entry.page_id] += weight ** 2
+        # Calculate query weight
+        query_weight = math.log(1 + (total_docs / df_body))
+        with trace.stage('postings'):
+            units.append((
+                query_weight,
+                _field_postings(engine.title.get(stem), math.log(1 + (total_docs / df_title))),
+                _field_postings(engine.body.get(stem), math.log(1 + (total_docs / df_body))),
+            ))
 
     # Process phrases
     for phrase in phrases:
@@ -100,59 +101,356 @@ def search(query_string):
         if not phrase_terms:
             continue
 
-        # Find candidate documents using first term
-        first_stem = stemmer.stem(phrase_terms[0])
-        df_record = session.query(DocumentStats).filter_by(stem=first_stem).first()
-        if not df_record:
+        # Phrase weights use the first term's document frequencies
+        first_stem = stem_term(phrase_terms[0])
+        with trace.stage('df_lookup'):
+            df = document_frequency(first_stem)
+        if not df:
             continue
+        df_title, df_body = df[0] or 1, df[1] or 1
 
         # Query weight for phrase
-        phrase_query_weight = math.log(1 + (total_docs / (df_record.df_body or 1)))
-        query_vector_length += phrase_query_weight ** 2
-
-        # Get candidate documents
-        title_ids = [id[0] for id in session.query(TitleInvertedIndex.page_id).filter_by(stem=first_stem).all()]
-        body_ids = [id[0] for id in session.query(BodyInvertedIndex.page_id).filter_by(stem=first_stem).all()]
-        candidate_docs = set(title_ids + body_ids)
-
-        # Check phrase matches
-        for page_id in candidate_docs:
-            page = session.query(Page).get(page_id)
-            if not page:
-                continue
+        phrase_query_weight = math.log(1 + (total_docs / df_body))
+
+        # Match the phrase in each index
+        with trace.stage('phrase'):
+            title_hits = _phrase_postings(get_phrase_counts(phrase_terms, engine.title), engine.doc_stats, 'title')
+            body_hits = _phrase_postings(get_phrase_counts(phrase_terms, engine.body), engine.doc_stats, 'body')
+        units.append((
+            phrase_query_weight,
+            _field_postings(title_hits, math.log(1 + (total_docs / df_title))),
+            _field_postings(body_hits, math.log(1 + (total_docs / df_body))),
+        ))
+
+    return units
+
 
-            # Score title matches
-            title_count = get_phrase_count(phrase_terms, page_id, TitleInvertedIndex, session)
-            if title_count > 0 and page.max_tf_title:
-                weight = (0.5 + 0.5 * (title_count / page.max_tf_title)) * math.log(1 + (total_docs / (df_record.df_title or 1)))
-                title_scores[page_id] += weight * phrase_query_weight
-                title_lengths[page_id] += weight ** 2
+def _static_boosts(static_scores, size):
+    """Each page's PageRank factor 1 + PAGERANK_WEIGHT * static score by page id, or None if unranked."""
+    if not PAGERANK_WEIGHT or static_scores is None:
+        return None
+    return 1 + PAGERANK_WEIGHT * _padded(static_scores, size)[:size]
 
-            # Score body matches
-            body_count = get_phrase_count(phrase_terms, page_id, BodyInvertedIndex, session)
-            if body_count > 0 and page.max_tf_body:
-                weight = (0.5 + 0.5 * (body_count / page.max_tf_body)) * math.log(1 + (total_docs / (df_record.df_body or 1)))
-                body_scores[page_id] += weight * phrase_query_weight
-                body_lengths[page_id] += weight ** 2
+
+def _score_exhaustive(units, doc_stats, limit, static_scores=None):
+    """Accumulate cosine scores one posting at a time."""
+    title_scores = defaultdict(float)
+    body_scores = defaultdict(float)
+    query_vector_length = 0
+
+    for query_weight, title, body in units:
+        query_vector_length += query_weight ** 2
+        for index_type, postings, scores in (('title', title, title_scores), ('body', body, body_scores)):
+            if postings is None:
+                continue
+            doc_ids, freqs = postings[0].docs()
+            idf = postings[1]
+            for page_id, frequency in zip(doc_ids, freqs):
+                max_tf = doc_stats.max_tf(index_type, page_id)
+                if not max_tf:
+                    continue
+
+                weight = (0.5 + 0.5 * (frequency / max_tf)) * idf
+                scores[page_id] += weight * query_weight
 
     # Combine scores with title bias
     query_vector_length = math.sqrt(query_vector_length) or 1  # Avoid division by zero
+    boosts = _static_boosts(static_scores, doc_stats.capacity)
     final_scores = {}
 
     all_doc_ids = set(title_scores.keys()) | set(body_scores.keys())
     for doc_id in all_doc_ids:
-        title_norm = math.sqrt(title_lengths[doc_id]) * query_vector_length
-        body_norm = math.sqrt(body_lengths[doc_id]) * query_vector_length
+        title_norm = doc_stats.norm('title', doc_id) * query_vector_length
+        body_norm = doc_stats.norm('body', doc_id) * query_vector_length
 
         title_score = title_scores[doc_id] / title_norm if title_norm > 0 else 0
         body_score = body_scores[doc_id] / body_norm if body_norm > 0 else 0
 
         # Title matches weighted 3x more than body matches
         final_scores[doc_id] = title_score * 3 + body_score
+        if boosts is not None:
+            final_scores[doc_id] *= float(boosts[doc_id])
+
+    # Ties are broken by page id so every scoring path ranks identically
+    return sorted(final_scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+
+def _padded(column, size):
+    if len(column) >= size:
+        return column
+    padded = np.zeros(size, dtype=column.dtype)
+    padded[:len(column)] = column
+    return padded
+
+
+def _score_vectorized(units, doc_stats, limit, static_scores=None):
+    """Accumulate cosine scores with NumPy scatter-adds over whole posting lists."""
+    decoded = []
+    size = doc_stats.capacity
+    for query_weight, title, body in units:
+        fields = []
+        for postings in (title, body):
+            doc_ids, freqs = postings[0].docs() if postings else ((), ())
+            if len(doc_ids):
+                size = max(size, doc_ids[-1] + 1)
+            fields.append((doc_ids, freqs, postings[1] if postings else 0))
+        decoded.append((query_weight, fields))
+    max_tf_columns = {
+        'title': _padded(doc_stats.max_tf_title, size),
+        'body': _padded(doc_stats.max_tf_body, size),
+    }
+    norm_columns = {
+        'title': _padded(doc_stats.norm_title, size),
+        'body': _padded(doc_stats.norm_body, size),
+    }
+    scores = {'title': np.zeros(size), 'body': np.zeros(size)}
+    matched = np.zeros(size, dtype=bool)
+    query_vector_length = 0
+
+    for query_weight, fields in decoded:
+        query_vector_length += query_weight ** 2
+        for index_type, (doc_ids, freqs, idf) in zip(('title', 'body'), fields):
+            if not len(doc_ids):
+                continue
+            doc_ids = np.asarray(doc_ids, dtype=np.int64)
+            freqs = np.asarray(freqs, dtype=np.int64)
+            max_tf = max_tf_columns[index_type][doc_ids]
+            keep = max_tf > 0
+            doc_ids = doc_ids[keep]
+
+            # Doc ids are unique within a posting list, so fancy-index adds are scatter-adds
+            weights = (0.5 + 0.5 * (freqs[keep] / max_tf[keep])) * idf
+            scores[index_type][doc_ids] += weights * query_weight
+            matched[doc_ids] = True
 
-    # Return top 50 results
-    sorted_ids = sorted(final_scores.keys(), key=lambda x: final_scores[x], reverse=True)[:50]
-    results = session.query(Page).filter(Page.id.in_(sorted_ids)).all()
+    # Combine scores with title bias
+    query_vector_length = math.sqrt(query_vector_length) or 1  # Avoid division by zero
+    doc_ids = np.flatnonzero(matched)
+    field_scores = {}
+    for index_type in ('title', 'body'):
+        norms = norm_columns[index_type][doc_ids] * query_vector_length
+        field_scores[index_type] = np.zeros(len(doc_ids))
+        np.divide(scores[index_type][doc_ids], norms, out=field_scores[index_type], where=norms > 0)
+
+    # Title matches weighted 3x more than body matches
+    final_scores = field_scores['title'] * 3 + field_scores['body']
+    boosts = _static_boosts(static_scores, size)
+    if boosts is not None:
+        final_scores *= boosts[doc_ids]
+
+    if len(doc_ids) > limit:
+        # Keep everything tied with the limit-th best score, then order exactly
+        kth_score = final_scores[np.argpartition(final_scores, -limit)[-limit]]
+        keep = final_scores >= kth_score
+        doc_ids, final_scores = doc_ids[keep], final_scores[keep]
+    order = np.lexsort((doc_ids, -final_scores))[:limit]
+    return [(int(doc_ids[i]), float(final_scores[i])) for i in order]
+
+
+def _score_maxscore(units, doc_stats, limit, static_scores=None):
+    """Term-at-a-time MaxScore evaluation with the same ranking as exhaustive scoring.
+
+    With stored document norms a unit adds w * q / (norm * |q|) to a field's
+    score, so each of its lists is bounded by q * idf * max_impact / |q|,
+    where max_impact is the list's largest normalised tf / norm stored with
+    the segments. Lists are scored whole, highest bound first, until the
+    bounds of the lists left sum to less than the limit-th best partial
+    score: no document unseen by then can make the top limit, so the
+    remaining lists are only probed, skip block by skip block, for the
+    candidates whose partial score plus those bounds still can. Candidates
+    are rescored in unit order so scores match the other paths bit for bit.
+    PageRank scales a page's bounds and partial score by its static boost,
+    so every bound uses the largest one.
+    """
+    size = doc_stats.capacity
+    max_tf_columns = (_padded(doc_stats.max_tf_title, size), _padded(doc_stats.max_tf_body, size))
+    norm_columns = (_padded(doc_stats.norm_title, size), _padded(doc_stats.norm_body, size))
+    query_vector_length = 0
+    for query_weight, _, _ in units:
+        query_vector_length += query_weight ** 2
+    query_vector_length = math.sqrt(query_vector_length) or 1  # Avoid division by zero
+    boosts = _static_boosts(static_scores, size)
+    max_boost = float(boosts.max()) if boosts is not None and size else 1.0
+
+    # A common stem's long body list is often bounded far below its short title list
+    bounds = {}
+    for unit, (query_weight, title, body) in enumerate(units):
+        for field, postings in enumerate((title, body)):
+            if postings:
+                bias = 3 if field == 0 else 1
+                bound = bias * query_weight * postings[1] * postings[0].max_impact / query_vector_length
+                bounds[unit, field] = bound * max_boost * (1 + PRUNING_SLACK)
+    order = sorted(bounds, key=lambda item: -bounds[item])
+
+    def contributions(field, doc_ids, field_weights, query_weight):
+        norms = norm_columns[field][doc_ids] * query_vector_length
+        result = np.zeros(len(doc_ids))
+        np.divide((3 if field == 0 else 1) * field_weights * query_weight, norms, out=result, where=norms > 0)
+        return result if boosts is None else result * boosts[doc_ids]
+
+    weights = {}  # (unit, field) -> (doc ids, tf-idf weights)
+    seen = np.zeros(size, dtype=bool)
+    partial = None  # Lower bound of each document's final score, built once pruning may start
+    candidates = None
+    remaining = sum(bounds.values())
+    scored = 0.0
+    for unit, field in order:
+        query_weight = units[unit][0]
+        plist, idf = units[unit][field + 1]
+        remaining -= bounds[unit, field]
+        scored += bounds[unit, field]
+        if candidates is not None and len(candidates) * MAXSCORE_PROBE_RATIO < len(plist):
+            doc_ids = candidates
+            freqs = np.asarray(plist.freqs_for(candidates.tolist()), dtype=np.int64)
+        else:
+            doc_ids, freqs = plist.docs()
+            doc_ids = np.asarray(doc_ids, dtype=np.int64)
+            freqs = np.asarray(freqs, dtype=np.int64)
+            inside = doc_ids < size
+            doc_ids, freqs = doc_ids[inside], freqs[inside]
+            if candidates is not None:
+                is_candidate = np.zeros(size, dtype=bool)
+                is_candidate[candidates] = True
+                keep = is_candidate[doc_ids]
+                doc_ids, freqs = doc_ids[keep], freqs[keep]
+        max_tf = max_tf_columns[field][doc_ids]
+        keep = (max_tf > 0) & (freqs > 0)
+        doc_ids = doc_ids[keep]
+        field_weights = (0.5 + 0.5 * (freqs[keep] / max_tf[keep])) * idf
+        weights[unit, field] = doc_ids, field_weights
+        seen[doc_ids] = True
+        if partial is not None:
+            partial[doc_ids] += contributions(field, doc_ids, field_weights, query_weight)
+
+        if candidates is None:
+            # No partial score can exceed the bounds scored so far
+            if remaining >= scored:
+                continue
+            if partial is None:
+                partial = np.zeros(size)
+                for (done, done_field), (done_ids, done_weights) in weights.items():
+                    partial[done_ids] += contributions(done_field, done_ids, done_weights, units[done][0])
+            if remaining * (1 + PRUNING_SLACK) >= _kth_largest(partial[seen], limit):
+                continue
+            candidates = np.flatnonzero(seen)
+        threshold = _kth_largest(partial[candidates], limit)
+        candidates = candidates[(partial[candidates] + remaining) * (1 + PRUNING_SLACK) >= threshold]
+
+    # Accumulate in unit order so scores match the vectorized path bit for bit
+    sums = (np.zeros(size), np.zeros(size))
+    for unit, (query_weight, _, _) in enumerate(units):
+        for field in (0, 1):
+            if (unit, field) in weights:
+                doc_ids, field_weights = weights[unit, field]
+                sums[field][doc_ids] += field_weights * query_weight
+    doc_ids = np.flatnonzero(seen) if candidates is None else candidates
+
+    field_scores = []
+    for field in (0, 1):
+        norms = norm_columns[field][doc_ids] * query_vector_length
+        field_scores.append(np.zeros(len(doc_ids)))
+        np.divide(sums[field][doc_ids], norms, out=field_scores[field], where=norms > 0)
+
+    # Title matches weighted 3x more than body matches
+    final_scores = field_scores[0] * 3 + field_scores[1]
+    if boosts is not None:
+        final_scores *= boosts[doc_ids]
+    order = np.lexsort((doc_ids, -final_scores))[:limit]
+    return [(int(doc_ids[i]), float(final_scores[i])) for i in order]
+
+
+def _kth_largest(values, k):
+    """The k-th largest of values, or -inf while there are fewer."""
+    if len(values) < k:
+        return -math.inf
+    return values[np.argpartition(values, -k)[-k]]
+
+
+SCORERS = {
+    'exhaustive': _score_exhaustive,
+    'vectorized': _score_vectorized,
+    'maxscore': _score_maxscore,
+}
+
+
+def rank(engine, terms, phrases, limit, mode='vectorized', collection=None, trace=None):
+    """Return the top limit [(page_id, score)] of engine's documents for parsed query terms and phrases.
+
+    Text scores are scaled by up to 1 + PAGERANK_WEIGHT for link authority.
+    See _gather_units() for collection.
+    """
+    trace = trace or Trace()
+    units = _gather_units(engine, terms, phrases, trace, collection)
+    with trace.stage('rank'):
+        return SCORERS[mode](units, engine.doc_stats, limit, engine.static_scores)
+
+
+def normalize_query(terms, phrases):
+    """Cache key of a parsed query: its stemmed phrases and stemmed terms in scoring order."""
+    return (
+        tuple(tuple(stem_term(term) for term in re.findall(r'\w+', phrase)) for phrase in phrases),
+        tuple(stem_term(term) for term in terms),
+    )
+
+
+def _record_slow_query(query_string, mode, limit, cached, num_results, trace):
+    elapsed = trace.elapsed
+    record = {
+        'query': query_string,
+        'mode': mode,
+        'limit': limit,
+        'cached': cached,
+        'results': num_results,
+        'seconds': round(elapsed, 6),
+        'stages': {stage: round(seconds, 6) for stage, seconds in trace.stages.items()},
+    }
+    slow_queries.append(record)
+    print(f"Slow query {query_string!r}: {elapsed * 1000:.1f} ms {record['stages']}")
+
+
+def search(query_string, limit=50, mode='vectorized', use_cache=True):
+    """Search documents using vector space model with title preference."""
+    trace = Trace()
+    session = db.session
+    with trace.stage('engine'):
+        engine = get_engine(session)
+    with trace.stage('parse'):
+        query_parts = parse_query(query_string)
+
+        # Extract terms and phrases (sorted so equal queries accumulate scores in the same order)
+        terms = [content for part_type, content in query_parts if part_type == 'term']
+        phrases = sorted(content for part_type, content in query_parts if part_type == 'phrase')
+
+        key = (normalize_query(terms, phrases), limit, mode)
+    coordinator = None
+    generation = engine.generation
+    if SEARCH_SHARDS:
+        from shards import get_coordinator  # shards imports this module for its workers
+        with trace.stage('engine'):
+            coordinator = get_coordinator(SEARCH_SHARDS, engine)
+        if coordinator is not None:
+            generation = (generation, coordinator.version)
+    ranked = query_cache.get(key, generation) if use_cache else None
+    cached = ranked is not None
+    if ranked is None:
+        if coordinator is None:
+            ranked = rank(engine, terms, phrases, limit, mode, trace=trace)
+        else:
+            with trace.stage('shards'):
+                ranked = coordinator.rank(terms, phrases, limit, mode)
+        if use_cache:
+            query_cache.put(key, generation, ranked)
+
+    # Return top results
+    with trace.stage('hydrate'):
+        final_scores = dict(ranked)
+        results = session.query(Page).filter(Page.id.in_(list(final_scores))).all()
+
+    SEARCH_REQUESTS.inc('hit' if cached else 'miss')
+    trace.report(SEARCH_STAGE_SECONDS)
+    SEARCH_SECONDS.observe(trace.elapsed, mode)
+    if SLOW_QUERY_SECONDS and trace.elapsed >= SLOW_QUERY_SECONDS:
+        _record_slow_query(query_string, mode, limit, cached, len(ranked), trace)
 
     return [(page, final_scores[page.id]) for page in
-            sorted(results, key=lambda p: final_scores[p.id], reverse=True)]
\ No newline at end of file
+            sorted(results, key=lambda p: (-final_scores[p.id], p.id))]
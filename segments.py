@@ -0,0 +1,797 @@
+import os
+import sys
+import json
+import math
+import mmap
+import heapq
+import struct
+import threading
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from postings import PostingList, encode_varint, decode_varint, impact
+
+INDEX_DIR = os.environ.get('INDEX_DIR', 'index')  # Segment files and their manifest
+FORMAT_VERSION = 1
+MANIFEST = 'segments.json'
+LINK_GRAPH = 'links.npz'  # Link graph and PageRank kept alongside the segments, written by linkgraph.py
+MERGE_FACTOR = 10  # Segments of one size tier merged together
+MAX_DELETED_RATIO = 0.3  # Rewrite a segment once this share of its documents is superseded
+FIELDS = ('title', 'body')
+HEADER = struct.Struct('<4sII')  # magic, format version, entry count
+EXTENSIONS = {'tdi': b'STDI', 'doc': b'SDOC', 'pos': b'SPOS', 'vec': b'SVEC'}
+DELETES_MAGIC = b'SDEL'
+IMPACTS_MAGIC = b'SIMP'
+
+
+def term_key(field, stem):
+    """Dictionary key of a stem in one field; keys sort by field, then stem bytes."""
+    return bytes((field,)) + stem.encode('utf-8')
+
+
+def _u32_bytes(values):
+    data = array('I', values)
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return data.tobytes()
+
+
+def _f64_bytes(values):
+    data = array('d', values)
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return data.tobytes()
+
+
+def _u32_view(buf, offset, count):
+    """Little-endian uint32 array at offset, as a zero-copy view where possible."""
+    view = memoryview(buf)[offset:offset + 4 * count]
+    if sys.byteorder == 'little':
+        return view.cast('I')
+    data = array('I', view.tobytes())
+    data.byteswap()
+    return data
+
+
+def _f64_view(buf, offset, count):
+    data = array('d', memoryview(buf)[offset:offset + 8 * count].tobytes())
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return data
+
+
+def _read_header(buf, magic, path):
+    file_magic, version, count = HEADER.unpack_from(buf, 0)
+    if file_magic != magic or version != FORMAT_VERSION:
+        raise ValueError(f"{path} is not a version {FORMAT_VERSION} segment file")
+    return count
+
+
+def write_segment(directory, name, terms, vectors):
+    """Write an immutable segment.
+
+    terms yields (key, postings) in key order, postings being
+    (page_id, sorted positions) pairs in page id order; vectors lists
+    (page_id, [title {stem: freq}, body {stem: freq}]) in page id order.
+
+    .tdi  term dictionary: an offset table, then per key its df and the
+          location of its postings in .doc and .pos
+    .doc  per key: skip table (4 uint32 arrays), then (doc gap, freq) varints
+    .pos  per key: delta encoded positions
+    .vec  per page: the stems and frequencies of each field, so a page's
+          old terms can be found without scanning postings
+    """
+    base = os.path.join(directory, name)
+    entries = bytearray()
+    entry_offsets = []
+    with open(base + '.doc', 'wb') as doc_file, open(base + '.pos', 'wb') as pos_file:
+        doc_file.write(HEADER.pack(EXTENSIONS['doc'], FORMAT_VERSION, 0))
+        pos_file.write(HEADER.pack(EXTENSIONS['pos'], FORMAT_VERSION, 0))
+        doc_offset = pos_offset = HEADER.size
+        for key, postings in terms:
+            plist = PostingList(postings)
+            skips = b''.join(_u32_bytes(column) for column in (
+                plist.skip_docs, plist.skip_bases, plist.skip_doc_offsets, plist.skip_pos_offsets))
+            entry_offsets.append(len(entries))
+            encode_varint(len(key), entries)
+            entries += key
+            for value in (plist.df, doc_offset, len(plist.skip_docs), len(plist.doc_bytes),
+                          pos_offset, len(plist.pos_bytes)):
+                encode_varint(value, entries)
+            doc_file.write(skips)
+            doc_file.write(plist.doc_bytes)
+            pos_file.write(plist.pos_bytes)
+            doc_offset += len(skips) + len(plist.doc_bytes)
+            pos_offset += len(plist.pos_bytes)
+    entry_offsets.append(len(entries))
+    with open(base + '.tdi', 'wb') as f:
+        f.write(HEADER.pack(EXTENSIONS['tdi'], FORMAT_VERSION, len(entry_offsets) - 1))
+        f.write(_u32_bytes(entry_offsets))
+        f.write(entries)
+
+    data = bytearray()
+    vector_offsets = []
+    for _, maps in vectors:
+        vector_offsets.append(len(data))
+        for stem_freqs in maps:
+            encode_varint(len(stem_freqs), data)
+            for stem, freq in stem_freqs.items():
+                stem_bytes = stem.encode('utf-8')
+                encode_varint(len(stem_bytes), data)
+                data += stem_bytes
+                encode_varint(freq, data)
+    vector_offsets.append(len(data))
+    with open(base + '.vec', 'wb') as f:
+        f.write(HEADER.pack(EXTENSIONS['vec'], FORMAT_VERSION, len(vectors)))
+        f.write(_u32_bytes(page_id for page_id, _ in vectors))
+        f.write(_u32_bytes(vector_offsets))
+        f.write(data)
+
+
+def segment_files(directory, name):
+    return [os.path.join(directory, f'{name}.{extension}') for extension in EXTENSIONS]
+
+
+def impacts_file(name, imp_gen):
+    return f'{name}_{imp_gen}.imp'
+
+
+def write_impacts(directory, name, imp_gen, impacts):
+    """Write a segment's per-term impact bounds, in term dictionary order.
+
+    A term's bound is its postings' largest impact(), taken against the
+    document norms of the time. Norms change, so unlike the other segment
+    files this one is rewritten under a new generation when they do.
+    """
+    with open(os.path.join(directory, impacts_file(name, imp_gen)), 'wb') as f:
+        f.write(HEADER.pack(IMPACTS_MAGIC, FORMAT_VERSION, len(impacts)))
+        f.write(_f64_bytes(impacts))
+
+
+class Segment:
+    """Read-only, memory-mapped view of one segment's files.
+
+    imp_gen is the generation of its impact bounds file, 0 for none, in
+    which case every term's bound is infinite.
+    """
+
+    def __init__(self, directory, name, imp_gen=0):
+        self.name = name
+        self.imp_gen = imp_gen
+        self._maps = {}
+        for extension, magic in EXTENSIONS.items():
+            path = os.path.join(directory, f'{name}.{extension}')
+            with open(path, 'rb') as f:
+                self._maps[extension] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            count = _read_header(self._maps[extension], magic, path)
+            if extension == 'tdi':
+                self.term_count = count
+            elif extension == 'vec':
+                self.doc_count = count
+        tdi = self._maps['tdi']
+        self._term_offsets = _u32_view(tdi, HEADER.size, self.term_count + 1)
+        self._terms_start = HEADER.size + 4 * (self.term_count + 1)
+        vec = self._maps['vec']
+        self.doc_ids = _u32_view(vec, HEADER.size, self.doc_count)
+        self._vector_offsets = _u32_view(vec, HEADER.size + 4 * self.doc_count, self.doc_count + 1)
+        self._vectors_start = HEADER.size + 8 * self.doc_count + 4
+        self._impacts_file = self.impacts = None
+        if imp_gen:
+            path = os.path.join(directory, impacts_file(name, imp_gen))
+            with open(path, 'rb') as f:
+                self._impacts_file = f.read()
+            count = _read_header(self._impacts_file, IMPACTS_MAGIC, path)
+            self.impacts = _f64_view(self._impacts_file, HEADER.size, count)
+
+    def __len__(self):
+        return self.doc_count
+
+    def buffers(self):
+        """Return {extension: mapped file contents}, plus 'imp' for the impact bounds if any."""
+        buffers = dict(self._maps)
+        if self._impacts_file is not None:
+            buffers['imp'] = self._impacts_file
+        return buffers
+
+    def impact(self, index):
+        """Impact bound of a dictionary entry."""
+        return self.impacts[index] if self.impacts is not None else math.inf
+
+    def _key(self, index):
+        buf = self._maps['tdi']
+        length, offset = decode_varint(buf, self._terms_start + self._term_offsets[index])
+        return buf[offset:offset + length]
+
+    def find(self, key):
+        """Binary search the term dictionary; returns the entry index or -1."""
+        lo, hi = 0, self.term_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.term_count and self._key(lo) == key:
+            return lo
+        return -1
+
+    def keys(self):
+        for index in range(self.term_count):
+            yield self._key(index), index
+
+    def postings(self, index):
+        """Zero-copy PostingList of a dictionary entry."""
+        buf = self._maps['tdi']
+        length, offset = decode_varint(buf, self._terms_start + self._term_offsets[index])
+        offset += length
+        values = []
+        for _ in range(6):
+            value, offset = decode_varint(buf, offset)
+            values.append(value)
+        df, doc_offset, num_skips, doc_length, pos_offset, pos_length = values
+        skips = tuple(_u32_view(self._maps['doc'], doc_offset + 4 * num_skips * i, num_skips) for i in range(4))
+        doc_offset += 16 * num_skips
+        doc_bytes = memoryview(self._maps['doc'])[doc_offset:doc_offset + doc_length]
+        pos_bytes = memoryview(self._maps['pos'])[pos_offset:pos_offset + pos_length]
+        return PostingList.from_buffers(df, doc_bytes, pos_bytes, skips, self.impact(index))
+
+    def has_doc(self, page_id):
+        index = bisect_left(self.doc_ids, page_id)
+        return index < self.doc_count and self.doc_ids[index] == page_id
+
+    def _vector_at(self, index):
+        buf = self._maps['vec']
+        offset = self._vectors_start + self._vector_offsets[index]
+        maps = []
+        for _ in FIELDS:
+            count, offset = decode_varint(buf, offset)
+            stem_freqs = {}
+            for _ in range(count):
+                length, offset = decode_varint(buf, offset)
+                stem = buf[offset:offset + length].decode('utf-8')
+                stem_freqs[stem], offset = decode_varint(buf, offset + length)
+            maps.append(stem_freqs)
+        return maps
+
+    def vector(self, page_id):
+        """Return [title {stem: freq}, body {stem: freq}] of a page, or None."""
+        index = bisect_left(self.doc_ids, page_id)
+        if index < self.doc_count and self.doc_ids[index] == page_id:
+            return self._vector_at(index)
+        return None
+
+    def vectors(self):
+        for index in range(self.doc_count):
+            yield self.doc_ids[index], self._vector_at(index)
+
+
+def read_postings(segments, key):
+    """PostingList of key over (segment, deleted page ids) pairs, or None.
+
+    A key held by a single segment without deletions is returned as a view
+    of the mapped files; otherwise live postings are decoded and re-encoded.
+    """
+    parts = []
+    for segment, deleted in segments:
+        index = segment.find(key)
+        if index >= 0:
+            parts.append((segment.postings(index), deleted))
+    if not parts:
+        return None
+    if len(parts) == 1 and not parts[0][1]:
+        return parts[0][0]
+    postings = live_postings(parts)
+    return PostingList(postings, max(plist.max_impact for plist, _ in parts)) if postings else None
+
+
+def live_df(segments, key):
+    """Number of live documents holding key over (segment, deleted page ids) pairs.
+
+    Read from the term dictionaries; postings are only probed, through the
+    skip tables, for deleted pages.
+    """
+    df = 0
+    for segment, deleted in segments:
+        index = segment.find(key)
+        if index < 0:
+            continue
+        plist = segment.postings(index)
+        df += plist.df
+        if deleted:
+            cursor = plist.cursor()
+            for page_id in sorted(deleted):
+                if not cursor.advance(page_id):
+                    break
+                if cursor.doc == page_id:
+                    df -= 1
+    return df
+
+
+def live_postings(parts):
+    """Merge (PostingList, deleted page ids) pairs into sorted (page_id, positions) pairs."""
+    decoded = []
+    for plist, deleted in parts:
+        postings = []
+        cursor = plist.cursor()
+        while cursor.next():
+            if cursor.doc not in deleted:
+                postings.append((cursor.doc, cursor.positions()))
+        decoded.append(postings)
+    return list(heapq.merge(*decoded))
+
+
+def _tagged_keys(segment, tag):
+    for key, index in segment.keys():
+        yield key, tag, index
+
+
+def _live_vectors(segment, deleted):
+    for page_id, maps in segment.vectors():
+        if page_id not in deleted:
+            yield page_id, maps
+
+
+def live_terms(segments):
+    """Yield (key, live postings) over (segment, deleted page ids) pairs in key order."""
+    # Keys come out of every segment in sorted order, so a k-way merge groups them
+    streams = [_tagged_keys(segment, i) for i, (segment, _) in enumerate(segments)]
+    group_key, parts = None, []
+    for key, i, index in heapq.merge(*streams):
+        if key != group_key:
+            if parts:
+                postings = live_postings(parts)
+                if postings:
+                    yield group_key, postings
+            group_key, parts = key, []
+        parts.append((segments[i][0].postings(index), segments[i][1]))
+    if parts:
+        postings = live_postings(parts)
+        if postings:
+            yield group_key, postings
+
+
+def live_vectors(segments):
+    """Yield (page_id, [title {stem: freq}, body {stem: freq}]) over (segment, deleted page ids) pairs in page id order."""
+    return heapq.merge(*(_live_vectors(segment, deleted) for segment, deleted in segments), key=lambda item: item[0])
+
+
+class _LiveSegment:
+    """A published segment with the page ids superseded by newer segments."""
+    __slots__ = ('segment', 'deleted', 'del_gen')
+
+    def __init__(self, segment, deleted=frozenset(), del_gen=0):
+        self.segment = segment
+        self.deleted = deleted
+        self.del_gen = del_gen
+
+    @property
+    def live_count(self):
+        return len(self.segment) - len(self.deleted)
+
+
+class IndexStore:
+    """Set of published segments in one directory, plus their background merges.
+
+    The manifest lists the live segments and the generation of each one's
+    deletions file; replacing it is the commit point for new segments,
+    deletions and merges. A page lives in at most one segment: publishing a
+    segment marks its pages deleted everywhere else.
+
+    A segment whose pages are committed to SQL is first listed as pending
+    with prepare(), so a crash between the SQL commit and publish() leaves
+    it on disk; recover() then publishes or drops it once the caller knows
+    whether its batch committed.
+    """
+
+    def __init__(self, directory=INDEX_DIR, merge_factor=MERGE_FACTOR):
+        self.directory = directory
+        self.merge_factor = merge_factor
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._merges_done = threading.Condition(self._lock)
+        self._merge_thread = None
+        self._counter = 0
+        self._segments = []
+        self._pending = set()  # Names written or being written but not yet published
+        self._prepared = set()  # Names listed as pending in the manifest
+        self._unresolved = set()  # Names found pending at load, waiting for recover()
+        self._load()
+
+    def _path(self, file_name):
+        return os.path.join(self.directory, file_name)
+
+    def _load(self):
+        try:
+            with open(self._path(MANIFEST), 'r') as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = {'version': FORMAT_VERSION, 'counter': 0, 'segments': []}
+        if manifest['version'] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported index format {manifest['version']} in {self.directory}")
+        self._counter = manifest['counter']
+        self._prepared = set(manifest.get('pending', ()))
+        self._unresolved = set(self._prepared)
+        for info in manifest['segments']:
+            deleted = frozenset()
+            if info['del_gen']:
+                deleted = frozenset(self._read_deletes(info['name'], info['del_gen']))
+            segment = Segment(self.directory, info['name'], info.get('imp_gen', 0))
+            self._segments.append(_LiveSegment(segment, deleted, info['del_gen']))
+        self._remove_unreferenced()
+
+    def _read_deletes(self, name, del_gen):
+        path = self._path(f'{name}_{del_gen}.del')
+        with open(path, 'rb') as f:
+            buf = f.read()
+        count = _read_header(buf, DELETES_MAGIC, path)
+        return _u32_view(buf, HEADER.size, count).tolist()
+
+    def _write_deletes(self, live):
+        live.del_gen += 1
+        with open(self._path(f'{live.segment.name}_{live.del_gen}.del'), 'wb') as f:
+            f.write(HEADER.pack(DELETES_MAGIC, FORMAT_VERSION, len(live.deleted)))
+            f.write(_u32_bytes(sorted(live.deleted)))
+
+    def _write_manifest(self):
+        manifest = {
+            'version': FORMAT_VERSION,
+            'counter': self._counter,
+            'segments': [{'name': live.segment.name, 'docs': len(live.segment), 'del_gen': live.del_gen,
+                          'imp_gen': live.segment.imp_gen}
+                         for live in self._segments],
+            'pending': sorted(self._prepared),
+        }
+        # Write then rename so a crash leaves either the old or the new manifest
+        tmp_path = self._path(MANIFEST + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self._path(MANIFEST))
+
+    def _remove_unreferenced(self):
+        """Delete files no published segment refers to, e.g. from a crash or a superseded deletions file."""
+        keep = {MANIFEST, LINK_GRAPH}
+        for name in self._pending | self._prepared:
+            keep.update(os.path.basename(path) for path in segment_files(self.directory, name))
+            keep.add(impacts_file(name, 1))
+        for live in self._segments:
+            keep.update(os.path.basename(path) for path in segment_files(self.directory, live.segment.name))
+            keep.add(f'{live.segment.name}_{live.del_gen}.del')
+            keep.add(impacts_file(live.segment.name, live.segment.imp_gen))
+        for file_name in os.listdir(self.directory):
+            if file_name not in keep:
+                self._remove(self._path(file_name))
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass  # Still mapped on platforms that forbid it; removed on a later cleanup
+
+    def _open_new(self, name):
+        """Open a segment written by this store, with the impact bounds written alongside if any."""
+        imp_gen = 1 if os.path.exists(self._path(impacts_file(name, 1))) else 0
+        return Segment(self.directory, name, imp_gen)
+
+    def _remove_segment(self, name):
+        for path in segment_files(self.directory, name) + [self._path(impacts_file(name, 1))]:
+            self._remove(path)
+
+    def _next_name(self):
+        with self._lock:
+            self._counter += 1
+            name = f'seg_{self._counter:06d}'
+            self._pending.add(name)
+            return name
+
+    def write(self, docs, norms=None):
+        """Write (page_id, title_positions, body_positions) docs as a new, unpublished segment.
+
+        With norms, {page_id: (norm_title, norm_body)}, each term's impact
+        bound is written alongside.
+        """
+        docs = sorted({page_id: (title, body) for page_id, title, body in docs}.items())
+        postings = defaultdict(list)
+        impacts = defaultdict(float)
+        vectors = []
+        for page_id, maps in docs:
+            for field, stem_map in enumerate(maps):
+                max_tf = max((len(positions) for positions in stem_map.values()), default=0)
+                norm = norms[page_id][field] if norms and page_id in norms else 0
+                for stem, positions in stem_map.items():
+                    key = term_key(field, stem)
+                    postings[key].append((page_id, sorted(positions)))
+                    if max_tf and norm:
+                        impacts[key] = max(impacts[key], impact(len(positions), max_tf, norm))
+            vectors.append((page_id, [{stem: len(positions) for stem, positions in stem_map.items()}
+                                      for stem_map in maps]))
+        name = self._next_name()
+        terms = sorted(postings.items())
+        write_segment(self.directory, name, terms, vectors)
+        if norms is not None:
+            write_impacts(self.directory, name, 1, [impacts[key] for key, _ in terms])
+        return name
+
+    def prepare(self, name):
+        """List a written segment as pending in the manifest, before the caller commits its pages."""
+        with self._lock:
+            self._prepared.add(name)
+            self._write_manifest()
+
+    def prepared(self):
+        with self._lock:
+            return set(self._prepared)
+
+    @property
+    def needs_recovery(self):
+        return bool(self._unresolved)
+
+    def recover(self, committed):
+        """Publish the segments left pending at load whose names are in committed, and delete the rest."""
+        with self._lock:
+            unresolved, self._unresolved = sorted(self._unresolved), set()
+        for name in unresolved:
+            if name in committed:
+                self.publish(name)
+            else:
+                self.discard(name)
+        return [name for name in unresolved if name in committed]
+
+    def _drop_unresolved(self):
+        # Called with the lock held, when the segments are replaced wholesale
+        self._prepared -= self._unresolved
+        self._unresolved = set()
+
+    def discard(self, name):
+        with self._lock:
+            self._pending.discard(name)
+            if name in self._prepared:
+                self._prepared.discard(name)
+                self._write_manifest()
+        self._remove_segment(name)
+
+    def install(self, buffers):
+        """Replace every segment with one whose files' contents are given as {extension: bytes}.
+
+        An 'imp' entry, as from Segment.buffers(), holds its impact bounds file.
+        """
+        self.wait_for_merges()
+        name = self._next_name()
+        for extension, path in zip(EXTENSIONS, segment_files(self.directory, name)):
+            with open(path, 'wb') as f:
+                f.write(buffers[extension])
+        if buffers.get('imp') is not None:
+            with open(self._path(impacts_file(name, 1)), 'wb') as f:
+                f.write(buffers['imp'])
+        live = _LiveSegment(self._open_new(name))
+        with self._lock:
+            self._pending.discard(name)
+            self._drop_unresolved()
+            self._segments = [live]
+            self._write_manifest()
+            self._remove_unreferenced()
+
+    def rebuild(self, terms, vectors):
+        """Replace every segment with one written from terms and vectors, as taken by write_segment()."""
+        self.wait_for_merges()
+        name = self._next_name()
+        write_segment(self.directory, name, terms, vectors)
+        live = _LiveSegment(Segment(self.directory, name))
+        with self._lock:
+            self._pending.discard(name)
+            self._drop_unresolved()
+            self._segments = [live]
+            self._write_manifest()
+            self._remove_unreferenced()
+
+    def _supersede(self, page_ids, exclude):
+        """Mark page ids deleted in every segment but exclude that still holds them."""
+        for live in self._segments:
+            if live is exclude:
+                continue
+            hits = {page_id for page_id in page_ids
+                    if page_id not in live.deleted and live.segment.has_doc(page_id)}
+            if hits:
+                live.deleted = live.deleted | hits
+                self._write_deletes(live)
+
+    def publish(self, name):
+        """Make a written segment visible, superseding older copies of its pages."""
+        live = _LiveSegment(self._open_new(name))
+        with self._lock:
+            self._pending.discard(name)
+            self._prepared.discard(name)
+            self._supersede(live.segment.doc_ids, live)
+            self._segments.append(live)
+            self._write_manifest()
+            self._remove_unreferenced()
+            self._start_merges()
+
+    def snapshot(self):
+        """Return [(Segment, deleted page ids)] as currently published."""
+        with self._lock:
+            return [(live.segment, live.deleted) for live in self._segments]
+
+    def page_terms(self, page_id):
+        """Return [title {stem: freq}, body {stem: freq}] of a page's live copy, or None."""
+        for segment, deleted in self.snapshot():
+            if page_id not in deleted:
+                vector = segment.vector(page_id)
+                if vector is not None:
+                    return vector
+        return None
+
+    def has_page(self, page_id):
+        """Whether a published segment holds a live copy of the page."""
+        return any(page_id not in deleted and segment.has_doc(page_id) for segment, deleted in self.snapshot())
+
+    def iter_vectors(self):
+        """Yield (page_id, [title {stem: freq}, body {stem: freq}]) of every live page."""
+        for segment, deleted in self.snapshot():
+            yield from _live_vectors(segment, deleted)
+
+    def refresh_impacts(self, max_tf, norms):
+        """Recompute every live segment's impact bounds against new document norms.
+
+        max_tf and norms are (title, body) pairs of per-page sequences
+        indexed by page id. Each segment gets a new impacts file, swapped in
+        with the manifest; searches already running keep the bounds they
+        started with.
+        """
+        with self._lock:
+            lives = [(live, live.segment, live.deleted) for live in self._segments]
+        refreshed = []
+        for live, segment, deleted in lives:
+            index_of = dict(segment.keys())
+            impacts = [0.0] * segment.term_count
+            for page_id, maps in segment.vectors():
+                if page_id in deleted:
+                    continue
+                for field, stem_freqs in enumerate(maps):
+                    if page_id >= len(norms[field]) or not max_tf[field][page_id] or not norms[field][page_id]:
+                        continue
+                    page_max_tf, norm = max_tf[field][page_id], norms[field][page_id]
+                    for stem, freq in stem_freqs.items():
+                        index = index_of[term_key(field, stem)]
+                        impacts[index] = max(impacts[index], impact(freq, page_max_tf, norm))
+            refreshed.append((live, segment, impacts))
+
+        with self._lock:
+            for live, segment, impacts in refreshed:
+                # Skip segments merged away meanwhile
+                if live.segment is segment and live in self._segments:
+                    write_impacts(self.directory, segment.name, segment.imp_gen + 1, impacts)
+                    live.segment = Segment(self.directory, segment.name, segment.imp_gen + 1)
+            self._write_manifest()
+            self._remove_unreferenced()
+
+    def clear(self):
+        with self._lock:
+            self._drop_unresolved()
+            self._segments = []
+            self._write_manifest()
+            self._remove_unreferenced()
+
+    def _pick_merge(self):
+        """Choose segments to merge, or None. Called with the lock held."""
+        for live in self._segments:
+            if live.deleted and len(live.deleted) >= MAX_DELETED_RATIO * len(live.segment):
+                return [live]
+        tiers = defaultdict(list)
+        for live in self._segments:
+            tiers[int(math.log(max(live.live_count, 1), self.merge_factor))].append(live)
+        for tier in sorted(tiers):
+            if len(tiers[tier]) >= self.merge_factor:
+                return sorted(tiers[tier], key=lambda live: live.live_count)[:self.merge_factor]
+        return None
+
+    def _start_merges(self):
+        # Called with the lock held
+        if self._merge_thread is None and self._pick_merge():
+            self._merge_thread = threading.Thread(target=self._merge_loop, daemon=True)
+            self._merge_thread.start()
+
+    def _merge_loop(self):
+        try:
+            while True:
+                with self._lock:
+                    sources = self._pick_merge()
+                if not sources:
+                    break
+                self._merge(sources)
+        except Exception as e:
+            print(f"Error merging segments: {e}")
+        finally:
+            with self._lock:
+                self._merge_thread = None
+                self._merges_done.notify_all()
+
+    def _merge(self, sources):
+        """Rewrite the live pages of sources as one segment and swap it in."""
+        with self._lock:
+            snapshot = [(live.segment, live.deleted) for live in sources]
+
+        vectors = list(live_vectors(snapshot))
+        name = None
+        if vectors:
+            name = self._next_name()
+            write_segment(self.directory, name, live_terms(snapshot), vectors)
+            impacts = _merged_impacts(Segment(self.directory, name), [segment for segment, _ in snapshot])
+
+        with self._lock:
+            if name:
+                self._pending.discard(name)
+            if any(live not in self._segments for live in sources):
+                # Cleared or merged elsewhere meanwhile
+                if name:
+                    self._remove_segment(name)
+                return
+            position = self._segments.index(sources[0])
+            remaining = [live for live in self._segments if live not in sources]
+            if name:
+                if any(live.segment is not segment for live, (segment, _) in zip(sources, snapshot)):
+                    # Bounds refreshed while the merge ran replace the ones it started from
+                    impacts = _merged_impacts(Segment(self.directory, name), [live.segment for live in sources])
+                if impacts is not None:
+                    write_impacts(self.directory, name, 1, impacts)
+                merged = _LiveSegment(self._open_new(name))
+                # Pages superseded while the merge ran are superseded in the result too
+                late = set()
+                for live, (_, deleted) in zip(sources, snapshot):
+                    late |= live.deleted - deleted
+                if late:
+                    merged.deleted = frozenset(late)
+                    self._write_deletes(merged)
+                remaining.insert(min(position, len(remaining)), merged)
+            self._segments = remaining
+            self._write_manifest()
+            self._remove_unreferenced()
+
+    def wait_for_merges(self):
+        with self._lock:
+            while self._merge_thread is not None:
+                self._merges_done.wait()
+
+    def force_merge(self):
+        """Merge every segment into one, dropping deleted pages."""
+        self.wait_for_merges()
+        with self._lock:
+            sources = list(self._segments)
+        if len(sources) > 1 or (sources and sources[0].deleted):
+            self._merge(sources)
+
+
+def _merged_impacts(merged, sources):
+    """Impact bounds of a merge's result: each term's largest bound in the source segments, or None."""
+    if any(source.impacts is None for source in sources):
+        return None
+    index_of = dict(merged.keys())
+    impacts = [0.0] * merged.term_count
+    for source in sources:
+        for key, index in source.keys():
+            merged_index = index_of.get(key)
+            if merged_index is not None:
+                impacts[merged_index] = max(impacts[merged_index], source.impacts[index])
+    return impacts
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Return the shared IndexStore for INDEX_DIR, opening it on first use."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = IndexStore()
+    return _store
+
+
+def open_store(directory):
+    """Point the shared IndexStore at directory, e.g. for a benchmark's scratch index."""
+    global _store
+    with _store_lock:
+        _store = IndexStore(directory)
+    return _store
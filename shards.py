@@ -0,0 +1,318 @@
+import os
+import sys
+import json
+import time
+import heapq
+import secrets
+import argparse
+import threading
+import subprocess
+from itertools import islice
+from multiprocessing.connection import Listener, Client
+import numpy as np
+import search
+from docstats import COLUMNS, DocStats, snapshot_doc_stats
+from engine import FieldIndex, IndexEngine
+from linkgraph import get_link_graph
+from model import Page
+from segments import IndexStore, live_terms, live_vectors
+
+SHARD_DIR = os.environ.get('SHARD_DIR', 'shards')  # Shard indices written by `flask index-shard`
+SHARD_MANIFEST = 'shards.json'
+READY_PREFIX = 'SHARD_READY '  # Line a worker prints once it is listening, followed by host:port
+
+
+def shard_of(page_id, num_shards):
+    return page_id % num_shards
+
+
+def _shard_path(directory, shard):
+    return os.path.join(directory, f'shard-{shard}')
+
+
+def _shard_terms(segments, num_shards, shard):
+    for key, postings in live_terms(segments):
+        owned = [posting for posting in postings if shard_of(posting[0], num_shards) == shard]
+        if owned:
+            yield key, owned
+
+
+def _index_state(segments, num_docs):
+    """What shards record of the index they were split from: its page count and each segment's name, impact generation and deletions."""
+    return {'num_docs': num_docs,
+            'segments': [[segment.name, segment.imp_gen, len(deleted)] for segment, deleted in segments]}
+
+
+def write_shards(session, store, num_shards, directory=SHARD_DIR):
+    """Split the published index into num_shards document-partitioned shards.
+
+    Shard k owns the pages whose id is k modulo num_shards: it gets a
+    segment store holding just their postings and vectors, and a copy of
+    their doc stats and PageRank static scores. Norms and ranks stay those
+    computed against the whole collection, so a coordinator that sums the
+    shards' df counts scores every page exactly as the unsharded index
+    does. Returns the page count of each shard.
+    """
+    segments = store.snapshot()
+    doc_stats = snapshot_doc_stats(session)
+    num_docs = session.query(Page).count()
+    session.rollback()
+    graph = get_link_graph()
+    static_scores = None
+    if graph is not None:
+        ranked = graph.static_scores()[:doc_stats.capacity]
+        static_scores = np.zeros(doc_stats.capacity)
+        static_scores[:len(ranked)] = ranked
+    os.makedirs(directory, exist_ok=True)
+    counts = []
+    for shard in range(num_shards):
+        vectors = [(page_id, maps) for page_id, maps in live_vectors(segments)
+                   if shard_of(page_id, num_shards) == shard]
+        shard_store = IndexStore(_shard_path(directory, shard))
+        shard_store.rebuild(_shard_terms(segments, num_shards, shard), vectors)
+        shard_store.refresh_impacts((doc_stats.max_tf_title.tolist(), doc_stats.max_tf_body.tolist()),
+                                    (doc_stats.norm_title.tolist(), doc_stats.norm_body.tolist()))
+        page_ids = np.array([page_id for page_id, _ in vectors], dtype=np.int64)
+        page_ids = page_ids[page_ids < doc_stats.capacity]
+        columns = {name: getattr(doc_stats, name)[page_ids] for name, _ in COLUMNS}
+        if static_scores is not None:
+            columns['static_scores'] = static_scores[page_ids]
+        with open(_shard_path(directory, shard) + '.npz', 'wb') as f:
+            np.savez(f, page_ids=page_ids, **columns)
+        counts.append(len(vectors))
+
+    # Written last, so workers started meanwhile load the previous complete set
+    manifest = {'num_shards': num_shards, 'pages': counts, 'version': time.time_ns(),
+                'source': _index_state(segments, num_docs)}
+    tmp_path = os.path.join(directory, SHARD_MANIFEST + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(directory, SHARD_MANIFEST))
+    return counts
+
+
+def read_manifest(directory=SHARD_DIR):
+    with open(os.path.join(directory, SHARD_MANIFEST), 'r') as f:
+        return json.load(f)
+
+
+_manifest_cache = (None, None, None)  # (path, mtime_ns, manifest) of the last manifest read_manifest_cached() parsed
+
+
+def read_manifest_cached(directory=SHARD_DIR):
+    """read_manifest(), parsed again only when the file's modification time changes."""
+    global _manifest_cache
+    path = os.path.join(directory, SHARD_MANIFEST)
+    mtime = os.stat(path).st_mtime_ns
+    cached_path, cached_mtime, manifest = _manifest_cache
+    if cached_path != path or cached_mtime != mtime:
+        manifest = read_manifest(directory)
+        _manifest_cache = (path, mtime, manifest)
+    return manifest
+
+
+def load_shard(directory, shard):
+    """Return an IndexEngine over one shard's postings and doc stats."""
+    segments = IndexStore(_shard_path(directory, shard)).snapshot()
+    with np.load(_shard_path(directory, shard) + '.npz') as data:
+        page_ids = data['page_ids']
+        doc_stats = DocStats(int(page_ids.max()) + 1 if len(page_ids) else 0)
+        for name, _ in COLUMNS:
+            getattr(doc_stats, name)[page_ids] = data[name]
+        static_scores = None
+        if 'static_scores' in data.files:
+            static_scores = np.zeros(doc_stats.capacity)
+            static_scores[page_ids] = data['static_scores']
+    title = FieldIndex(0, segments)
+    body = FieldIndex(1, segments)
+    return IndexEngine(title, body, len(page_ids), doc_stats, static_scores=static_scores)
+
+
+def _handle(engine, request):
+    if request[0] == 'df':
+        dfs = {}
+        for stem in request[1]:
+            df = engine.df(stem)
+            if df:
+                dfs[stem] = df
+        return engine.num_docs, dfs
+    if request[0] == 'rank':
+        _, terms, phrases, collection, limit, mode = request
+        return search.rank(engine, terms, phrases, limit, mode, collection)
+    raise ValueError(f"Unknown shard request {request[0]!r}")
+
+
+def serve(directory, shard, address, authkey, once=False):
+    """Answer coordinator requests for one shard until stopped, or until the first coordinator leaves if once."""
+    engine = load_shard(directory, shard)
+    with Listener(address, authkey=authkey) as listener:
+        host, port = listener.address
+        print(f'{READY_PREFIX}{host}:{port}', flush=True)
+        # Nobody reads stdout past the ready line, so send later output to stderr rather than fill the pipe
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+        while True:
+            with listener.accept() as conn:
+                while True:
+                    try:
+                        request = conn.recv()
+                    except EOFError:
+                        break
+                    try:
+                        conn.send(('ok', _handle(engine, request)))
+                    except Exception as e:
+                        conn.send(('error', f"{type(e).__name__}: {e}"))
+            if once:
+                return
+
+
+class Coordinator:
+    """Scatter-gather search over shard workers, each holding part of the documents.
+
+    A query takes two round trips, sent to every shard before any reply is
+    read so the shards work in parallel: the first sums the shards' document
+    counts and df, the second has each shard score its pages with the
+    resulting global idf and return its local top results, which are then
+    merged. Queries are sent one at a time.
+    """
+
+    def __init__(self, connections, version=None, processes=()):
+        self.connections = connections
+        self.version = version
+        self.processes = list(processes)
+        self.broken = False  # A worker connection failed; get_coordinator() replaces broken coordinators
+        self._lock = threading.Lock()
+
+    def _scatter(self, request):
+        try:
+            for conn in self.connections:
+                conn.send(request)
+            # Read every reply, even after an error, so the next query's replies line up
+            replies = [conn.recv() for conn in self.connections]
+        except (OSError, EOFError):
+            self.broken = True
+            raise
+        for shard, (status, value) in enumerate(replies):
+            if status != 'ok':
+                raise RuntimeError(f"Shard {shard} failed: {value}")
+        return [value for _, value in replies]
+
+    def rank(self, terms, phrases, limit, mode='vectorized'):
+        """Return the top limit [(page_id, score)] across all shards for parsed query terms and phrases."""
+        with self._lock:
+            total_docs = 0
+            dfs = {}
+            for num_docs, shard_dfs in self._scatter(('df', search.query_df_stems(terms, phrases))):
+                total_docs += num_docs
+                for stem, (df_title, df_body) in shard_dfs.items():
+                    title_total, body_total = dfs.get(stem, (0, 0))
+                    dfs[stem] = (title_total + df_title, body_total + df_body)
+            results = self._scatter(('rank', terms, phrases, (total_docs, dfs), limit, mode))
+        # Each shard's list is already ordered by (-score, page_id), the order of the unsharded ranking
+        return list(islice(heapq.merge(*results, key=lambda item: (-item[1], item[0])), limit))
+
+    def close(self):
+        with self._lock:
+            for conn in self.connections:
+                conn.close()
+            for process in self.processes:
+                if self.broken:
+                    process.kill()
+                process.wait()
+
+
+def start_local_workers(directory=SHARD_DIR):
+    """Start one worker subprocess per shard in directory and return a Coordinator over them."""
+    manifest = read_manifest(directory)
+    authkey = secrets.token_bytes(16)
+    env = dict(os.environ, SHARD_AUTHKEY=authkey.hex())
+    processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), directory, str(shard), '--once'],
+                                  stdout=subprocess.PIPE, env=env, text=True)
+                 for shard in range(manifest['num_shards'])]
+    connections = []
+    try:
+        for shard, process in enumerate(processes):
+            # Workers load their shards in parallel; each reports its address once it is listening
+            for line in process.stdout:
+                if line.startswith(READY_PREFIX):
+                    host, port = line[len(READY_PREFIX):].strip().rsplit(':', 1)
+                    break
+            else:
+                raise RuntimeError(f"Shard {shard} worker exited with status {process.wait()}")
+            connections.append(Client((host, int(port)), authkey=authkey))
+    except Exception:
+        for conn in connections:
+            conn.close()
+        for process in processes:
+            process.kill()
+        raise
+    return Coordinator(connections, manifest['version'], processes)
+
+
+def connect_workers(addresses, authkey):
+    """Return a Coordinator over already running workers at "host:port,host:port,..."."""
+    connections = []
+    for address in addresses.split(','):
+        host, port = address.strip().rsplit(':', 1)
+        connections.append(Client((host, int(port)), authkey=authkey))
+    return Coordinator(connections, addresses)
+
+
+_coordinator = None
+_coordinator_lock = threading.Lock()
+_last_warning = None  # Why get_coordinator() last returned None, so each reason is logged once
+
+
+def _warn_once(key, message):
+    global _last_warning
+    if key != _last_warning:
+        _last_warning = key
+        print(message)
+
+
+def get_coordinator(workers, engine=None):
+    """Return the shared Coordinator for workers, "local" or worker addresses, or None to search in process.
+
+    Local workers are restarted when `flask index-shard` writes a new set
+    of shards. Until shards exist, or while they were split from another
+    index than engine's (a crawl or `flask index-load` has run since),
+    None is returned and a warning logged once. Remote workers need
+    SHARD_AUTHKEY set to the key they run with.
+    """
+    global _coordinator
+    with _coordinator_lock:
+        if workers == 'local':
+            try:
+                manifest = read_manifest_cached()
+            except FileNotFoundError:
+                _warn_once('missing', f"No shards in {SHARD_DIR}, searching in process; run `flask index-shard N`")
+                return None
+            if engine is not None and manifest.get('source') != _index_state(engine.title.segments, engine.num_docs):
+                _warn_once(('stale', manifest['version'], engine.generation),
+                           f"Shards in {SHARD_DIR} were split from an older index, searching in process; "
+                           f"rerun `flask index-shard {manifest['num_shards']}`")
+                return None
+            version = manifest['version']
+        else:
+            version = workers
+        if _coordinator is None or _coordinator.broken or _coordinator.version != version:
+            if _coordinator is not None:
+                _coordinator.close()
+                _coordinator = None
+            if workers == 'local':
+                _coordinator = start_local_workers()
+            else:
+                _coordinator = connect_workers(workers, bytes.fromhex(os.environ['SHARD_AUTHKEY']))
+        return _coordinator
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve one index shard to a search coordinator.')
+    parser.add_argument('directory', help='directory written by `flask index-shard`')
+    parser.add_argument('shard', type=int, help='number of the shard to serve')
+    parser.add_argument('--listen', default='127.0.0.1:0', help='host:port to accept the coordinator on')
+    parser.add_argument('--once', action='store_true', help='exit once the first coordinator disconnects')
+    args = parser.parse_args()
+    if 'SHARD_AUTHKEY' not in os.environ:
+        parser.error('set SHARD_AUTHKEY to a hex key shared with the coordinator')
+    host, port = args.listen.rsplit(':', 1)
+    serve(args.directory, args.shard, (host, int(port)), bytes.fromhex(os.environ['SHARD_AUTHKEY']), args.once)
@@ -0,0 +1,163 @@
+import threading
+import numpy as np
+from sqlalchemy.orm import Session
+from generation import index_generation
+from docstats import snapshot_doc_stats
+from segments import get_store
+
+SIMILAR_PAGES = 10  # Neighbours kept per page
+SIMILAR_QUERY_TERMS = 25  # Highest weighted body stems of a page matched against the other pages
+SIMILAR_MAX_DF_RATIO = 0.5  # Stems in more of the pages than this say little about similarity
+
+
+class SimilarityIndex:
+    """Precomputed top SIMILAR_PAGES neighbours of every page by body tf-idf cosine.
+
+    Each page's SIMILAR_QUERY_TERMS highest weighted stems are matched
+    against the full, norm-scaled body vectors of the other pages through
+    their postings, as a "more like this" query would. Rows are indexed
+    directly by page id and padded with -1.
+    """
+
+    def __init__(self, generation, neighbours, scores):
+        self.generation = generation
+        self.neighbours = neighbours
+        self.scores = scores
+
+    def get(self, page_id):
+        """Return [(page_id, score)] most similar first, or None for a page built without."""
+        if not 0 <= page_id < len(self.neighbours) or self.neighbours[page_id, 0] == -2:
+            return None
+        return [(int(other), float(score)) for other, score in zip(self.neighbours[page_id], self.scores[page_id])
+                if other >= 0]
+
+    @classmethod
+    def build(cls, session, generation, store=None):
+        store = store or get_store()
+        doc_stats = snapshot_doc_stats(session)
+        stem_ids = {}
+        page_ids, row_lengths, terms, freqs = [], [], [], []
+        for page_id, (_, body) in store.iter_vectors():
+            page_ids.append(page_id)
+            row_lengths.append(len(body))
+            for stem, frequency in body.items():
+                terms.append(stem_ids.setdefault(stem, len(stem_ids)))
+                freqs.append(frequency)
+
+        size = max(page_ids, default=-1) + 1
+        # -2 marks ids with no vector in this build, -1 pads short neighbour lists
+        neighbours = np.full((size, SIMILAR_PAGES), -2, dtype=np.int32)
+        scores = np.zeros((size, SIMILAR_PAGES), dtype=np.float32)
+        if not page_ids:
+            return cls(generation, neighbours, scores)
+
+        # Same weights as the indexed vectors, divided by the page's norm so dot products are cosines
+        docs = np.repeat(np.array(page_ids, dtype=np.int64), row_lengths)
+        terms = np.array(terms, dtype=np.int64)
+        df = np.bincount(terms, minlength=len(stem_ids))
+        max_tf = _column(doc_stats.max_tf_body, docs)
+        norms = _column(doc_stats.norm_body, docs)
+        usable = (max_tf > 0) & (norms > 0)
+        weights = np.zeros(len(docs))
+        weights[usable] = ((0.5 + 0.5 * (np.array(freqs, dtype=np.float64)[usable] / max_tf[usable]))
+                           * np.log(1 + len(page_ids) / df[terms[usable]]) / norms[usable])
+
+        # Postings of each stem, grouped by stem id
+        order = np.argsort(terms, kind='stable')
+        posting_docs = docs[order]
+        posting_weights = weights[order]
+        posting_starts = np.concatenate(([0], np.cumsum(df)))
+        query_dfs = df <= max(1, SIMILAR_MAX_DF_RATIO * len(page_ids))
+
+        row_start = 0
+        for page_id, length in zip(page_ids, row_lengths):
+            row = slice(row_start, row_start + length)
+            row_start += length
+            neighbours[page_id] = -1
+            row_terms, row_weights = terms[row], weights[row]
+            keep = query_dfs[row_terms] & (row_weights > 0)
+            row_terms, row_weights = row_terms[keep], row_weights[keep]
+            if len(row_terms) > SIMILAR_QUERY_TERMS:
+                top = np.argpartition(-row_weights, SIMILAR_QUERY_TERMS - 1)[:SIMILAR_QUERY_TERMS]
+                row_terms, row_weights = row_terms[top], row_weights[top]
+            if not len(row_terms):
+                continue
+
+            postings = np.concatenate([np.arange(posting_starts[t], posting_starts[t + 1]) for t in row_terms])
+            contributions = posting_weights[postings] * np.repeat(row_weights, df[row_terms])
+            candidates, inverse = np.unique(posting_docs[postings], return_inverse=True)
+            totals = np.bincount(inverse, weights=contributions)
+            others = (candidates != page_id) & (totals > 0)
+            candidates, totals = candidates[others], totals[others]
+            best = np.lexsort((candidates, -totals))[:SIMILAR_PAGES]
+            neighbours[page_id, :len(best)] = candidates[best]
+            scores[page_id, :len(best)] = totals[best]
+        return cls(generation, neighbours, scores)
+
+
+def _column(column, page_ids):
+    """column[page_ids], reading 0 for ids past its end."""
+    values = np.zeros(len(page_ids), dtype=np.float64)
+    inside = page_ids < len(column)
+    values[inside] = column[page_ids[inside]]
+    return values
+
+
+_index = None
+_index_lock = threading.Lock()
+_rebuild_done = threading.Condition(_index_lock)  # Notified whenever a rebuild finishes
+_rebuilding = False
+
+
+def _rebuild(bind, generation):
+    global _index, _rebuilding
+    session = Session(bind=bind)
+    try:
+        index = SimilarityIndex.build(session, generation)
+        with _index_lock:
+            if _index is None or _index.generation < generation:
+                _index = index
+    except Exception as e:
+        print(f"Error building similar pages index: {e}")
+    finally:
+        session.close()
+        with _rebuild_done:
+            _rebuilding = False
+            _rebuild_done.notify_all()
+
+
+def refresh_similar(session, wait=False):
+    """Rebuild the similar pages index if the index generation has moved on.
+
+    The rebuild runs on a background thread unless wait is set, in which
+    case a rebuild already running is waited for first. Only one rebuild
+    runs at a time; readers keep the previous index meanwhile.
+    """
+    global _rebuilding
+    generation = index_generation()
+    with _rebuild_done:
+        while True:
+            if _index is not None and _index.generation >= generation:
+                return
+            if not _rebuilding:
+                break
+            if not wait:
+                return
+            # The running rebuild may be for an older generation, or fail
+            _rebuild_done.wait()
+        _rebuilding = True
+    if wait:
+        _rebuild(session.get_bind(), generation)
+    else:
+        threading.Thread(target=_rebuild, args=(session.get_bind(), generation), daemon=True).start()
+
+
+def similar_pages(session, page_id):
+    """Return [(page_id, score)] of the pages most like page_id, or None if it isn't in the index yet.
+
+    The first call builds the index; later calls answer from the latest one
+    while a stale index is rebuilt in the background.
+    """
+    refresh_similar(session, wait=_index is None)
+    index = _index
+    return index.get(page_id) if index is not None else None
@@ -0,0 +1,242 @@
+import io
+import os
+import json
+import mmap
+import zlib
+import struct
+import tempfile
+from datetime import datetime
+import numpy as np
+from model import Page, DocumentStats, DuplicatePage, PageText, PageLink
+from postings import encode_varint, decode_varint
+from segments import EXTENSIONS, Segment, write_segment
+from linkgraph import LinkGraph, get_link_graph, install_link_graph, reset_link_graph
+
+SNAPSHOT_MAGIC = b'IDXSNAP\x00'
+SNAPSHOT_VERSION = 1
+HEADER = struct.Struct('<8sII')  # magic, snapshot version, section count
+SECTION = struct.Struct('<8sQQ')  # name, offset, length
+COUNT = struct.Struct('<Q')
+ALIGNMENT = 8  # Sections start on 8 byte boundaries so columns can be viewed in place
+
+# Per-page numeric columns, stored as little-endian arrays
+STATS_COLUMNS = (
+    ('id', '<i4'),
+    ('max_tf_title', '<i4'),
+    ('max_tf_body', '<i4'),
+    ('size', '<i4'),
+    ('norm_title', '<f8'),
+    ('norm_body', '<f8'),
+)
+# Page metadata kept as compressed JSON, in the same order as the stats columns
+PAGE_FIELDS = ('url', 'title', 'last_modified', 'last_modified_at', 'etag', 'keywords', 'parent_id', 'simhash')
+
+
+def _segment_buffers(store):
+    """Contents of the store's files after compacting it into one segment."""
+    store.force_merge()
+    segments = store.snapshot()
+    if len(segments) > 1 or (segments and segments[0][1]):
+        raise RuntimeError("The index changed while it was being compacted; try again once crawling stops")
+    if segments:
+        return {extension: bytes(buffer) for extension, buffer in segments[0][0].buffers().items()}
+    with tempfile.TemporaryDirectory() as directory:
+        write_segment(directory, 'empty', [], [])
+        return {extension: bytes(buffer) for extension, buffer in Segment(directory, 'empty').buffers().items()}
+
+
+def _stats_section(pages):
+    out = bytearray(COUNT.pack(len(pages)))
+    for i, (name, dtype) in enumerate(STATS_COLUMNS):
+        out += np.asarray([page[i] or 0 for page in pages], dtype=dtype).tobytes()
+    return bytes(out)
+
+
+def _pages_section(pages):
+    records = []
+    for page in pages:
+        record = dict(zip(PAGE_FIELDS, page[len(STATS_COLUMNS):]))
+        if record['last_modified_at'] is not None:
+            record['last_modified_at'] = record['last_modified_at'].isoformat()
+        records.append(record)
+    return zlib.compress(json.dumps(records).encode('utf-8'))
+
+
+def _rows_section(rows):
+    return zlib.compress(json.dumps([list(row) for row in rows]).encode('utf-8'))
+
+
+def _texts_section(rows):
+    # PageText bodies are already zlib compressed, so they are stored as-is
+    out = bytearray(COUNT.pack(len(rows)))
+    for page_id, text in rows:
+        encode_varint(page_id, out)
+        encode_varint(len(text), out)
+        out += text
+    return bytes(out)
+
+
+def _graph_section(graph):
+    out = io.BytesIO()
+    graph.write(out)
+    return out.getvalue()
+
+
+def _df_section(rows):
+    out = bytearray(COUNT.pack(len(rows)))
+    for stem, df_title, df_body in rows:
+        stem_bytes = stem.encode('utf-8')
+        encode_varint(len(stem_bytes), out)
+        out += stem_bytes
+        encode_varint(df_title or 0, out)
+        encode_varint(df_body or 0, out)
+    return bytes(out)
+
+
+def write_snapshot(path, session, store):
+    """Write the segments, DocumentStats, per-page stats and link graph into one versioned file.
+
+    The layout is a header, a table of (name, offset, length) sections, then
+    the sections: the compacted segment's tdi/doc/pos/vec/imp files as-is, the
+    page stats columns, the df table, the compressed page metadata, links
+    and near-duplicate URLs, the pages' clean text, and the ranked link
+    graph if there is one.
+    Returns the number of pages written.
+    """
+    sections = _segment_buffers(store)
+    columns = [getattr(Page, name) for name, _ in STATS_COLUMNS] + [getattr(Page, name) for name in PAGE_FIELDS]
+    pages = session.query(*columns).order_by(Page.id).all()
+    sections['stats'] = _stats_section(pages)
+    sections['pages'] = _pages_section(pages)
+    sections['df'] = _df_section(session.query(DocumentStats.stem, DocumentStats.df_title, DocumentStats.df_body)
+                                 .order_by(DocumentStats.stem).all())
+    sections['links'] = _rows_section(session.query(PageLink.source_id, PageLink.target_url)
+                                      .order_by(PageLink.source_id, PageLink.target_url).all())
+    sections['duplicates'] = _rows_section(session.query(DuplicatePage.url, DuplicatePage.duplicate_of)
+                                            .order_by(DuplicatePage.url).all())
+    sections['texts'] = _texts_section(session.query(PageText.page_id, PageText.text).order_by(PageText.page_id).all())
+    session.rollback()
+    graph = get_link_graph()
+    if graph is not None:
+        sections['graph'] = _graph_section(graph)  # Don't hold a read transaction while writing the file
+
+    offset = HEADER.size + SECTION.size * len(sections)
+    table = []
+    for name, data in sections.items():
+        offset += -offset % ALIGNMENT
+        table.append((name, offset, len(data)))
+        offset += len(data)
+
+    # Write then rename so readers never see a partial snapshot
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(table)))
+        for name, offset, length in table:
+            f.write(SECTION.pack(name.encode('ascii'), offset, length))
+        for name, offset, length in table:
+            f.write(b'\0' * (offset - f.tell()))
+            f.write(sections[name])
+    os.replace(tmp_path, path)
+    return len(pages)
+
+
+def open_snapshot(path):
+    """Map a snapshot file and return {section name: memoryview}."""
+    with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, count = HEADER.unpack_from(buf, 0)
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError(f"{path} is not an index snapshot")
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f"{path} is snapshot version {version}, expected {SNAPSHOT_VERSION}")
+    view = memoryview(buf)
+    sections = {}
+    for i in range(count):
+        name, offset, length = SECTION.unpack_from(buf, HEADER.size + i * SECTION.size)
+        sections[name.rstrip(b'\0').decode('ascii')] = view[offset:offset + length]
+    return sections
+
+
+def read_stats(section):
+    """Return {column: numpy array} viewing the stats section without copying."""
+    count, = COUNT.unpack_from(section, 0)
+    offset = COUNT.size
+    columns = {}
+    for name, dtype in STATS_COLUMNS:
+        columns[name] = np.frombuffer(section, dtype=dtype, count=count, offset=offset)
+        offset += count * np.dtype(dtype).itemsize
+    return columns
+
+
+def read_df(section):
+    count, = COUNT.unpack_from(section, 0)
+    offset = COUNT.size
+    rows = []
+    for _ in range(count):
+        length, offset = decode_varint(section, offset)
+        stem = bytes(section[offset:offset + length]).decode('utf-8')
+        df_title, offset = decode_varint(section, offset + length)
+        df_body, offset = decode_varint(section, offset)
+        rows.append({'stem': stem, 'df_title': df_title, 'df_body': df_body})
+    return rows
+
+
+def read_texts(section):
+    count, = COUNT.unpack_from(section, 0)
+    offset = COUNT.size
+    rows = []
+    for _ in range(count):
+        page_id, offset = decode_varint(section, offset)
+        length, offset = decode_varint(section, offset)
+        rows.append({'page_id': page_id, 'text': bytes(section[offset:offset + length])})
+        offset += length
+    return rows
+
+
+def load_snapshot(path, session, store):
+    """Replace the pages and everything derived from them with a snapshot's. Returns the page count."""
+    sections = open_snapshot(path)
+    stats = read_stats(sections['stats'])
+    records = json.loads(zlib.decompress(sections['pages']))
+    rows = []
+    for i, record in enumerate(records):
+        row = {name: stats[name][i].item() for name, _ in STATS_COLUMNS}
+        row.update(record)
+        if row['last_modified_at'] is not None:
+            row['last_modified_at'] = datetime.fromisoformat(row['last_modified_at'])
+        rows.append(row)
+
+    try:
+        session.query(DuplicatePage).delete()
+        session.query(PageText).delete()
+        session.query(PageLink).delete()
+        session.query(Page).delete()
+        session.query(DocumentStats).delete()
+        if rows:
+            session.execute(Page.__table__.insert(), rows)
+        df_rows = read_df(sections['df'])
+        if df_rows:
+            session.execute(DocumentStats.__table__.insert(), df_rows)
+        # Snapshots written before links, duplicates and texts were kept lack their sections
+        links = json.loads(zlib.decompress(sections['links'])) if 'links' in sections else []
+        if links:
+            session.execute(PageLink.__table__.insert(),
+                            [{'source_id': source_id, 'target_url': target_url} for source_id, target_url in links])
+        duplicates = json.loads(zlib.decompress(sections['duplicates'])) if 'duplicates' in sections else []
+        if duplicates:
+            session.execute(DuplicatePage.__table__.insert(),
+                            [{'url': url, 'duplicate_of': duplicate_of} for url, duplicate_of in duplicates])
+        texts = read_texts(sections['texts']) if 'texts' in sections else []
+        if texts:
+            session.execute(PageText.__table__.insert(), texts)
+        session.flush()
+        store.install({extension: sections.get(extension) for extension in (*EXTENSIONS, 'imp')})
+        if 'graph' in sections:
+            install_link_graph(LinkGraph.load(io.BytesIO(sections['graph'])))
+        else:
+            reset_link_graph()
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    return len(rows)
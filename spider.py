@@ -1,164 +1,523 @@
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
-from urllib.parse import urljoin, urlparse
-import re
+from urllib.parse import urljoin, urlsplit
+import time
+import os
 import queue
-from threading import Lock, Thread
+import multiprocessing
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock, BoundedSemaphore, Thread
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from collections import Counter
-from model import db, Page, TitleInvertedIndex, BodyInvertedIndex
-from indexer import stemmer, process_terms, update_inverted_index, STOP_WORDS, update_stats
+from model import db, Page, DuplicatePage, PageText, PageLink
+from indexer import process_terms, IndexBatch, load_page_terms, recompute_norms, recover_segments
+from generation import bump_generation
+from docstats import record_page, reset_doc_stats
+from tokenizer import iter_tokens
+from pagetext import body_strings, clean_text, compress_text
+from frontier import Frontier, canonicalize_url
+from fingerprint import FingerprintIndex, simhash, to_signed
+from linkgraph import update_link_graph
+from segments import get_store
+from writer import get_writer
+from metrics import Counter as MetricCounter, Histogram, Trace
 
-def crawl(start_url, socketio):
-    domain = urlparse(start_url).netloc
-    url_queue = queue.Queue()
-    url_queue.put((start_url, None))
-    visited = set()
-    db_lock = Lock()
-    num_workers = 1
-    poison_pill = (None, None)
+INDEX_BATCH_SIZE = 20  # Pages per indexing transaction
+NUM_FETCHERS = 8  # Concurrent in-flight requests
+PER_HOST_CONNECTIONS = 4  # Concurrent requests allowed to one host
+PER_HOST_DELAY = 0.0  # Minimum seconds between request starts to one host
+FETCH_TIMEOUT = (5, 20)  # (connect, read) seconds
+FETCHED_QUEUE_SIZE = 32  # Fetched pages waiting to be parsed and indexed
+NUM_PARSERS = os.cpu_count() or 1  # Parser processes; 0 parses on the indexer thread
+# Parser processes are never forked from the crawler, whose threads may hold locks a forked child would inherit
+PARSER_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+NORM_REFRESH_RATIO = 0.25  # Recompute all norms once this fraction of pages changed...
+NORM_REFRESH_MIN_PAGES = 100  # ...and at least this many
 
-    Session = sessionmaker(bind=db.engine)
+CRAWL_STAGE_SECONDS = Histogram('crawler_stage_seconds', 'Time spent in each crawler stage', ('stage',))
+CRAWL_PAGES = MetricCounter('crawler_pages_total', 'URLs handled by the crawler, by outcome', ('outcome',))
+CRAWL_BYTES = MetricCounter('crawler_fetched_bytes_total', 'Bytes of page bodies downloaded')
 
-    def worker():
+
+class HostThrottle:
+    """Per-host politeness: caps concurrent requests and spaces out their starts."""
+
+    def __init__(self, max_connections=PER_HOST_CONNECTIONS, delay=PER_HOST_DELAY):
+        self.max_connections = max_connections
+        self.delay = delay
+        self._lock = Lock()
+        self._slots = {}
+        self._next_start = {}
+
+    @contextmanager
+    def slot(self, host):
+        with self._lock:
+            slots = self._slots.setdefault(host, BoundedSemaphore(self.max_connections))
+        slots.acquire()
+        try:
+            with self._lock:
+                now = time.monotonic()
+                start = max(now, self._next_start.get(host, now))
+                self._next_start[host] = start + self.delay
+            if start > now:
+                time.sleep(start - now)
+            yield
+        finally:
+            slots.release()
+
+
+def make_http_session(pool_size=NUM_FETCHERS):
+    """Shared keep-alive session whose connection pool fits every fetcher."""
+    http = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    http.mount('http://', adapter)
+    http.mount('https://', adapter)
+    return http
+
+
+def parse_page(url, html, domain, trace=None):
+    """Extract the title, stem positions, clean body text and canonical same-domain links of a fetched page."""
+    trace = trace or Trace()
+    with trace.stage('parse'):
+        soup = BeautifulSoup(html, 'html.parser')
+        title = soup.title.string if soup.title and soup.title.string else 'No Title'
+
+    with trace.stage('tokenize'):
+        # Process title
+        title_positions, _ = process_terms(iter_tokens([title]))
+
+        # Process body, tokenizing its text nodes one by one instead of joining them
+        strings = body_strings(soup)
+        body_positions, size = process_terms(iter_tokens(strings))
+        text = clean_text(strings)
+
+    with trace.stage('parse'):
+        links = set()
+        for link in soup.find_all('a', href=True):
+            absolute_url = canonicalize_url(urljoin(url, link['href']))
+            parsed = urlsplit(absolute_url)
+            if parsed.netloc == domain and parsed.scheme in ('http', 'https'):
+                links.add(absolute_url)
+
+    return title, title_positions, body_positions, size, text, links
+
+
+def parse_for_index(url, html, domain):
+    """Parse a page into the compact fields the indexer writes.
+
+    Runs in a parser process, so only plain stems, positions, links, the
+    compressed body text, the body's SimHash and the parse/tokenize timings
+    cross back to the crawler.
+    """
+    trace = Trace()
+    title, title_positions, body_positions, size, text, links = parse_page(url, html, domain, trace)
+    max_tf_title = max(len(v) for v in title_positions.values()) if title_positions else 0
+    max_tf_body = max(len(v) for v in body_positions.values()) if body_positions else 0
+    body_counts = {stem: len(positions) for stem, positions in body_positions.items()}
+    keywords = Counter(body_counts).most_common(10)
+    with trace.stage('fingerprint'):
+        fingerprint = simhash(body_positions)
+    stats = (max_tf_title, max_tf_body, size)
+    return (title, title_positions, body_positions, links, keywords, stats, fingerprint,
+            compress_text(text), trace.stages)
+
+
+def make_parser_pool(num_parsers):
+    """Return a process pool for parse_for_index() that starts its workers without forking the crawler."""
+    context = multiprocessing.get_context(PARSER_START_METHOD)
+    if PARSER_START_METHOD == 'forkserver':
+        # Workers fork from a server that has already imported __main__ and this module
+        context.set_forkserver_preload(['__main__', __name__])
+    return ProcessPoolExecutor(num_parsers, mp_context=context)
+
+
+class InlineResult:
+    """Already computed stand-in for a parser future."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def result(self):
+        return self.value
+
+
+def parse_http_date(value):
+    """Parse an HTTP date header into a naive UTC datetime, or None."""
+    if not value:
+        return None
+    try:
+        parsed = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def conditional_headers(etag, last_modified):
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified and last_modified != 'N/A':
+        headers['If-Modified-Since'] = last_modified
+    return headers
+
+
+def is_modified(known, etag, last_modified):
+    """Compare a 200 response's validators with the stored (etag, last_modified, last_modified_at, id) row."""
+    known_etag, _, known_modified_at = known[:3]
+    if etag and known_etag:
+        return etag != known_etag
+    modified_at = parse_http_date(last_modified)
+    if modified_at and known_modified_at:
+        return modified_at > known_modified_at
+    # Without comparable validators assume the page changed
+    return True
+
+
+def write_page_texts(session, pending):
+    """Store the compressed body text of batched pages with one executemany, for chat context."""
+    stmt = sqlite_insert(PageText.__table__)
+    stmt = stmt.on_conflict_do_update(index_elements=['page_id'], set_={'text': stmt.excluded.text})
+    session.execute(stmt, [{'page_id': page_id, 'text': page_text} for _, page_id, *_, page_text in pending])
+
+
+def write_page_links(session, pending):
+    """Replace the stored out-links of batched pages, for the link graph."""
+    page_ids = [page_id for _, page_id, *_ in pending]
+    session.query(PageLink).filter(PageLink.source_id.in_(page_ids)).delete(synchronize_session=False)
+    rows = [{'source_id': page_id, 'target_url': link} for _, page_id, _, links, *_ in pending for link in links]
+    if rows:
+        session.execute(PageLink.__table__.insert(), rows)
+
+
+def crawl(start_url, socketio, num_fetchers=NUM_FETCHERS, fetch_cache=None, num_parsers=NUM_PARSERS,
+          frontier_path=None):
+    """Crawl the domain of start_url, indexing every page reachable from it.
+
+    With frontier_path the frontier is kept in that file and an interrupted
+    crawl from the same start_url resumes where it was last checkpointed.
+    """
+    domain = urlsplit(canonicalize_url(start_url)).netloc
+    frontier = Frontier(frontier_path) if frontier_path else Frontier()
+    remaining = frontier.start(start_url)
+    if remaining:
+        print(f"Resuming crawl of {start_url} with {remaining} URLs left")
+    fetched_queue = queue.Queue(maxsize=FETCHED_QUEUE_SIZE)
+
+    Session = sessionmaker(bind=db.engine)  # Fetchers' reads; writes go through the writer thread
+    writer = get_writer(db.engine)
+    http = make_http_session(num_fetchers)
+    count_session = Session()
+    try:
+        recover_segments(count_session)
+        norm_state = {'pages': count_session.query(Page).count(), 'changed': 0}
+        fingerprints = FingerprintIndex.load(count_session)  # Only touched by batch writes, one at a time
+    finally:
+        count_session.close()
+    throttle = HostThrottle()
+    parsers = make_parser_pool(num_parsers) if num_parsers else None
+    if parsers is not None:
+        # Start the fork server and a first parser now rather than on the first fetched page
+        parsers.submit(int).result()
+
+    def submit_parse(base_url, html):
+        if parsers is None:
+            return InlineResult(parse_for_index(base_url, html, domain))
+        return parsers.submit(parse_for_index, base_url, html, domain)
+
+    def revisit_children(session, known, depth):
+        """Queue the stored children of an unchanged page so they get revalidated too."""
+        if not known:
+            return
+        child_urls = [row[0] for row in session.query(Page.url).filter_by(parent_id=known.id)]
+        session.rollback()
+        for child_url in child_urls:
+            frontier.add(child_url, depth + 1, known.id)
+
+    def fetcher():
         session = Session()
         try:
             while True:
-                url = None
+                # The frontier hands out each URL once; None means the crawl is over
+                entry = frontier.get()
+                if entry is None:
+                    break
+                url, depth, parent_id = entry
+
+                handed_off = False
                 try:
-                    # Get URL from queue with timeout
-                    url, parent_id = url_queue.get(timeout=100)
-                    # Check for poison pill immediately
-                    if url is None:
-                        break
-
-                    page_record = session.query(Page).filter_by(url=url).first()
-                    already_visited = url in visited
-                    if page_record:
-                        # Check if the page has been modified since last crawl
-                        try:
-                            head_response = requests.head(url, timeout=100)
-                            current_modified = head_response.headers.get('Last-Modified')
-                            if current_modified and current_modified > page_record.last_modified:
-                                # Page has been updated, so we should crawl it again
-                                already_visited = False
-                            else:
-                                already_visited = True
-                        except requests.RequestException:
-                            # If we can't check, assume it hasn't changed
-                            already_visited = True
-
-
-                    # Mark as visited before processing to prevent race conditions
-                    if not already_visited:
-                        visited.add(url)
-
-                    if already_visited:
+                    known = session.query(Page.etag, Page.last_modified, Page.last_modified_at, Page.id).filter_by(url=url).first()
+                    session.rollback()  # Don't hold a read transaction across the fetch
+                    if known and not get_store().has_page(known.id):
+                        # Stored but not in the index, e.g. by an older version: fetch in full to index it
+                        known = None
+                    cached = fetch_cache.get(url) if fetch_cache and not known else None
+
+                    # Revalidate known or cached pages with a single conditional GET
+                    if known:
+                        headers = conditional_headers(known[0], known[1])
+                    elif cached:
+                        headers = conditional_headers(cached['etag'], cached['last_modified'])
+                    else:
+                        headers = {}
+
+                    waiting = time.perf_counter()
+                    with throttle.slot(urlsplit(url).netloc):
+                        CRAWL_STAGE_SECONDS.observe(time.perf_counter() - waiting, 'lock_wait')
+                        with CRAWL_STAGE_SECONDS.time('fetch'):
+                            response = http.get(url, headers=headers, timeout=FETCH_TIMEOUT)
+                    CRAWL_BYTES.inc(amount=len(response.content))
+
+                    # A redirect to a page this crawl already has is a duplicate
+                    base_url = canonicalize_url(response.url)
+                    if base_url != url and not frontier.mark_seen(base_url, depth, parent_id):
+                        CRAWL_PAGES.inc('duplicate')
                         continue
-                    # Fetch page content
-                    response = requests.get(url, timeout=100)
-                    response.raise_for_status()
-
-                    # Parse content
-                    soup = BeautifulSoup(response.text, 'html.parser')
-                    title = soup.title.string if soup.title else 'No Title'
-                    last_modified = response.headers.get('Last-Modified', 'N/A')
-
-                    # Process title
-                    title_terms = re.findall(r'\w+', title.lower())
-                    title_stems, title_positions = process_terms(title_terms)
-
-                    # Process body
-                    body = soup.find('body')
-                    body_text = body.get_text() if body else ''
-                    body_terms = re.findall(r'\w+', body_text.lower())
-                    body_stems, body_positions = process_terms(body_terms)
-
-                    with db_lock:
-                        try:
-                            # Start transaction
-                            session.begin_nested()
-
-                            # Create page record
-                            page = Page(
-                                url=url,
-                                title=title,
-                                last_modified=last_modified,
-                                size=len(body_terms),
-                                keywords=Counter(
-                                    {stem: len(positions) for stem, positions in body_positions.items()}).most_common(
-                                    10),
-                                parent_id=parent_id,
-                                max_tf_title=max(len(v) for v in title_positions.values()) if title_positions else 0,
-                                max_tf_body=max(len(v) for v in body_positions.values()) if body_positions else 0
-                            )
-                            session.add(page)
-                            session.flush()
-
-                            # Update inverted indices
-                            update_inverted_index(title_positions, page.id, TitleInvertedIndex, session)
-                            update_inverted_index(body_positions, page.id, BodyInvertedIndex, session)
-                            update_stats(title_positions, 'title', session)
-                            update_stats(body_positions, 'body', session)
-
-                            # Extract links before committing
-                            links = set()
-                            for link in soup.find_all('a', href=True):
-                                absolute_url = urljoin(url, link['href'])
-                                parsed = urlparse(absolute_url)
-                                if parsed.netloc == domain and parsed.scheme in ('http', 'https'):
-                                    links.add(absolute_url)
-
-                            session.commit()
-
-                            # Queue new URLs only after successful commit
-                            for link in links:
-                                url_queue.put((link, page.id))
-
-                            socketio.emit('update', {'data': 'Crawled ' + url})
-
-                        except Exception as e:
-                            session.rollback()
-                            print(f"Database error processing {url}: {e}")
-
-                except queue.Empty:
-                    # Just continue waiting for new items
-                    continue
+
+                    if response.status_code == 304:
+                        if not cached:
+                            CRAWL_PAGES.inc('not_modified')
+                            revisit_children(session, known, depth)
+                            continue
+                        # Not indexed yet but the cached body is current: index it without a transfer
+                        text, etag, last_modified = cached['text'], cached['etag'], cached['last_modified']
+                    else:
+                        response.raise_for_status()
+                        text = response.text
+                        etag = response.headers.get('ETag')
+                        last_modified = response.headers.get('Last-Modified', 'N/A')
+                        if known and not is_modified(known, etag, last_modified):
+                            # Server ignored the validators but the page is unchanged
+                            CRAWL_PAGES.inc('unchanged')
+                            revisit_children(session, known, depth)
+                            continue
+                        if fetch_cache:
+                            fetch_cache.put(url, etag, last_modified, text)
+
+                    # Parse in the process pool; the indexer collects results in fetch order
+                    parsed = submit_parse(base_url, text)
+                    with CRAWL_STAGE_SECONDS.time('queue_wait'):
+                        fetched_queue.put((url, depth, parent_id, parsed, etag, last_modified))
+                    handed_off = True
+
                 except requests.RequestException as e:
+                    CRAWL_PAGES.inc('fetch_error')
                     print(f"Request error for {url}: {e}")
                 except Exception as e:
+                    CRAWL_PAGES.inc('fetch_error')
                     print(f"General error processing {url}: {e}")
                 finally:
-                    # Always mark task as done if we got a URL from the queue
-                    if url is not None:
-                        url_queue.task_done()
+                    # The indexer marks handed-off URLs done once their links are queued
+                    if not handed_off:
+                        frontier.task_done(url)
         finally:
             session.close()
 
+    def refresh_norms():
+        """Recompute every page's vector norms and publish them to readers."""
+        try:
+            with CRAWL_STAGE_SECONDS.time('norms'):
+                norm_state['pages'] = writer.run(lambda session: len(recompute_norms(session)))
+        except Exception as e:
+            print(f"Database error refreshing norms: {e}")
+            return
+        norm_state['changed'] = 0
+        reset_doc_stats()
+        bump_generation()
+
+    def store_page(session, batch, pending, url, depth, parent_id, parsed, etag, last_modified):
+        """Write one parsed page's row in a savepoint and add it to the batch; runs on the writer thread."""
+        try:
+            (title, title_positions, body_positions, links, keywords, stats, fingerprint, page_text,
+             timings) = parsed
+            max_tf_title, max_tf_body, size = stats
+            page_fields = dict(
+                title=title,
+                last_modified=last_modified,
+                last_modified_at=parse_http_date(last_modified),
+                etag=etag,
+                size=size,
+                keywords=keywords,
+                max_tf_title=max_tf_title,
+                max_tf_body=max_tf_body,
+                simhash=None if fingerprint is None else to_signed(fingerprint)
+            )
+
+            # Savepoint so a bad page doesn't discard the rest of the batch. The page is added to the
+            # batch inside it, so its row and validators are only kept once it will be indexed.
+            with session.begin_nested():
+                page = session.query(Page).filter_by(url=url).first()
+                # New pages whose body nearly matches an indexed or batched one are not indexed
+                original_id = None
+                if not page and fingerprint is not None:
+                    original_id = fingerprints.find(fingerprint)
+                if original_id is not None:
+                    session.merge(DuplicatePage(url=url, duplicate_of=original_id))
+                    session.flush()
+                else:
+                    if page:
+                        # Changed page: re-indexed in full. None if it has no live segment, e.g. in an
+                        # older database, in which case its stems are counted afresh.
+                        old_terms = load_page_terms(page.id)
+                        for name, value in page_fields.items():
+                            setattr(page, name, value)
+                    else:
+                        old_terms = None
+                        page = Page(url=url, parent_id=parent_id, **page_fields)
+                        session.add(page)
+                        session.query(DuplicatePage).filter_by(url=url).delete()
+                    session.flush()
+
+                    # Postings and df updates are written when the batch is flushed
+                    if old_terms is None:
+                        batch.add(page.id, title_positions, body_positions)
+                    else:
+                        batch.update(page.id, old_terms, title_positions, body_positions)
+
+            if original_id is not None:
+                # Its links are not followed either, which keeps a mirror's subtree out of the crawl
+                CRAWL_PAGES.inc('near_duplicate')
+                frontier.task_done(url)
+            else:
+                if fingerprint is None:
+                    fingerprints.remove(page.id)
+                else:
+                    fingerprints.add(page.id, fingerprint)
+                pending.append((url, page.id, depth, links, stats, page_text))
+        except Exception as e:
+            CRAWL_PAGES.inc('index_error')
+            print(f"Error indexing {url}: {e}")
+            frontier.task_done(url)
+
+    def write_batch(session, batch, parsed, pending):
+        """Writer job storing a batch of parsed pages; returns the norms of the pages added to pending."""
+        for item in parsed:
+            store_page(session, batch, pending, *item)
+        if not pending:
+            return {}
+        write_page_texts(session, pending)
+        write_page_links(session, pending)
+        return batch.flush(session)
+
+    def commit_batch(batch, parsed):
+        """Write the parsed pages in one transaction on the writer thread, then publish them."""
+        pending = []  # (url, page_id, depth, links, stats, page_text) of pages written to the batch
+        try:
+            with CRAWL_STAGE_SECONDS.time('db_write'):
+                try:
+                    norms = writer.run(lambda session: write_batch(session, batch, parsed, pending))
+                except Exception:
+                    batch.discard()
+                    raise
+                try:
+                    batch.publish()
+                except Exception as e:
+                    # The pages are committed: their segment stays pending and is published on the next start
+                    print(f"Error publishing batch segment: {e}")
+        except Exception as e:
+            for _, page_id, *_ in pending:
+                fingerprints.remove(page_id)
+            CRAWL_PAGES.inc('index_error', amount=len(pending))
+            print(f"Database error writing batch: {e}")
+        else:
+            if not pending:
+                return
+            CRAWL_PAGES.inc('indexed', amount=len(pending))
+            for _, page_id, _, _, stats, _ in pending:
+                record_page(page_id, *stats, *norms[page_id])
+            bump_generation()
+
+            # Norms of earlier pages drift as df and the collection size change
+            norm_state['changed'] += len(pending)
+            if norm_state['changed'] >= max(NORM_REFRESH_MIN_PAGES, NORM_REFRESH_RATIO * norm_state['pages']):
+                refresh_norms()
+
+            # Queue new URLs only after successful commit
+            for url, page_id, depth, links, *_ in pending:
+                for link in links:
+                    frontier.add(link, depth + 1, page_id)
+                try:
+                    socketio.emit('update', {'data': 'Crawled ' + url})
+                except Exception as e:
+                    # Progress updates are best-effort; the page is committed either way
+                    print(f"Error sending crawl update: {e}")
+        finally:
+            for url, *_ in pending:
+                frontier.task_done(url)
+            # Checkpoint with every batch so committed pages never lose their queued links
+            frontier.checkpoint()
+
+    def indexer():
+        batch = IndexBatch()
+        parsed = []  # (url, depth, parent_id, parse result, etag, last_modified) waiting to be written
+        while True:
+            item = fetched_queue.get()
+            if item is None:
+                break
+
+            url, depth, parent_id, future, etag, last_modified = item
+            try:
+                result = future.result()
+                for stage, seconds in result[-1].items():
+                    CRAWL_STAGE_SECONDS.observe(seconds, stage)
+                parsed.append((url, depth, parent_id, result, etag, last_modified))
+            except Exception as e:
+                CRAWL_PAGES.inc('index_error')
+                print(f"Error indexing {url}: {e}")
+                frontier.task_done(url)
+
+            # Write the batch when it is full or nothing else is ready to index
+            if len(parsed) >= INDEX_BATCH_SIZE or (parsed and fetched_queue.empty()):
+                try:
+                    commit_batch(batch, parsed)
+                except Exception as e:
+                    # This is the only indexer thread: if it died, fetchers would block on the full queue
+                    # and the crawl would never finish. A segment left pending is published on the next start.
+                    print(f"Error indexing batch: {e}")
+                    batch = IndexBatch()
+                parsed = []
+
+        # Bring every norm up to date with the final df counts
+        if norm_state['changed']:
+            refresh_norms()
+
     # Start workers
-    threads = []
-    for _ in range(num_workers):
-        t = Thread(target=worker, daemon=True)
+    fetchers = []
+    for _ in range(num_fetchers):
+        t = Thread(target=fetcher, daemon=True)
         t.start()
-        threads.append(t)
+        fetchers.append(t)
+    index_thread = Thread(target=indexer, daemon=True)
+    index_thread.start()
 
     # Wait for completion
-    url_queue.join()
+    frontier.join()
 
     # Stop workers
-    for _ in range(num_workers):
-        url_queue.put(poison_pill)
-
-    for t in threads:
+    frontier.close()
+    for t in fetchers:
         t.join()
+    fetched_queue.put(None)
+    index_thread.join()
+    if parsers is not None:
+        parsers.shutdown()
+    http.close()
 
-    # Final commit to ensure all data is saved
-    final_session = Session()
-
+    # Rerank the link graph with this crawl's pages and links, starting from the previous ranks
+    session = Session()
     try:
-        final_session.commit()
-        # No need to emit here, app.py will handle the completion message
+        with CRAWL_STAGE_SECONDS.time('pagerank'):
+            update_link_graph(session)
+        bump_generation()
+    except Exception as e:
+        print(f"Error updating link graph: {e}")
     finally:
-        final_session.close()
+        session.close()
 
-    return True
\ No newline at end of file
+    return True
@@ -12,6 +12,17 @@ marked.setOptions({
     sanitize: false       // Allow HTML (sanitize manually if needed)
 });
 
+function renderMarkdown(bubble, text) {
+    try {
+        bubble.innerHTML = marked.parse(text);
+    } catch (e) {
+        // Fallback to basic formatting if marked fails
+        bubble.innerHTML = text
+            .replace(/\n/g, '<br>')
+            .replace(/\*\*(.*?)\*\*/g, '<strong>$1</strong>');
+    }
+}
+
 function appendMessage(sender, text) {
     const msgDiv = document.createElement('div');
     msgDiv.className = sender === 'user' ? 'flex justify-end' : 'flex justify-start';
@@ -24,19 +35,13 @@ function appendMessage(sender, text) {
         bubble.className = 'inline-block px-4 py-2 rounded-2xl shadow transition-all duration-200 max-w-[80%] break-words bg-gray-200 text-gray-900 rounded-bl-md animate-bounce-in-left markdown-bubble';
 
         // Process markdown for bot messages
-        try {
-            bubble.innerHTML = marked.parse(text);
-        } catch (e) {
-            // Fallback to basic formatting if marked fails
-            bubble.innerHTML = text
-                .replace(/\n/g, '<br>')
-                .replace(/\*\*(.*?)\*\*/g, '<strong>$1</strong>');
-        }
+        renderMarkdown(bubble, text);
     }
 
     msgDiv.appendChild(bubble);
     chatWindow.appendChild(msgDiv);
     chatWindow.scrollTop = chatWindow.scrollHeight;
+    return bubble;
 }
 
 // Welcome message
@@ -69,20 +74,40 @@ chatForm.addEventListener('submit', async function(e) {
         const response = await fetch('/chat', {
             method: 'POST',
             headers: {'Content-Type': 'application/json'},
-            body: JSON.stringify({message})
+            body: JSON.stringify({message, stream: true})
         });
 
-        // Remove loading message
-        chatWindow.removeChild(loadingMsgDiv);
-
-        if (response.ok) {
-            const data = await response.json();
-            appendMessage('bot', data.reply);
-        } else {
+        if (!response.ok) {
+            chatWindow.removeChild(loadingMsgDiv);
             appendMessage('bot', 'Sorry, there was an error processing your request.');
+            return;
+        }
+
+        // Render the reply as it streams in, replacing the loading message with the first chunk
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let reply = '';
+        let bubble = null;
+        while (true) {
+            const {done, value} = await reader.read();
+            if (done) break;
+            reply += decoder.decode(value, {stream: true});
+            if (!bubble) {
+                chatWindow.removeChild(loadingMsgDiv);
+                bubble = appendMessage('bot', reply);
+            } else {
+                renderMarkdown(bubble, reply);
+                chatWindow.scrollTop = chatWindow.scrollHeight;
+            }
+        }
+        if (!bubble) {
+            chatWindow.removeChild(loadingMsgDiv);
+            appendMessage('bot', reply);
         }
     } catch (error) {
-        chatWindow.removeChild(loadingMsgDiv);
+        if (loadingMsgDiv.parentNode) {
+            chatWindow.removeChild(loadingMsgDiv);
+        }
         appendMessage('bot', `Sorry, an error occurred: ${error.message}`);
     }
 });
\ No newline at end of file
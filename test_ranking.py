@@ -0,0 +1,54 @@
+import pytest
+from benchmark import SyntheticSite, make_app, bench_index
+from model import db, Page, PageLink
+from engine import IndexEngine
+from indexer import parse_query
+from linkgraph import update_link_graph, reset_link_graph
+from spider import parse_for_index
+from search import rank
+
+NUM_PAGES = 300
+LIMITS = range(1, 51)
+
+SITE = SyntheticSite(NUM_PAGES)
+QUERIES = [query for queries in SITE.queries(10).values() for query in queries] + [
+    'the of and',  # Common words only, so MaxScore has no non-essential lists to skip
+    'the computer science research',
+    'hkust student admission news movie',
+    ' '.join(SITE.vocabulary[30:36]),
+    ' '.join(SITE.vocabulary[200:203]) + ' the',
+    '"computer science" engineering',
+    'nonexistentzzz',
+]
+
+
+@pytest.fixture(scope='module')
+def engine(tmp_path_factory):
+    """IndexEngine over the synthetic site, indexed into a temporary database and segment store with PageRank."""
+    app = make_app(str(tmp_path_factory.mktemp('index')))
+    with app.app_context():
+        bench_index(SITE)
+        session = db.session
+        page_ids = dict(session.query(Page.url, Page.id))
+        rows = []
+        for url, page_id in page_ids.items():
+            links = parse_for_index(url, SITE.render(int(url[len('http://bench.local/page'):-4])), 'bench.local')[3]
+            rows += [{'source_id': page_id, 'target_url': link} for link in links]
+        session.execute(PageLink.__table__.insert(), rows)
+        session.commit()
+        reset_link_graph()
+        update_link_graph(session)
+        yield IndexEngine.load(session)
+        session.remove()
+
+
+@pytest.mark.parametrize('query', QUERIES)
+def test_modes_rank_identically(engine, query):
+    assert engine.static_scores is not None
+    parts = parse_query(query)
+    terms = [content for part_type, content in parts if part_type == 'term']
+    phrases = sorted(content for part_type, content in parts if part_type == 'phrase')
+    for limit in LIMITS:
+        expected = rank(engine, terms, phrases, limit, 'exhaustive')
+        assert rank(engine, terms, phrases, limit, 'vectorized') == expected, limit
+        assert rank(engine, terms, phrases, limit, 'maxscore') == expected, limit
@@ -0,0 +1,53 @@
+import re
+from functools import lru_cache
+from nltk.stem import PorterStemmer
+from metrics import Collected
+
+STEM_CACHE_SIZE = 100000  # Distinct words whose stems are kept in memory
+TOKEN_PATTERN = re.compile(r'\w+')
+
+STOP_WORDS = set()
+with open('stopwords.txt', 'r') as f:
+    STOP_WORDS = {line.strip().lower() for line in f if line.strip()}
+stemmer = PorterStemmer()
+
+
+@lru_cache(maxsize=STEM_CACHE_SIZE)
+def _cached_stem(term):
+    return stemmer.stem(term)
+
+
+def stem_term(term):
+    """Return the stem of a lowercase term, or None for a stop word.
+
+    Stop words are rejected before the stemmer runs, and stems are memoized
+    in a bounded LRU shared by indexing and search.
+    """
+    if term in STOP_WORDS:
+        return None
+    return _cached_stem(term)
+
+
+def iter_tokens(chunks):
+    """Yield lowercase \\w+ tokens from an iterable of text chunks.
+
+    Produces the same tokens as tokenizing the concatenated text, without
+    building it: a token touching the end of a chunk is held back until the
+    next chunk shows whether it continues.
+    """
+    carry = ''
+    for chunk in chunks:
+        text = carry + chunk if carry else chunk
+        carry = ''
+        for match in TOKEN_PATTERN.finditer(text):
+            if match.end() == len(text):
+                carry = match.group()
+            else:
+                yield match.group().lower()
+    if carry:
+        yield carry.lower()
+
+
+Collected('stem_cache_hits_total', 'Stem lookups answered from the cache', lambda: _cached_stem.cache_info().hits, 'counter')
+Collected('stem_cache_misses_total', 'Stem lookups that ran the stemmer', lambda: _cached_stem.cache_info().misses, 'counter')
+Collected('stem_cache_entries', 'Stems held in the cache', lambda: _cached_stem.cache_info().currsize)
@@ -0,0 +1,96 @@
+import queue
+import threading
+from concurrent.futures import Future
+from sqlalchemy.orm import Session
+from model import db
+from metrics import Counter, Histogram, Collected
+
+WRITE_BATCH_SIZE = 32  # Most queued writes committed in one transaction
+
+WRITER_JOBS = Counter('db_writer_jobs_total', 'Writes run by the database writer thread, by outcome', ('outcome',))
+WRITER_COMMIT_SECONDS = Histogram('db_writer_commit_seconds', 'Time to commit one batch of queued writes')
+
+
+class DatabaseWriter:
+    """Dedicated thread through which every database write goes.
+
+    submit(write) queues a call of write(session) and returns a Future of
+    its result. The thread takes up to WRITE_BATCH_SIZE queued writes at a
+    time and runs each in its own savepoint, so a write that raises is
+    rolled back alone and its future gets the exception, then commits the
+    rest together. With one writer SQLite never makes writers wait on each
+    other, and in WAL mode readers never wait on it. Writes should return
+    plain values rather than ORM objects, which expire on commit.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def submit(self, write):
+        future = Future()
+        self._queue.put((write, future))
+        return future
+
+    def run(self, write):
+        """Run write(session) on the writer thread and return its result once committed."""
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("A write can't wait for another write")
+        return self.submit(write).result()
+
+    def _run(self):
+        session = Session(bind=self.engine)
+        while True:
+            jobs = [self._queue.get()]
+            while len(jobs) < WRITE_BATCH_SIZE:
+                try:
+                    jobs.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            done = []
+            for write, future in jobs:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    with session.begin_nested():
+                        done.append((future, write(session)))
+                except Exception as e:
+                    WRITER_JOBS.inc('error')
+                    future.set_exception(e)
+            try:
+                with WRITER_COMMIT_SECONDS.time():
+                    session.commit()
+            except Exception as e:
+                session.rollback()
+                print(f"Database error committing writes: {e}")
+                for future, _ in done:
+                    WRITER_JOBS.inc('error')
+                    future.set_exception(e)
+            else:
+                for future, result in done:
+                    WRITER_JOBS.inc('committed')
+                    future.set_result(result)
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_writer(engine=None):
+    """Return the writer thread of engine, db.engine by default, starting it on first use."""
+    engine = db.engine if engine is None else engine
+    with _writers_lock:
+        writer = _writers.get(engine)
+        if writer is None:
+            writer = _writers[engine] = DatabaseWriter(engine)
+        return writer
+
+
+Collected('db_writer_queued', 'Writes waiting for the database writer thread',
+          lambda: sum(len(writer) for writer in list(_writers.values())))